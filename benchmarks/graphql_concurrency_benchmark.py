@@ -0,0 +1,176 @@
+"""
+Measures GraphQL latency under a mix of fast and slow queries, with blocking resolvers (the web service's
+original sync Session path) and with the async session path, each served by uvicorn on SQLite.
+
+Fast requests look up one device; slow requests page through a long location history. SQLite answers both in
+microseconds, so ``--db-delay-us`` makes the database sleep for that long every 1000 virtual machine steps,
+standing in for a loaded MySQL server: the slow query waits on the database much longer than the fast one.
+
+Usage:
+    python -m benchmarks.graphql_concurrency_benchmark --duration 5 --concurrency 20 --slow-ratio 0.05
+"""
+import argparse
+import asyncio
+import datetime
+import os
+import random
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+import httpx
+import strawberry
+import uvicorn
+from fastapi import Depends, FastAPI
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from strawberry import Info
+from strawberry.fastapi import GraphQLRouter
+
+from benchmarks.common import find_free_port, print_table, summarize_latencies
+from src.model import Device
+from src.schema import DeviceType, LocationType, Mutation, Query
+from src.service.database_service import DatabaseService
+from src.sql_query import get_location_history_by_device, insert_locations
+
+FAST_QUERY = "query { deviceById(deviceId: %d) { id name } }"
+SLOW_QUERY = "query { locationHistoryByDevice(deviceId: 1, first: 1000) { edges { node { latitude } } } }"
+
+
+@strawberry.type
+class BlockingEdge:
+    node: LocationType
+
+
+@strawberry.type
+class BlockingConnection:
+    edges: List[BlockingEdge]
+
+
+@strawberry.type
+class BlockingQuery:
+    """The resolvers as they were before the async path: a blocking Session used on the event loop."""
+
+    @strawberry.field
+    def device_by_id(self, info: Info, device_id: int) -> Optional[DeviceType]:
+        session: Session = info.context['db']
+        return session.query(Device).filter(Device.id == device_id).first()
+
+    @strawberry.field
+    def location_history_by_device(self, info: Info, device_id: int, first: int) -> BlockingConnection:
+        session: Session = info.context['db']
+        return BlockingConnection(edges=[BlockingEdge(node=location) for location in
+                                         get_location_history_by_device(device_id, session, limit=first)])
+
+
+def slow_down(database_service: DatabaseService, delay: float):
+    def progress():
+        time.sleep(delay)
+        return 0
+
+    @event.listens_for(database_service.session_local.kw["bind"], "connect")
+    def on_connect(dbapi_connection, connection_record):
+        dbapi_connection.set_progress_handler(progress, 1000)
+
+    if database_service.async_session_local is not None:
+        @event.listens_for(database_service.async_session_local.kw["bind"].sync_engine, "connect")
+        def on_async_connect(dbapi_connection, connection_record):
+            dbapi_connection.await_(dbapi_connection._connection.set_progress_handler(progress, 1000))
+
+
+def seed(database_url: str, num_devices: int, history_length: int):
+    database_service = DatabaseService(database_url)
+    with database_service.session_local() as db:
+        db.add_all([Device(name=f"Device {i}") for i in range(1, num_devices + 1)])
+        db.flush()
+        started = datetime.datetime(2024, 8, 7)
+        insert_locations([{"device_id": 1, "latitude": 41.0, "longitude": 29.0,
+                           "timestamp": started + datetime.timedelta(seconds=i)} for i in range(history_length)], db)
+        db.commit()
+
+
+def create_app(database_url: str, mode: str, delay: float) -> FastAPI:
+    database_service = DatabaseService(database_url, use_async=mode == "async")
+    slow_down(database_service, delay)
+    if mode == "async":
+        schema = strawberry.Schema(query=Query, mutation=Mutation)
+        get_db = database_service.get_async_db
+    else:
+        schema = strawberry.Schema(query=BlockingQuery)
+        get_db = database_service.get_db
+
+    async def get_context(db=Depends(get_db)):
+        return {"db": db}
+
+    app = FastAPI()
+    app.include_router(GraphQLRouter(schema, context_getter=get_context), prefix="/graphql")
+    return app
+
+
+def start_server(app: FastAPI, port: int) -> uvicorn.Server:
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    threading.Thread(target=server.run, daemon=True).start()
+    while not server.started:
+        time.sleep(0.05)
+    return server
+
+
+async def run_clients(url: str, args) -> dict:
+    latencies = {"fast": [], "slow": []}
+    deadline = time.perf_counter() + args.duration
+    rng = random.Random(1)
+
+    async def client(http: httpx.AsyncClient):
+        while time.perf_counter() < deadline:
+            kind = "slow" if rng.random() < args.slow_ratio else "fast"
+            query = SLOW_QUERY if kind == "slow" else FAST_QUERY % rng.randint(1, args.devices)
+            started = time.perf_counter()
+            response = await http.post(url, json={"query": query})
+            response.raise_for_status()
+            latencies[kind].append(time.perf_counter() - started)
+
+    limits = httpx.Limits(max_connections=args.concurrency)
+    async with httpx.AsyncClient(limits=limits, timeout=60) as http:
+        await asyncio.gather(*(client(http) for _ in range(args.concurrency)))
+    return latencies
+
+
+def run_mode(directory: str, mode: str, args) -> list[dict]:
+    database_url = f"sqlite:///{os.path.join(directory, 'graphql.db')}"
+    port = find_free_port()
+    server = start_server(create_app(database_url, mode, args.db_delay_us / 1e6), port)
+    try:
+        latencies = asyncio.run(run_clients(f"http://127.0.0.1:{port}/graphql", args))
+    finally:
+        server.should_exit = True
+    rows = []
+    for kind, values in latencies.items():
+        summary = summarize_latencies(values)
+        rows.append({"mode": mode, "query": kind, "requests": summary["count"],
+                     "req/s": summary["count"] / args.duration, "p50_ms": summary["p50_ms"],
+                     "p99_ms": summary["p99_ms"], "max_ms": summary["max_ms"]})
+    return rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--slow-ratio", type=float, default=0.05)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--history-length", type=int, default=20000)
+    parser.add_argument("--db-delay-us", type=float, default=5000)
+    parser.add_argument("--modes", nargs="+", default=["blocking", "async"], choices=["blocking", "async"])
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        seed(f"sqlite:///{os.path.join(directory, 'graphql.db')}", args.devices, args.history_length)
+        rows = []
+        for mode in args.modes:
+            rows.extend(run_mode(directory, mode, args))
+    print_table(f"GraphQL latency, {args.concurrency} clients, {args.slow_ratio:.0%} slow queries", rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,74 @@
+"""
+Measures how many simulated devices the vectorized load generator can drive from one process.
+
+First the fleet step alone is timed: moving and encoding every device once. Then a TCP server (asyncio mode) is
+started in a separate process, with its output queue drained, and the generator streams the whole fleet to it
+at the target rate over a pool of persistent connections, reporting the achieved rate and ACK latencies.
+
+Usage:
+    python -m benchmarks.load_generator_benchmark --devices 1000000 --rate 200000 --connections 8 --duration 10
+"""
+import argparse
+import asyncio
+import multiprocessing
+import queue
+import threading
+import time
+
+from benchmarks.common import find_free_port, print_table
+from src.load_generator import DeviceFleet, LoadGenerator
+from tcp_server import TCP_SERVER_MODES
+
+HOST = "127.0.0.1"
+
+
+def drain(output_queue: queue.Queue):
+    while True:
+        output_queue.get()
+
+
+def serve(port: int):
+    output_queue = queue.Queue()
+    threading.Thread(target=drain, args=(output_queue,), daemon=True).start()
+    TCP_SERVER_MODES["asyncio"](host=HOST, port=port, output_queue=output_queue, read_timeout=30).start()
+
+
+def time_fleet_step(devices: int, batch_size: int) -> dict:
+    fleet = DeviceFleet(range(1, devices + 1), seed=1)
+    started = time.perf_counter()
+    for position in range(0, devices, batch_size):
+        batch = slice(position, position + batch_size)
+        fleet.move(batch)
+        fleet.encode_records(batch, int(time.time()))
+    elapsed = time.perf_counter() - started
+    return {"devices": devices, "batch_size": batch_size, "step_s": elapsed, "fixes/s": devices / elapsed}
+
+
+def run(args) -> dict:
+    port = find_free_port(HOST)
+    server = multiprocessing.get_context("spawn").Process(target=serve, args=(port,), daemon=True)
+    server.start()
+    time.sleep(1)
+    try:
+        generator = LoadGenerator(HOST, port, range(1, args.devices + 1), rate=args.rate,
+                                  connections=args.connections, batch_size=args.batch_size, seed=1)
+        summary = asyncio.run(generator.run(args.duration))
+    finally:
+        server.terminate()
+    return {"devices": args.devices, "target/s": args.rate, "connections": args.connections, **summary}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=1_000_000)
+    parser.add_argument("--rate", type=float, default=200_000, help="Target fixes per second")
+    parser.add_argument("--connections", type=int, default=8)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+    print_table("Fleet step (move + encode)", [time_fleet_step(args.devices, args.batch_size)])
+    print_table("Load generator against the asyncio TCP server", [run(args)])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+"""
+In-process stand-in for RabbitMQ that implements the subset of pika's ``BlockingConnection`` the services use.
+
+Queues live in memory and are shared by every connection of the process: the default exchange routes by queue
+name, fanout exchanges copy a message to every bound queue. Consumers get manual acknowledgements with
+``basic_ack``/``basic_nack`` (``multiple`` included), a prefetch limit, ``consume`` with an inactivity timeout and
+``basic_consume``/``start_consuming``. Publisher confirms are a no-op since nothing can be lost.
+
+``LocalBroker.install()`` replaces ``pika.BlockingConnection``, so the unmodified services connect to it. The
+broker records how long every message waited in its queue.
+"""
+import itertools
+import threading
+import time
+from collections import defaultdict, deque
+from types import SimpleNamespace
+
+import pika
+
+
+class LocalBroker:
+    def __init__(self):
+        self.condition = threading.Condition()
+        self.queues = {}
+        self.bindings = defaultdict(set)
+        self.names = itertools.count(1)
+        self.wait_latencies = []
+
+    def install(self):
+        pika.BlockingConnection = self.connect
+
+    def connect(self, parameters=None) -> "LocalConnection":
+        return LocalConnection(self)
+
+    def declare_queue(self, name: str = "") -> str:
+        with self.condition:
+            name = name or f"amq.gen-{next(self.names)}"
+            self.queues.setdefault(name, deque())
+            return name
+
+    def bind(self, exchange: str, queue_name: str):
+        with self.condition:
+            self.bindings[exchange].add(queue_name)
+
+    def publish(self, exchange: str, routing_key: str, body: bytes, properties):
+        message = (body, properties, time.perf_counter())
+        with self.condition:
+            for queue_name in (self.bindings[exchange] if exchange else (routing_key,)):
+                if queue_name in self.queues:
+                    self.queues[queue_name].append(message)
+            self.condition.notify_all()
+
+    def get(self, queue_name: str, timeout: float = None):
+        """Returns the next (body, properties, published_at) of a queue, or None after timeout seconds."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self.condition:
+            while not self.queues[queue_name]:
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self.condition.wait(remaining)
+            message = self.queues[queue_name].popleft()
+            self.wait_latencies.append(time.perf_counter() - message[2])
+            return message
+
+    def requeue(self, queue_name: str, messages: list):
+        with self.condition:
+            self.queues[queue_name].extendleft(reversed(messages))
+            self.condition.notify_all()
+
+    def depth(self, queue_name: str) -> int:
+        with self.condition:
+            return len(self.queues.get(queue_name, ()))
+
+
+class LocalConnection:
+    def __init__(self, broker: LocalBroker):
+        self.broker = broker
+        self.is_open = True
+
+    def channel(self) -> "LocalChannel":
+        return LocalChannel(self.broker)
+
+    def close(self):
+        self.is_open = False
+
+
+class LocalChannel:
+    def __init__(self, broker: LocalBroker):
+        self.broker = broker
+        self.is_open = True
+        self.prefetch_count = 0
+        self.delivery_tags = itertools.count(1)
+        self.unacked = {}
+        self.consumers = []
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue: str = "", **kwargs):
+        return SimpleNamespace(method=SimpleNamespace(queue=self.broker.declare_queue(queue)))
+
+    def exchange_declare(self, exchange: str, exchange_type: str = "fanout", **kwargs):
+        pass
+
+    def queue_bind(self, queue: str, exchange: str, **kwargs):
+        self.broker.bind(exchange, queue)
+
+    def basic_qos(self, prefetch_count: int = 0, **kwargs):
+        self.prefetch_count = prefetch_count
+
+    def basic_publish(self, exchange: str, routing_key: str, body: bytes, properties=None, **kwargs):
+        self.broker.publish(exchange, routing_key, body, properties or pika.BasicProperties())
+
+    def _deliver(self, queue_name: str, auto_ack: bool, timeout: float = None):
+        if not auto_ack and self.prefetch_count and len(self.unacked) >= self.prefetch_count:
+            time.sleep(timeout or 0)
+            return None
+        message = self.broker.get(queue_name, timeout)
+        if message is None:
+            return None
+        body, properties, _ = message
+        delivery_tag = next(self.delivery_tags)
+        if not auto_ack:
+            self.unacked[delivery_tag] = (queue_name, message)
+        return SimpleNamespace(delivery_tag=delivery_tag), properties, body
+
+    def consume(self, queue: str, auto_ack: bool = False, exclusive: bool = False, inactivity_timeout=None):
+        while self.is_open:
+            delivery = self._deliver(queue, auto_ack, inactivity_timeout)
+            yield delivery if delivery is not None else (None, None, None)
+
+    def _settle(self, delivery_tag: int, multiple: bool) -> dict:
+        tags = [tag for tag in self.unacked if tag <= delivery_tag] if multiple else [delivery_tag]
+        settled = defaultdict(list)
+        for tag in tags:
+            queue_name, message = self.unacked.pop(tag)
+            settled[queue_name].append(message)
+        return settled
+
+    def basic_ack(self, delivery_tag: int, multiple: bool = False):
+        self._settle(delivery_tag, multiple)
+
+    def basic_nack(self, delivery_tag: int, multiple: bool = False, requeue: bool = True):
+        for queue_name, messages in self._settle(delivery_tag, multiple).items():
+            if requeue:
+                self.broker.requeue(queue_name, messages)
+
+    def basic_consume(self, queue: str, on_message_callback, auto_ack: bool = False, **kwargs):
+        self.consumers.append((queue, on_message_callback, auto_ack))
+
+    def start_consuming(self):
+        while self.is_open:
+            for queue_name, callback, auto_ack in self.consumers:
+                delivery = self._deliver(queue_name, auto_ack, timeout=0.1)
+                if delivery is not None:
+                    callback(self, *delivery)
+
+    def close(self):
+        self.is_open = False
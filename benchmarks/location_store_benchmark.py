@@ -0,0 +1,139 @@
+"""
+Compares the columnar location store with the ``locations`` table: write throughput of the data processor, storage
+per fix and history reads.
+
+Both backends are loaded through ``GPSDataProcessor`` with the same fixes, one per second per device. History reads
+pick a random device and time:
+- ``range scan``: every fix of a ``--window`` seconds range, as plain columns.
+- ``page``: a page of ``--page-size`` locations through ``get_location_history_by_device``, as the GraphQL API
+  reads them.
+
+The database is a temporary SQLite file unless ``--database-url`` points to an empty scratch database; storage is
+measured from the SQLite file or, on MySQL, from ``information_schema``.
+
+Usage:
+    python -m benchmarks.location_store_benchmark --devices 100 --fixes-per-device 10000 --window 3600
+"""
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import datetime
+
+from sqlalchemy import text
+from sqlalchemy.engine import make_url
+
+from benchmarks.common import print_table, summarize_latencies
+from gps_data_processor import GPSDataProcessor
+from src.gps_record import CONTENT_TYPE_RECORDS, RECORD_STRUCT
+from src.location_store import ColumnarLocationStore
+from src.model import Device, Location
+from src.sql_query import get_location_history_by_device, location_history_statement
+
+START = 1723000000
+
+
+def generate_messages(args) -> list:
+    """Queue messages of --records-per-message records, every device reporting once per second."""
+    records = [RECORD_STRUCT.pack(device_id, START + second, 41.0 + second * 1e-6, 29.0 + device_id * 1e-3)
+               for second in range(args.fixes_per_device) for device_id in range(1, args.devices + 1)]
+    return [(b"".join(records[i:i + args.records_per_message]), CONTENT_TYPE_RECORDS)
+            for i in range(0, len(records), args.records_per_message)]
+
+
+def load(processor: GPSDataProcessor, messages: list, batch_size: int) -> float:
+    started = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        processor.process_gps_batch(messages[i:i + batch_size])
+    return time.perf_counter() - started
+
+
+def sql_bytes(processor: GPSDataProcessor, database_url: str) -> int:
+    url = make_url(database_url)
+    if url.get_backend_name() == "sqlite":
+        return os.path.getsize(url.database)
+    with processor.database_service.session_local() as db:
+        return db.execute(text("SELECT data_length + index_length FROM information_schema.TABLES "
+                               "WHERE table_schema = DATABASE() AND table_name = 'locations'")).scalar()
+
+
+def store_bytes(directory: str) -> int:
+    allocated = 0
+    for root, _, files in os.walk(directory):
+        allocated += sum(os.stat(os.path.join(root, name)).st_blocks * 512 for name in files)
+    return allocated
+
+
+def time_reads(read, args) -> dict:
+    rng = random.Random(1)
+    latencies, fixes = [], 0
+    for _ in range(args.scans):
+        device_id = rng.randint(1, args.devices)
+        start = START + rng.randrange(max(1, args.fixes_per_device - args.window))
+        started = time.perf_counter()
+        fixes += len(read(device_id, datetime.utcfromtimestamp(start), datetime.utcfromtimestamp(start + args.window)))
+        latencies.append(time.perf_counter() - started)
+    return {"fixes/read": fixes / args.scans, "reads/s": args.scans / sum(latencies),
+            **summarize_latencies(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=100)
+    parser.add_argument("--fixes-per-device", type=int, default=10000)
+    parser.add_argument("--records-per-message", type=int, default=500)
+    parser.add_argument("--batch-size", type=int, default=100, help="Messages per processor batch")
+    parser.add_argument("--window", type=int, default=3600, help="Seconds of a range scan")
+    parser.add_argument("--page-size", type=int, default=100)
+    parser.add_argument("--scans", type=int, default=200)
+    parser.add_argument("--database-url",
+                        help="Empty scratch database of the locations table, a temporary SQLite file if unset")
+    args = parser.parse_args()
+
+    messages = generate_messages(args)
+    total_fixes = args.devices * args.fixes_per_device
+    with tempfile.TemporaryDirectory() as directory:
+        database_url = args.database_url or f"sqlite:///{os.path.join(directory, 'locations.db')}"
+        processor = GPSDataProcessor(database_url)
+        with processor.database_service.session_local() as db:
+            db.add_all([Device(name=f"Device {i}") for i in range(1, args.devices + 1)])
+            db.commit()
+        sql_seconds = load(processor, messages, args.batch_size)
+        store_directory = os.path.join(directory, "store")
+        store_processor = GPSDataProcessor(database_url, location_store=ColumnarLocationStore(store_directory))
+        store_seconds = load(store_processor, messages, args.batch_size)
+        store = ColumnarLocationStore(store_directory, read_only=True)
+        writes = [
+            {"backend": "locations table", "fixes/s": total_fixes / sql_seconds,
+             "bytes/fix": sql_bytes(processor, database_url) / total_fixes},
+            {"backend": "columnar store", "fixes/s": total_fixes / store_seconds,
+             "bytes/fix": store_bytes(store_directory) / total_fixes},
+        ]
+
+        with processor.database_service.session_local() as db:
+            columns = (Location.id, Location.timestamp, Location.latitude, Location.longitude)
+
+            def sql_scan(device_id, start, end):
+                return db.execute(location_history_statement(device_id, start, end)
+                                  .with_only_columns(*columns)).all()
+
+            def sql_page(device_id, start, end):
+                return get_location_history_by_device(device_id, db, start=start, end=end, limit=args.page_size)
+
+            def store_page(device_id, start, end):
+                return get_location_history_by_device(device_id, db, start=start, end=end, limit=args.page_size,
+                                                      store=store)
+
+            reads = [
+                {"backend": "locations table", "query": "range scan", **time_reads(sql_scan, args)},
+                {"backend": "columnar store", "query": "range scan", **time_reads(store.read, args)},
+                {"backend": "locations table", "query": "page", **time_reads(sql_page, args)},
+                {"backend": "columnar store", "query": "page", **time_reads(store_page, args)},
+            ]
+    print_table(f"Writes of {total_fixes} fixes", writes)
+    print_table("History reads", reads)
+
+
+if __name__ == "__main__":
+    main()
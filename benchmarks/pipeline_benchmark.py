@@ -0,0 +1,411 @@
+"""
+End-to-end benchmark of the ingest pipeline on one box, with SQLite and an in-process broker stand-in.
+
+Every scenario runs in its own process, so its peak RSS is its own:
+- ``ingest``: the load generator streams binary fixes to the asyncio TCPServer, whose output queue is drained.
+  Latency is the time until the server acknowledged a batch.
+- ``publish``: RabbitMQPublisher drains a pre-filled ingest buffer into the broker. Latency is per published batch.
+- ``process``: RabbitMQListener and GPSDataProcessor drain a pre-filled broker queue into SQLite. Latency is per
+  processed batch.
+- ``graphql``: concurrent ``lastLocationByDevice`` and ``locationHistoryByDevice`` queries against the FastAPI app
+  over ASGI, on a populated database.
+- ``pipeline``: all of the above at once. Probe fixes of a dedicated device are sent every few milliseconds, and
+  their latency from being sent to being committed is the end-to-end latency. The per-stage latencies of this row
+  are the time fixes spent waiting in the ingest buffer and in the broker.
+
+Results are printed and, with ``--output``, written as JSON together with the git commit and the arguments.
+``--baseline`` compares the run with an earlier results file and exits with status 1 when a throughput dropped,
+or a p99 latency or the peak RSS grew, by more than ``--tolerance``.
+
+Usage:
+    python -m benchmarks.pipeline_benchmark --duration 5 --output results.json
+    python -m benchmarks.pipeline_benchmark --duration 5 --baseline results.json
+"""
+import argparse
+import asyncio
+import json
+import multiprocessing
+import os
+import platform
+import queue
+import random
+import resource
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from collections import deque
+from datetime import datetime, timezone
+
+import pika
+
+from benchmarks.common import find_free_port, print_table, summarize_latencies
+from benchmarks.local_broker import LocalBroker
+from src.gps_record import CONTENT_TYPE_RECORDS, RECORD_STRUCT
+from src.protocol import FORMAT_BINARY
+
+HOST = "127.0.0.1"
+GPS_QUEUE = "gps"
+SCENARIOS = ("ingest", "publish", "process", "graphql", "pipeline")
+# Metrics compared against a baseline, and whether higher values are better.
+COMPARED_METRICS = {"fixes/s": True, "requests/s": True, "p99_ms": False, "e2e_p99_ms": False,
+                    "peak_rss_mb": False}
+
+
+def peak_rss_mb() -> float:
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def generate_messages(devices: int, fixes: int, records_per_message: int) -> list[bytes]:
+    records = b"".join(RECORD_STRUCT.pack(i % devices + 1, 1723000000 + i // devices, 41.0 + i * 1e-7, 29.0)
+                       for i in range(fixes))
+    size = records_per_message * RECORD_STRUCT.size
+    return [records[i:i + size] for i in range(0, len(records), size)]
+
+
+def create_database(directory: str, devices: int) -> str:
+    from src.model import Device
+    from src.service.database_service import connect_to_db
+    database_url = f"sqlite:///{os.path.join(directory, 'pipeline.db')}"
+    database_service = connect_to_db(database_url)
+    with database_service.session_local() as db:
+        # WAL lets the web service read while the processor writes.
+        db.connection().exec_driver_sql("PRAGMA journal_mode=WAL")
+        db.add_all([Device(name=f"Device {i}") for i in range(1, devices + 2)])
+        db.commit()
+    return database_url
+
+
+def wait_until(condition, timeout: float, interval: float = 0.01) -> bool:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(interval)
+    return True
+
+
+def run_ingest(args, directory: str) -> dict:
+    from src.load_generator import LoadGenerator
+    from tcp_server import AsyncTCPServer
+
+    port = find_free_port(HOST)
+    output_queue = queue.Queue()
+    received = [0]
+
+    def drain():
+        while True:
+            received[0] += len(output_queue.get()) // RECORD_STRUCT.size
+
+    threading.Thread(target=AsyncTCPServer(host=HOST, port=port, output_queue=output_queue).start,
+                     daemon=True).start()
+    threading.Thread(target=drain, daemon=True).start()
+    time.sleep(0.2)
+    generator = LoadGenerator(HOST, port, range(1, args.devices + 1), rate=args.rate, connections=args.connections,
+                              batch_size=args.batch_size, data_format=FORMAT_BINARY, seed=1)
+    started = time.perf_counter()
+    asyncio.run(generator.run(args.duration))
+    elapsed = time.perf_counter() - started
+    return {"fixes/s": received[0] / elapsed, **summarize_latencies(generator.totals.latencies)}
+
+
+class TimedPublisher:
+    """Wraps RabbitMQPublisher.publish_batch to time every batch and count the fixes it published."""
+
+    def __init__(self, publisher):
+        self.publish_batch = publisher.publish_batch
+        self.latencies = []
+        self.published = 0
+        publisher.publish_batch = self
+
+    def __call__(self, queue_name, messages: list):
+        started = time.perf_counter()
+        self.publish_batch(queue_name, messages)
+        self.latencies.append(time.perf_counter() - started)
+        self.published += sum(len(message) for message in messages) // RECORD_STRUCT.size
+
+
+def create_publisher(input_queue, broker: LocalBroker):
+    from tcp_server import RabbitMQPublisher
+    broker.declare_queue(GPS_QUEUE)
+    publisher = RabbitMQPublisher(input_queue=input_queue, rabbitmq_queue_name=GPS_QUEUE, rabbitmq_host=HOST,
+                                  rabbitmq_port=5672, partitions=1)
+    return publisher, TimedPublisher(publisher)
+
+
+def run_publish(args, directory: str) -> dict:
+    from src.ingest_buffer import IngestBuffer
+    broker = LocalBroker()
+    broker.install()
+    messages = generate_messages(args.devices, args.fixes, args.records_per_message)
+    buffer = IngestBuffer(high_watermark=len(messages) + 1, low_watermark=len(messages))
+    for message in messages:
+        buffer.put(message)
+    publisher, timer = create_publisher(buffer, broker)
+    started = time.perf_counter()
+    threading.Thread(target=publisher.listen_internal_queue, daemon=True).start()
+    wait_until(lambda: timer.published >= args.fixes, timeout=600)
+    elapsed = time.perf_counter() - started
+    return {"fixes/s": timer.published / elapsed, **summarize_latencies(timer.latencies)}
+
+
+class TimedBatches:
+    """Times every batch GPSDataProcessor processes and counts its fixes."""
+
+    def __init__(self, process_gps_batch):
+        self.process_gps_batch = process_gps_batch
+        self.latencies = []
+        self.processed = 0
+
+    def __call__(self, messages: list):
+        started = time.perf_counter()
+        self.process_gps_batch(messages)
+        self.latencies.append(time.perf_counter() - started)
+        self.processed += sum(len(body) for body, _ in messages) // RECORD_STRUCT.size
+
+
+def start_processor(database_url: str, location_updates=None) -> TimedBatches:
+    from gps_data_processor import GPSDataProcessor, RabbitMQListener
+    processor = GPSDataProcessor(database_url, location_updates=location_updates)
+    batches = TimedBatches(processor.process_gps_batch)
+    listener = RabbitMQListener(process_method=batches, host=HOST, port=5672, queue_name=GPS_QUEUE)
+    threading.Thread(target=listener.listen_queue, daemon=True).start()
+    return batches
+
+
+def run_process(args, directory: str) -> dict:
+    broker = LocalBroker()
+    broker.install()
+    database_url = create_database(directory, args.devices)
+    broker.declare_queue(GPS_QUEUE)
+    properties = pika.BasicProperties(content_type=CONTENT_TYPE_RECORDS)
+    for message in generate_messages(args.devices, args.fixes, args.records_per_message):
+        broker.publish("", GPS_QUEUE, message, properties)
+    started = time.perf_counter()
+    batches = start_processor(database_url)
+    wait_until(lambda: batches.processed >= args.fixes, timeout=600)
+    elapsed = time.perf_counter() - started
+    return {"fixes/s": batches.processed / elapsed, **summarize_latencies(batches.latencies)}
+
+
+async def query_graphql(app, devices: int, duration: float, concurrency: int) -> dict:
+    import httpx
+    queries = ["query($id: Int!) { lastLocationByDevice(deviceId: $id) { latitude longitude timestamp } }",
+               "query($id: Int!) { locationHistoryByDevice(deviceId: $id, first: 100) "
+               "{ edges { node { latitude longitude timestamp } } } }"]
+    latencies, errors = [], [0]
+    deadline = time.perf_counter() + duration
+
+    async def worker(client: httpx.AsyncClient, rng: random.Random):
+        while time.perf_counter() < deadline:
+            started = time.perf_counter()
+            response = await client.post("/graphql", json={"query": rng.choice(queries),
+                                                           "variables": {"id": rng.randint(1, devices)}})
+            if response.status_code == 200 and not response.json().get("errors"):
+                latencies.append(time.perf_counter() - started)
+            else:
+                errors[0] += 1
+
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://benchmark") as client:
+        await asyncio.gather(*(worker(client, random.Random(i)) for i in range(concurrency)))
+    return {"requests/s": len(latencies) / duration, "errors": errors[0], **summarize_latencies(latencies)}
+
+
+def import_web_app(database_url: str):
+    os.environ["DATABASE_URL"] = database_url
+    os.environ.pop("RABBITMQ_HOST", None)
+    from main_web import app
+    return app
+
+
+def run_graphql(args, directory: str) -> dict:
+    from gps_data_processor import GPSDataProcessor
+    database_url = create_database(directory, args.devices)
+    processor = GPSDataProcessor(database_url)
+    messages = [(message, CONTENT_TYPE_RECORDS)
+                for message in generate_messages(args.devices, args.fixes, args.records_per_message)]
+    for i in range(0, len(messages), 500):
+        processor.process_gps_batch(messages[i:i + 500])
+    app = import_web_app(database_url)
+    return asyncio.run(query_graphql(app, args.devices, args.duration, args.graphql_concurrency))
+
+
+class ProbeRecorder:
+    """Stands in for the location updates publisher and measures the end-to-end latency of probe fixes."""
+
+    def __init__(self, device_id: int):
+        self.device_id = device_id
+        self.sent = {}
+        self.latencies = []
+
+    def locations_saved(self, rows: list[dict]):
+        now = time.perf_counter()
+        for row in rows:
+            if row["device_id"] == self.device_id:
+                sent = self.sent.pop(int(row["latitude"]), None)
+                if sent is not None:
+                    self.latencies.append(now - sent)
+
+
+def send_probes(port: int, probes: ProbeRecorder, interval: float, stop: threading.Event):
+    from src.iot_device import DeviceConnection
+    with DeviceConnection(HOST, port, data_format=FORMAT_BINARY) as connection:
+        seq = 0
+        while not stop.is_set():
+            seq += 1
+            probes.sent[seq] = time.perf_counter()
+            connection.send({"device_id": probes.device_id, "timestamp": int(time.time()), "latitude": seq,
+                             "longitude": 0.0})
+            connection.wait_for_ack()
+            time.sleep(interval)
+
+
+def time_buffer(buffer) -> list:
+    """Records how long every item waits in the in-memory ingest buffer, which hands items out in FIFO order."""
+    put_times, latencies = deque(), []
+    put, get = buffer.put, buffer.get
+
+    def timed_put(item, block: bool = True, timeout: float = None):
+        put_times.append(time.perf_counter())
+        put(item, block, timeout)
+
+    def timed_get(block: bool = True, timeout: float = None):
+        item = get(block, timeout)
+        latencies.append(time.perf_counter() - put_times.popleft())
+        return item
+
+    buffer.put, buffer.get = timed_put, timed_get
+    return latencies
+
+
+def run_pipeline(args, directory: str) -> dict:
+    from src.ingest_buffer import IngestBuffer
+    from src.load_generator import LoadGenerator
+    from tcp_server import AsyncTCPServer
+
+    broker = LocalBroker()
+    broker.install()
+    database_url = create_database(directory, args.devices)
+    app = import_web_app(database_url)
+    port = find_free_port(HOST)
+    buffer = IngestBuffer(high_watermark=100_000, low_watermark=50_000)
+    buffer_latencies = time_buffer(buffer)
+    threading.Thread(target=AsyncTCPServer(host=HOST, port=port, output_queue=buffer).start, daemon=True).start()
+    publisher, _ = create_publisher(buffer, broker)
+    threading.Thread(target=publisher.listen_internal_queue, daemon=True).start()
+    probes = ProbeRecorder(device_id=args.devices + 1)
+    batches = start_processor(database_url, location_updates=probes)
+    time.sleep(0.2)
+
+    stop = threading.Event()
+    threading.Thread(target=send_probes, args=(port, probes, args.probe_interval_ms / 1000, stop),
+                     daemon=True).start()
+    generator = LoadGenerator(HOST, port, range(1, args.devices + 1), rate=args.rate, connections=args.connections,
+                              batch_size=args.batch_size, data_format=FORMAT_BINARY, seed=1)
+
+    async def run_all():
+        return await asyncio.gather(generator.run(args.duration),
+                                    query_graphql(app, args.devices, args.duration, args.graphql_concurrency))
+
+    processed_before = batches.processed
+    started = time.perf_counter()
+    _, graphql = asyncio.run(run_all())
+    elapsed = time.perf_counter() - started
+    stop.set()
+    end_to_end = summarize_latencies(probes.latencies)
+    return {"fixes/s": (batches.processed - processed_before) / elapsed, "requests/s": graphql["requests/s"],
+            "ack_p99_ms": summarize_latencies(generator.totals.latencies)["p99_ms"],
+            "buffer_p99_ms": summarize_latencies(buffer_latencies)["p99_ms"],
+            "broker_p99_ms": summarize_latencies(broker.wait_latencies)["p99_ms"],
+            "graphql_p99_ms": graphql["p99_ms"], "e2e_p50_ms": end_to_end["p50_ms"],
+            "e2e_p99_ms": end_to_end["p99_ms"], "e2e_max_ms": end_to_end["max_ms"]}
+
+
+def run_scenario(name: str, args, results: multiprocessing.Queue):
+    with tempfile.TemporaryDirectory() as directory:
+        result = globals()[f"run_{name}"](args, directory)
+    results.put({"stage": name, **result, "peak_rss_mb": peak_rss_mb()})
+    results.close()
+    results.join_thread()
+    # Background threads of the services never return, so leave without waiting for them.
+    os._exit(0)
+
+
+def run_isolated(name: str, args) -> dict:
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=run_scenario, args=(name, args, results))
+    process.start()
+    while True:
+        try:
+            result = results.get(timeout=1)
+            break
+        except queue.Empty:
+            if not process.is_alive():
+                raise RuntimeError(f"Scenario {name} failed with exit code {process.exitcode}")
+    process.join()
+    return result
+
+
+def git_commit() -> str:
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results: list[dict], baseline: dict, tolerance: float) -> list[str]:
+    """Returns a line per metric that regressed by more than tolerance (a fraction) against the baseline."""
+    baseline_stages = {result["stage"]: result for result in baseline["results"]}
+    regressions = []
+    for result in results:
+        previous = baseline_stages.get(result["stage"], {})
+        for metric, higher_is_better in COMPARED_METRICS.items():
+            if metric not in result or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(f"{result['stage']} {metric}: {previous[metric]:.2f} -> {result[metric]:.2f} "
+                                   f"({change:+.0%})")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--scenarios", nargs="+", choices=SCENARIOS, default=list(SCENARIOS))
+    parser.add_argument("--duration", type=float, default=5, help="Seconds per ingest, graphql and pipeline run")
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--fixes", type=int, default=100_000, help="Fixes pre-loaded for publish and process")
+    parser.add_argument("--records-per-message", type=int, default=10)
+    parser.add_argument("--rate", type=float, default=20_000, help="Target fixes per second of the load generator")
+    parser.add_argument("--connections", type=int, default=4)
+    parser.add_argument("--batch-size", type=int, default=100)
+    parser.add_argument("--graphql-concurrency", type=int, default=8)
+    parser.add_argument("--probe-interval-ms", type=float, default=10)
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument("--baseline", help="Compare with the results JSON of an earlier run")
+    parser.add_argument("--tolerance", type=float, default=0.25)
+    args = parser.parse_args()
+
+    results = [run_isolated(name, args) for name in args.scenarios]
+    for result in results:
+        print_table(f"Stage: {result['stage']}", [{key: value for key, value in result.items() if key != "stage"}])
+    report = {"commit": git_commit(), "created_at": datetime.now(timezone.utc).isoformat(),
+              "python": platform.python_version(), "machine": platform.machine(), "cpus": os.cpu_count(),
+              "arguments": {key: value for key, value in vars(args).items() if key not in ("output", "baseline")},
+              "results": results}
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+    if args.baseline:
+        with open(args.baseline) as file:
+            regressions = compare(results, json.load(file), args.tolerance)
+        for regression in regressions:
+            print(f"REGRESSION {regression}")
+        if regressions:
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+"""
+Compares the per-fix ORM write path the processor used to have with the batched bulk writer, on SQLite.
+
+Usage:
+    python -m benchmarks.processor_benchmark --devices 1000 --fixes 20000 --batch-sizes 100 500
+"""
+import argparse
+import datetime
+import os
+import tempfile
+import time
+
+from benchmarks.common import print_table
+from gps_data_processor import GPSDataProcessor
+from src.gps_record import CONTENT_TYPE_RECORDS, RECORD_STRUCT, decode_records
+from src.model import Device, Location, LatestLocation
+
+
+def legacy_save_location(processor: GPSDataProcessor, gps_record: tuple):
+    """The processor's original write path: one session, flush, refresh, merge and commit per fix."""
+    device_id, timestamp, latitude, longitude = gps_record
+    with processor.database_service.session_local() as db:
+        location = Location(device_id=device_id, latitude=latitude, longitude=longitude,
+                            timestamp=datetime.datetime.utcfromtimestamp(timestamp))
+        db.add(location)
+        db.flush()
+        db.refresh(location, attribute_names=["id"])
+        db.merge(LatestLocation(device_id=device_id, latitude=latitude, longitude=longitude,
+                                timestamp=location.timestamp))
+        db.commit()
+
+
+def create_processor(directory: str, name: str, num_devices: int) -> GPSDataProcessor:
+    processor = GPSDataProcessor(f"sqlite:///{os.path.join(directory, name)}.db")
+    with processor.database_service.session_local() as db:
+        db.add_all([Device(name=f"Device {i}") for i in range(1, num_devices + 1)])
+        db.commit()
+    return processor
+
+
+def generate_records(num_devices: int, num_fixes: int) -> bytes:
+    return b"".join(RECORD_STRUCT.pack(i % num_devices + 1, 1723000000 + i, 41.0 + i * 1e-6, 29.0)
+                    for i in range(num_fixes))
+
+
+def run_legacy(directory: str, args, records: bytes) -> dict:
+    processor = create_processor(directory, "legacy", args.devices)
+    gps_records = decode_records(records)[:args.legacy_fixes]
+    started = time.perf_counter()
+    for gps_record in gps_records:
+        legacy_save_location(processor, gps_record)
+    elapsed = time.perf_counter() - started
+    return {"mode": "per-fix ORM", "batch_size": 1, "fixes": len(gps_records), "fixes/s": len(gps_records) / elapsed}
+
+
+def run_batched(directory: str, args, records: bytes, batch_size: int) -> dict:
+    processor = create_processor(directory, f"batched_{batch_size}", args.devices)
+    record_size = RECORD_STRUCT.size
+    # Every queue message carries one publisher batch of records, as the TCP server sends them.
+    messages = [(records[i:i + args.records_per_message * record_size], CONTENT_TYPE_RECORDS)
+                for i in range(0, len(records), args.records_per_message * record_size)]
+    started = time.perf_counter()
+    for i in range(0, len(messages), batch_size):
+        processor.process_gps_batch(messages[i:i + batch_size])
+    elapsed = time.perf_counter() - started
+    return {"mode": "batched", "batch_size": batch_size, "fixes": args.fixes, "fixes/s": args.fixes / elapsed}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--devices", type=int, default=1000)
+    parser.add_argument("--fixes", type=int, default=20000)
+    parser.add_argument("--legacy-fixes", type=int, default=500, help="The per-fix path is slow, run fewer fixes")
+    parser.add_argument("--records-per-message", type=int, default=1)
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 500])
+    cli_args = parser.parse_args()
+
+    gps_data = generate_records(cli_args.devices, cli_args.fixes)
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        results = [run_legacy(tmp_dir, cli_args, gps_data)]
+        results += [run_batched(tmp_dir, cli_args, gps_data, batch_size) for batch_size in cli_args.batch_sizes]
+    baseline = results[0]["fixes/s"]
+    for result in results:
+        result["speedup"] = result["fixes/s"] / baseline
+    print_table("GPSDataProcessor write throughput (SQLite)", results)
@@ -0,0 +1,116 @@
+"""
+Fans location updates out to many concurrent ``locationUpdates`` GraphQL subscriptions in one process.
+
+A background thread publishes batches of updates for random devices into the subscription hub, the way the
+location updates feed does; every subscriber runs the real subscription through the strawberry schema. Most
+subscribers follow a few devices, some a bounding box. Latency is measured from publishing an update to the
+subscriber receiving it and includes the coalescing window.
+
+Usage:
+    python -m benchmarks.subscription_fanout_benchmark --subscribers 5000 --updates-per-second 5000 --duration 10
+"""
+import argparse
+import asyncio
+import random
+import threading
+import time
+from datetime import datetime
+
+from strawberry import Schema
+
+from benchmarks.common import print_table, summarize_latencies
+from src.last_location_cache import CachedLocation
+from src.location_subscriptions import LocationSubscriptionHub
+from src.schema import Mutation, Query, Subscription
+
+DEVICE_QUERY = """
+subscription($ids: [Int!]) {
+    locationUpdates(deviceIds: $ids) { deviceId latitude longitude timestamp }
+}
+"""
+BOX_QUERY = """
+subscription($box: BoundingBoxInput) {
+    locationUpdates(boundingBox: $box) { deviceId latitude longitude timestamp }
+}
+"""
+
+
+def publish_updates(hub: LocationSubscriptionHub, args, stop: threading.Event, published: list):
+    rng = random.Random(2)
+    batch_interval = 0.1
+    per_batch = max(1, int(args.updates_per_second * batch_interval))
+    next_batch = time.perf_counter()
+    while not stop.is_set():
+        now = datetime.utcfromtimestamp(time.time())
+        hub.publish([CachedLocation(rng.randint(1, args.devices), rng.uniform(-60, 60), rng.uniform(-180, 180), now)
+                     for _ in range(per_batch)])
+        published[0] += per_batch
+        next_batch += batch_interval
+        time.sleep(max(0.0, next_batch - time.perf_counter()))
+
+
+async def subscriber(schema: Schema, context: dict, query: str, variables: dict, latencies: list, counters: dict):
+    subscription = await schema.subscribe(query, variable_values=variables, context_value=context)
+    async for result in subscription:
+        received = time.time()
+        locations = result.data["locationUpdates"]
+        counters["messages"] += 1
+        counters["locations"] += len(locations)
+        latencies.extend(received - datetime.fromisoformat(location["timestamp"]).timestamp() for location in locations)
+
+
+async def run(args) -> dict:
+    hub = LocationSubscriptionHub(coalesce_window=args.window_ms / 1000)
+    schema = Schema(query=Query, mutation=Mutation, subscription=Subscription)
+    context = {"location_updates": hub}
+    rng = random.Random(1)
+    latencies = []
+    counters = {"messages": 0, "locations": 0}
+    tasks = []
+    for i in range(args.subscribers):
+        if i < args.subscribers * args.box_ratio:
+            latitude, longitude = rng.uniform(-50, 50), rng.uniform(-170, 170)
+            variables = {"box": {"minLatitude": latitude, "minLongitude": longitude, "maxLatitude": latitude + 5,
+                                 "maxLongitude": longitude + 5}}
+            query = BOX_QUERY
+        else:
+            variables = {"ids": rng.sample(range(1, args.devices + 1), args.devices_per_subscriber)}
+            query = DEVICE_QUERY
+        tasks.append(asyncio.create_task(subscriber(schema, context, query, variables, latencies, counters)))
+    while len(hub) < args.subscribers:
+        await asyncio.sleep(0.01)
+
+    stop = threading.Event()
+    published = [0]
+    publisher = threading.Thread(target=publish_updates, args=(hub, args, stop, published), daemon=True)
+    cpu_started, started = time.process_time(), time.perf_counter()
+    publisher.start()
+    await asyncio.sleep(args.duration)
+    stop.set()
+    elapsed = time.perf_counter() - started
+    cpu = time.process_time() - cpu_started
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+    summary = summarize_latencies(latencies)
+    return {"subscribers": args.subscribers, "updates/s": published[0] / elapsed,
+            "messages/s": counters["messages"] / elapsed, "locations/s": counters["locations"] / elapsed,
+            "cpu_%": cpu / elapsed * 100, "p50_ms": summary["p50_ms"], "p99_ms": summary["p99_ms"]}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--subscribers", type=int, default=5000)
+    parser.add_argument("--devices", type=int, default=10000)
+    parser.add_argument("--devices-per-subscriber", type=int, default=10)
+    parser.add_argument("--box-ratio", type=float, default=0.02)
+    parser.add_argument("--updates-per-second", type=int, default=5000)
+    parser.add_argument("--window-ms", type=float, default=1000)
+    parser.add_argument("--duration", type=float, default=10)
+    args = parser.parse_args()
+    print_table(f"Subscription fan-out, {args.window_ms:.0f} ms coalescing window", [asyncio.run(run(args))])
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Compares the threaded and asyncio TCPServer modes.
+
+Runs each server in a background thread and drives it with concurrent asyncio clients that each open a
+connection, send one GPS fix and wait for the ACK. A number of "stalled" devices connect first and never
+send anything, which is what happens with trackers on a flaky cellular link.
+
+Usage:
+    python -m benchmarks.tcp_server_benchmark --duration 5 --concurrency 200 --stalled 5
+"""
+import argparse
+import asyncio
+import json
+import queue
+import threading
+import time
+
+from benchmarks.common import find_free_port, summarize_latencies, print_table
+from tcp_server import TCP_SERVER_MODES
+
+HOST = "127.0.0.1"
+MESSAGE = json.dumps({"device_id": 1, "timestamp": 1723000000, "latitude": 41.0, "longitude": 29.0}).encode()
+
+
+def drain(output_queue: queue.Queue):
+    while True:
+        output_queue.get()
+
+
+async def send_one(port: int, latencies: list, errors: list):
+    started = time.perf_counter()
+    try:
+        reader, writer = await asyncio.open_connection(HOST, port)
+        writer.write(MESSAGE)
+        await writer.drain()
+        response = await reader.read(16)
+        if response == b"ACK":
+            latencies.append(time.perf_counter() - started)
+        else:
+            errors.append(response)
+        writer.close()
+    except OSError as e:
+        errors.append(e)
+
+
+async def client_worker(port: int, deadline: float, latencies: list, errors: list):
+    while time.perf_counter() < deadline:
+        try:
+            await asyncio.wait_for(send_one(port, latencies, errors), timeout=deadline - time.perf_counter())
+        except asyncio.TimeoutError:
+            break
+
+
+async def drive(port: int, duration: float, concurrency: int, stalled: int):
+    stalled_connections = [await asyncio.open_connection(HOST, port) for _ in range(stalled)]
+    latencies, errors = [], []
+    started = time.perf_counter()
+    deadline = started + duration
+    await asyncio.gather(*(client_worker(port, deadline, latencies, errors) for _ in range(concurrency)))
+    elapsed = time.perf_counter() - started
+    for _, writer in stalled_connections:
+        writer.close()
+    return latencies, errors, elapsed
+
+
+def run_mode(mode: str, args) -> dict:
+    port = find_free_port(HOST)
+    output_queue = queue.Queue()
+    server = TCP_SERVER_MODES[mode](host=HOST, port=port, output_queue=output_queue, backlog=args.backlog,
+                                    read_timeout=args.read_timeout)
+    threading.Thread(target=server.start, daemon=True).start()
+    threading.Thread(target=drain, args=(output_queue,), daemon=True).start()
+    time.sleep(0.2)
+
+    latencies, errors, elapsed = asyncio.run(drive(port, args.duration, args.concurrency, args.stalled))
+    return {"mode": mode, "connections/s": len(latencies) / elapsed, "errors": len(errors),
+            **summarize_latencies(latencies)}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--concurrency", type=int, default=200)
+    parser.add_argument("--stalled", type=int, default=0, help="Idle connections opened before the run")
+    parser.add_argument("--backlog", type=int, default=1024)
+    parser.add_argument("--read-timeout", type=float, default=2.0)
+    parser.add_argument("--modes", nargs="+", default=list(TCP_SERVER_MODES))
+    cli_args = parser.parse_args()
+
+    print_table("TCPServer ingest benchmark", [run_mode(mode, cli_args) for mode in cli_args.modes])
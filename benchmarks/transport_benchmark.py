@@ -0,0 +1,119 @@
+"""
+Compares the transports between the TCP server's publisher and the data processor's listener.
+
+The publisher runs in this process and the listener in a spawned one, as in production; the listener only decodes
+the bodies, so the numbers are the transport's own. Every publish is one body of ``--records-per-publish`` binary
+records whose first record carries the time it was published, and its latency is the time until the listener has
+it in a batch. Each transport is run twice:
+- ``max``: publishing as fast as the transport takes the bodies, for throughput.
+- ``paced``: publishing at ``--rate`` fixes per second, for latency.
+
+The ``rabbitmq`` transport needs a broker at ``--rabbitmq-host``.
+
+Usage:
+    python -m benchmarks.transport_benchmark --transports unix rabbitmq --rabbitmq-host localhost --fixes 1000000
+"""
+import argparse
+import multiprocessing
+import os
+import queue
+import struct
+import tempfile
+import time
+
+from benchmarks.common import print_table, summarize_latencies
+from src.gps_record import RECORD_STRUCT
+from src.service.transport_service import TRANSPORT_RABBITMQ, TRANSPORT_UNIX, create_transport
+
+STAMP = struct.Struct("<d")
+STAMP_OFFSET = 8
+
+
+def create(args, directory: str):
+    return create_transport(args.transport, rabbitmq_host=args.rabbitmq_host, rabbitmq_port=args.rabbitmq_port,
+                            socket_dir=directory, max_in_flight=args.max_in_flight)
+
+
+def listen(args, directory: str, queue_name: str, expected: int, results: multiprocessing.Queue):
+    from gps_data_processor import RabbitMQListener
+    latencies, received = [], [0]
+
+    def process(batch: list):
+        now = time.perf_counter()
+        for body, _ in batch:
+            latencies.append(now - STAMP.unpack_from(body, STAMP_OFFSET)[0])
+            received[0] += len(body) // RECORD_STRUCT.size
+        if received[0] >= expected:
+            results.put(latencies)
+            results.close()
+            results.join_thread()
+            os._exit(0)
+
+    RabbitMQListener(process, args.rabbitmq_host, args.rabbitmq_port, queue_name, batch_size=args.batch_size,
+                     batch_linger_ms=args.linger_ms, transport=create(args, directory)).listen_queue()
+
+
+def run(args, mode: str) -> dict:
+    from src.service.publisher_service import RabbitMQPublisherService
+    rate = args.rate if mode == "paced" else 0
+    fixes = int(args.rate * args.duration) if rate else args.fixes
+    publishes = fixes // args.records_per_publish
+    records = b"".join(RECORD_STRUCT.pack(i + 1, 1723000000, 41.0, 29.0) for i in range(args.records_per_publish))
+    queue_name = f"transport_benchmark_{os.getpid()}_{mode}"
+    with tempfile.TemporaryDirectory() as directory:
+        context = multiprocessing.get_context("spawn")
+        results = context.Queue()
+        listener = context.Process(target=listen, args=(args, directory, queue_name,
+                                                        publishes * args.records_per_publish, results))
+        listener.start()
+        time.sleep(1)
+        publisher = RabbitMQPublisherService(args.rabbitmq_host, args.rabbitmq_port,
+                                             transport=create(args, directory))
+        interval = args.records_per_publish / rate if rate else 0
+        started = next_publish = time.perf_counter()
+        for _ in range(publishes):
+            if interval:
+                next_publish += interval
+                delay = next_publish - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+            now = time.perf_counter()
+            publisher.publish(queue_name, records[:STAMP_OFFSET] + STAMP.pack(now) + records[STAMP_OFFSET + 8:])
+        while True:
+            try:
+                latencies = results.get(timeout=1)
+                break
+            except queue.Empty:
+                if not listener.is_alive():
+                    raise RuntimeError(f"The listener failed with exit code {listener.exitcode}")
+        elapsed = time.perf_counter() - started
+        listener.join()
+        publisher.close()
+    return {"transport": args.transport, "mode": mode, "fixes/s": publishes * args.records_per_publish / elapsed,
+            **summarize_latencies(latencies)}
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--transports", nargs="+", choices=(TRANSPORT_UNIX, TRANSPORT_RABBITMQ),
+                        default=[TRANSPORT_UNIX])
+    parser.add_argument("--rabbitmq-host", default="localhost")
+    parser.add_argument("--rabbitmq-port", type=int, default=5672)
+    parser.add_argument("--fixes", type=int, default=1_000_000, help="Fixes published by the max run")
+    parser.add_argument("--records-per-publish", type=int, default=500)
+    parser.add_argument("--rate", type=float, default=50_000, help="Fixes per second of the paced run")
+    parser.add_argument("--duration", type=float, default=5, help="Seconds of the paced run")
+    parser.add_argument("--batch-size", type=int, default=500, help="Listener batch size in bodies")
+    parser.add_argument("--linger-ms", type=float, default=5, help="Listener batch linger")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="Unacknowledged bodies of the unix transport")
+    args = parser.parse_args()
+
+    rows = []
+    for transport in args.transports:
+        args.transport = transport
+        rows += [run(args, "max"), run(args, "paced")]
+    print_table("Transports", rows)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,18 @@
-LOG_LEVEL = "INFO"
+import os
+
+from dotenv import load_dotenv
+
+load_dotenv()
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO")
+# "json" writes one JSON object per record, "text" the LOGGING_FORMAT lines.
+LOG_FORMAT = os.getenv("LOG_FORMAT", "json")
 TIME_FORMAT = '"%Y-%m-%d %H:%M:%S'
 LOGGING_FORMAT = "%(asctime)s.%(msecs)03d-> %(message)s"
+# Records waiting for the background writer; further records are dropped.
+LOG_QUEUE_SIZE = 10000
+LOGGER_LEVELS = {"pika": "WARNING"}
+# Per-message events: only one in every N is logged, and at most N of them per second.
+LOG_EVENT_SAMPLING = {"device_connected": 1, "fix_received": 1000, "batch_published": 100, "locations_saved": 100,
+                      "fixes_dropped": 100}
+LOG_EVENT_RATE_LIMITS = {"device_connected": 100, "fix_received": 10, "batch_published": 10, "locations_saved": 10,
+                         "fixes_dropped": 10}
@@ -1,3 +1,4 @@
+import asyncio
 import logging
 import os
 import time
@@ -5,8 +6,8 @@ import time
 import requests
 from dotenv import load_dotenv
 
-import config as cfg
-from src.iot_device import IoTDevice, send_gps_data
+from src.load_generator import LoadGenerator
+from src.structured_logging import configure_logging
 from tests.create_devices import create_devices
 
 load_dotenv()
@@ -15,6 +16,13 @@ tcp_server_port = int(os.getenv("TCP_SERVER_PORT", "65432"))
 webserver_url = os.getenv("WEBSERVER_URL", "http://localhost:8081")
 num_devices = int(os.getenv("NUM_DEVICES_TO_CREATE", 100))
 generation_interval = int(os.getenv("DATA_GENERATION_INTERVAL_PER_DEVICE", 10))
+device_data_format = os.getenv("DEVICE_DATA_FORMAT", "JSON").encode()
+target_rate = float(os.getenv("GENERATOR_TARGET_RATE", "0"))
+connections = int(os.getenv("GENERATOR_CONNECTIONS", "4"))
+batch_size = int(os.getenv("GENERATOR_BATCH_SIZE", "500"))
+report_interval = float(os.getenv("GENERATOR_REPORT_INTERVAL", "10"))
+device_refresh_interval = float(os.getenv("GENERATOR_DEVICE_REFRESH_INTERVAL", "60"))
+generator_duration = float(os.getenv("GENERATOR_DURATION", "0"))
 
 session = requests.Session()
 logger = logging.getLogger(__name__)
@@ -26,7 +34,6 @@ def get_devices(server_url):
     query {
       allDevices {
         id
-        name
       }
     }
     """
@@ -40,53 +47,45 @@ def get_devices(server_url):
     return devices
 
 
-class DeviceStorer:
-    def __init__(self, device_ids: list[int]):
-        self.devices = {device_id: IoTDevice(device_id) for device_id in device_ids}
-
-    def get_devices_gps_data(self):
-        return {device_id: self.devices[device_id].generate_gps_data() for device_id in self.devices}
-
-    def update_devices(self, device_ids: list[int]):
-        removed_devices = self.devices.keys() - device_ids
-        for k in removed_devices:
-            self.devices.pop(k, None)
-        new_devices = device_ids - self.devices.keys()
-        for device_id in new_devices:
-            self.devices[device_id] = IoTDevice(device_id)
-
-    def move_devices(self):
-        [device.move() for device in self.devices.values()]
+async def refresh_devices_forever(load_generator: LoadGenerator, interval: float):
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            devices = await asyncio.to_thread(get_devices, webserver_url)
+            load_generator.set_devices([device["id"] for device in devices])
+        except Exception:
+            logger.exception("Error occurred while refreshing devices:")
 
 
-def send_data_to_tcp_server(device_storer: DeviceStorer):
-    devices = get_devices(webserver_url)
-    logger.info(f"Number of devices: {len(devices)}")
-    device_ids = [device["id"] for device in devices]
-    device_storer.update_devices(device_ids)
-    device_storer.move_devices()
-    gps_data = device_storer.get_devices_gps_data()
-    for gps in gps_data.values():
-        send_gps_data(gps)
+async def run(load_generator: LoadGenerator) -> dict:
+    tasks = [asyncio.create_task(load_generator.report_forever(report_interval))]
+    if device_refresh_interval > 0:
+        tasks.append(asyncio.create_task(refresh_devices_forever(load_generator, device_refresh_interval)))
+    try:
+        return await load_generator.run(generator_duration or None)
+    finally:
+        for task in tasks:
+            task.cancel()
 
 
 if __name__ == '__main__':
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
-    current_device_storer = DeviceStorer(device_ids=[])
+    configure_logging()
     while True:
         try:
             create_devices(webserver_url, num_devices)
+            device_ids = [device["id"] for device in get_devices(webserver_url)]
             break
         except Exception as e:
             logger.error(f"Couldn't create devices will try again: {e}")
             time.sleep(2)
 
-    while True:
-        try:
-            send_data_to_tcp_server(current_device_storer)
-        except (KeyboardInterrupt, InterruptedError):
-            logger.info('Terminating data generator...')
-            break
-        except Exception as err:
-            logger.exception(err)
-        time.sleep(generation_interval)
+    rate = target_rate or len(device_ids) / generation_interval
+    logger.info(f"Simulating {len(device_ids)} devices at {rate:.0f} fixes/s over {connections} connections")
+    generator = LoadGenerator(tcp_server_host, tcp_server_port, device_ids, rate=rate, connections=connections,
+                              batch_size=batch_size, data_format=device_data_format)
+    try:
+        summary = asyncio.run(run(generator))
+        logger.info("Run summary: " + " ".join(f"{key}={value:.1f}" if isinstance(value, float)
+                                               else f"{key}={value}" for key, value in summary.items()))
+    except (KeyboardInterrupt, InterruptedError):
+        logger.info('Terminating data generator...')
@@ -1,75 +1,188 @@
 import datetime
-import json
 import logging
+import multiprocessing
 import os
 import time
 
-import pika
 from dotenv import load_dotenv
 from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
-import config as cfg
+from src.device_registry import DeviceRegistry
+from src.gps_record import decode_message
+from src.location_store import LOCATION_STORE_COLUMNAR, LOCATION_STORE_SQL, ColumnarLocationStore
+from src.metrics import Counter, Histogram, start_metrics_server
+from src.partitioning import partition_queue_name
 from src.service.database_service import connect_to_db
-from src.model import Location, LatestLocation
+from src.service.device_registry_service import DeviceRegistrySync
+from src.service.publisher_service import LocationUpdatePublisher
+from src.service.storage_lifecycle_service import LocationStorageLifecycle, LocationStoreLifecycle
+from src.service.transport_service import TRANSPORT_RABBITMQ, RabbitMQTransport, Transport, create_transport
+from src.sql_query import get_existing_device_ids, insert_locations, newest_location_per_device, \
+    upsert_latest_locations
+from src.structured_logging import EventLogger, configure_logging
 
 load_dotenv()
 logger = logging.getLogger(__name__)
+saved_log = EventLogger(logger, "locations_saved")
+dropped_log = EventLogger(logger, "fixes_dropped")
 db_url = os.getenv("DATABASE_URL")
 rabbitmq_host = os.getenv("RABBITMQ_HOST")
 rabbitmq_port = os.getenv("RABBITMQ_PORT")
 rabbitmq_gps_queue = os.getenv("RABBITMQ_GPS_QUEUE")
+rabbitmq_gps_partitions = int(os.getenv("RABBITMQ_GPS_PARTITIONS", "1"))
+rabbitmq_device_events_exchange = os.getenv("RABBITMQ_DEVICE_EVENTS_EXCHANGE", "device_events")
+rabbitmq_location_updates_exchange = os.getenv("RABBITMQ_LOCATION_UPDATES_EXCHANGE", "location_updates")
+device_registry_enabled = os.getenv("DEVICE_REGISTRY_ENABLED", "true").lower() == "true"
+device_registry_resync_interval = float(os.getenv("DEVICE_REGISTRY_RESYNC_INTERVAL", "300"))
+processor_batch_size = int(os.getenv("PROCESSOR_BATCH_SIZE", "500"))
+processor_batch_linger_ms = float(os.getenv("PROCESSOR_BATCH_LINGER_MS", "50"))
+processor_prefetch_count = int(os.getenv("PROCESSOR_PREFETCH_COUNT", "1000"))
+location_storage_lifecycle_enabled = os.getenv("LOCATION_STORAGE_LIFECYCLE_ENABLED", "true").lower() == "true"
+location_storage_lifecycle_interval = float(os.getenv("LOCATION_STORAGE_LIFECYCLE_INTERVAL", "3600"))
+location_raw_retention_days = int(os.getenv("LOCATION_RAW_RETENTION_DAYS", "0"))
+location_rollup_retention_days = int(os.getenv("LOCATION_ROLLUP_RETENTION_DAYS", "0"))
+location_rollup_delay = float(os.getenv("LOCATION_ROLLUP_DELAY", "7200"))
+location_partitions_ahead = int(os.getenv("LOCATION_PARTITIONS_AHEAD", "7"))
+processor_metrics_port = int(os.getenv("PROCESSOR_METRICS_PORT", "9101"))
+gps_transport = os.getenv("GPS_TRANSPORT", TRANSPORT_RABBITMQ)
+gps_transport_socket_dir = os.getenv("GPS_TRANSPORT_SOCKET_DIR", "gps_transport")
+location_store_backend = os.getenv("LOCATION_STORE", LOCATION_STORE_SQL)
+location_store_dir = os.getenv("LOCATION_STORE_DIR", "location_store")
+location_store_sync = os.getenv("LOCATION_STORE_SYNC", "false").lower() == "true"
+
+MESSAGES_CONSUMED = Counter("processor_messages_consumed_total", "Messages consumed from the GPS queue.")
+BATCH_SECONDS = Histogram("processor_batch_seconds", "Time to process and acknowledge a batch of messages.")
+BATCH_FAILURES = Counter("processor_batch_failures_total", "Batches that failed and were requeued.")
+FIXES_SAVED = Counter("processor_fixes_saved_total", "Fixes stored in the database.")
+DB_WRITE_SECONDS = Histogram("processor_db_write_seconds", "Time to insert a batch of fixes before the commit.")
+DB_COMMIT_SECONDS = Histogram("processor_db_commit_seconds", "Time to commit a batch of fixes.")
+STORE_APPEND_SECONDS = Histogram("processor_store_append_seconds",
+                                 "Time to append a batch of fixes to the columnar location store.")
 
 
 class GPSDataProcessor:
-    def __init__(self, database_url):
+    """
+    Stores fixes in ``locations`` and ``latest_locations``; with a ``location_store``, the raw fixes are appended
+    to the columnar store instead of ``locations``, after ``latest_locations`` was committed.
+    """
+
+    def __init__(self, database_url, device_registry: DeviceRegistry = None,
+                 location_updates: LocationUpdatePublisher = None, location_store: ColumnarLocationStore = None):
         self.database_service = connect_to_db(database_url)
+        self.device_registry = device_registry
+        self.location_updates = location_updates
+        self.location_store = location_store
 
-    def process_gps_data(self, message_body):
-        try:
-            message_data = json.loads(message_body)
-            device_id = message_data["device_id"]
-            latitude = message_data["latitude"]
-            longitude = message_data["longitude"]
-            timestamp = message_data["timestamp"]
-            timestamp = datetime.datetime.utcfromtimestamp(timestamp)
-
-            db = next(self.database_service.get_db())
-            location = Location(device_id=device_id, latitude=latitude, longitude=longitude, timestamp=timestamp)
-            db.add(location)
-            db.flush()
-            db.refresh(location, attribute_names=["id"])
-            latest_location = LatestLocation(device_id=device_id, location_id=location.id)
-            db.merge(latest_location)
-            db.commit()
-            logger.info(f"Location data for device #{device_id} is saved successfully!")
-        except IntegrityError as e:
-            logger.info(f"Device is not registered!: {message_body}")
-            logger.debug(e.args)
-        except Exception as e:
-            logger.exception(f"Error processing GPS data: {e}\nBody: {message_body}")
+    def process_gps_data(self, message_body, content_type=None):
+        self.process_gps_batch([(message_body, content_type)])
+
+    def process_gps_batch(self, messages: list[tuple[bytes, str]]):
+        """
+        Decodes a batch of queue messages and stores all of their fixes in a single transaction.
+
+        Messages that can't be decoded are logged and skipped. Database errors are raised so the caller can
+        leave the batch unacknowledged.
+        """
+        gps_records = []
+        for message_body, content_type in messages:
+            try:
+                gps_records.extend(decode_message(message_body, content_type))
+            except Exception as e:
+                logger.exception("Error decoding GPS data: %s\nBody: %r", e, message_body)
+        if self.device_registry is not None:
+            decoded = len(gps_records)
+            gps_records = self.device_registry.filter_fixes(gps_records)
+            if len(gps_records) < decoded:
+                dropped_log.info("Dropped %d fixes of unregistered devices (%d in total)", decoded - len(gps_records),
+                                 self.device_registry.rejected)
+        if gps_records:
+            self.save_locations(gps_records)
+
+    def save_locations(self, gps_records: list[tuple]):
+        rows = [{"device_id": device_id, "latitude": latitude, "longitude": longitude,
+                 "timestamp": datetime.datetime.utcfromtimestamp(timestamp)}
+                for device_id, timestamp, latitude, longitude in gps_records]
+        with self.database_service.session_local() as db:
+            try:
+                self._write_locations(rows, db)
+            except IntegrityError as e:
+                db.rollback()
+                known_device_ids = get_existing_device_ids((row["device_id"] for row in rows), db)
+                registered_rows = [row for row in rows if row["device_id"] in known_device_ids]
+                dropped_log.info("Dropped %d fixes of unregistered devices", len(rows) - len(registered_rows))
+                logger.debug(e.args)
+                if registered_rows:
+                    self._write_locations(registered_rows, db)
+                rows = registered_rows
+                gps_records = [record for record in gps_records if record[0] in known_device_ids]
+        if self.location_store is not None:
+            started = time.perf_counter()
+            self.location_store.append_records(gps_records)
+            STORE_APPEND_SECONDS.observe(time.perf_counter() - started)
+        FIXES_SAVED.inc(len(rows))
+        saved_log.info("Location data of %d fixes is saved successfully!", len(rows))
+        if self.location_updates is not None and rows:
+            self.location_updates.locations_saved(newest_location_per_device(rows))
+
+    def _write_locations(self, rows: list[dict], db: Session):
+        started = time.perf_counter()
+        if self.location_store is None:
+            insert_locations(rows, db)
+        upsert_latest_locations(rows, db)
+        written = time.perf_counter()
+        db.commit()
+        DB_WRITE_SECONDS.observe(written - started)
+        DB_COMMIT_SECONDS.observe(time.perf_counter() - written)
 
 
 class RabbitMQListener:
-    def __init__(self, process_method, host, port, queue_name):
+    """
+    Consumes the GPS queue in batches with manual acknowledgements, from RabbitMQ unless another transport is given.
+
+    Up to ``batch_size`` messages are collected, waiting at most ``batch_linger_ms`` after the first one, and
+    handed to ``process_method`` together. The whole batch is acknowledged only after ``process_method``
+    returns, so messages of a batch that failed are redelivered.
+    """
+
+    def __init__(self, process_method, host, port, queue_name, batch_size: int = processor_batch_size,
+                 batch_linger_ms: float = processor_batch_linger_ms, prefetch_count: int = processor_prefetch_count,
+                 transport: Transport = None):
         self.process_method = process_method
-        self.rabbitmq_host = host
-        self.rabbitmq_port = port
+        self.transport = transport or RabbitMQTransport(host, port)
         self.rabbitmq_queue = queue_name
+        self.batch_size = batch_size
+        self.batch_linger = batch_linger_ms / 1000
+        self.prefetch_count = max(prefetch_count, batch_size)
 
-    def queue_callback(self, ch, method, properties, body):
+    def process_batch(self, transport: Transport, batch: list, last_delivery_tag: int):
+        started = time.perf_counter()
         try:
-            self.process_method(body)
+            self.process_method(batch)
         except Exception:
-            logger.exception(f"Error: unable to process queue message: {body}")
+            BATCH_FAILURES.inc()
+            logger.exception(f"Error: unable to process a batch of {len(batch)} queue messages, requeueing")
+            transport.nack(last_delivery_tag)
+            time.sleep(1)
+            return
+        transport.ack(last_delivery_tag)
+        BATCH_SECONDS.observe(time.perf_counter() - started)
 
     def listen_queue(self):
-        connection = pika.BlockingConnection(
-            pika.ConnectionParameters(host=self.rabbitmq_host, port=self.rabbitmq_port))
-        channel = connection.channel()
-        channel.queue_declare(queue=self.rabbitmq_queue)
-        channel.basic_consume(queue=self.rabbitmq_queue, auto_ack=True, on_message_callback=self.queue_callback)
         logger.info(f' [*] Waiting for messages on queue {self.rabbitmq_queue}.')
-        channel.start_consuming()
+        batch = []
+        deadline = last_delivery_tag = None
+        for delivery in self.transport.consume(self.rabbitmq_queue, self.prefetch_count,
+                                               inactivity_timeout=self.batch_linger):
+            if delivery is not None:
+                MESSAGES_CONSUMED.inc()
+                if not batch:
+                    deadline = time.monotonic() + self.batch_linger
+                batch.append((delivery.body, delivery.content_type))
+                last_delivery_tag = delivery.delivery_tag
+            if batch and (len(batch) >= self.batch_size or delivery is None or time.monotonic() >= deadline):
+                self.process_batch(self.transport, batch, last_delivery_tag)
+                batch = []
 
     def start(self):
         while True:
@@ -83,11 +196,118 @@ class RabbitMQListener:
                 logger.exception("Error occurred while listening to the queue:")
 
 
+def run_worker(partition: int, partitions: int):
+    if processor_metrics_port:
+        # Every partition's worker is a process of its own and serves its metrics on the next port.
+        start_metrics_server(processor_metrics_port + partition)
+    # Device events and location updates are announced on fanout exchanges, which need a broker.
+    device_registry = DeviceRegistry() if device_registry_enabled and rabbitmq_host else None
+    location_updates = LocationUpdatePublisher(rabbitmq_location_updates_exchange, rabbitmq_host=rabbitmq_host,
+                                               rabbitmq_port=rabbitmq_port) if rabbitmq_host else None
+    location_store = None
+    if location_store_backend == LOCATION_STORE_COLUMNAR:
+        location_store = ColumnarLocationStore(location_store_dir, sync=location_store_sync, partition=partition,
+                                               partitions=partitions)
+        # Also removes the segments of deleted devices, so it runs even when expiry is disabled.
+        retention_days = location_raw_retention_days if location_storage_lifecycle_enabled else 0
+        LocationStoreLifecycle(location_store, raw_retention_days=retention_days,
+                               interval=location_storage_lifecycle_interval).start()
+    gps_processor = GPSDataProcessor(db_url, device_registry=device_registry, location_updates=location_updates,
+                                     location_store=location_store)
+    if device_registry is not None:
+        DeviceRegistrySync(device_registry, gps_processor.database_service, rabbitmq_host, rabbitmq_port,
+                           exchange=rabbitmq_device_events_exchange,
+                           resync_interval=device_registry_resync_interval).start()
+    transport = create_transport(gps_transport, rabbitmq_host=rabbitmq_host, rabbitmq_port=rabbitmq_port,
+                                 socket_dir=gps_transport_socket_dir)
+    queue_listener = RabbitMQListener(process_method=gps_processor.process_gps_batch, host=rabbitmq_host,
+                                      port=rabbitmq_port,
+                                      queue_name=partition_queue_name(rabbitmq_gps_queue, partition, partitions),
+                                      transport=transport)
+    queue_listener.start()
+
+
+def run_supervised_worker(partition: int, partitions: int):
+    configure_logging(worker=partition)
+    run_worker(partition, partitions)
+
+
+class ProcessorSupervisor:
+    """
+    Runs one worker process per GPS queue partition and restarts workers that exit.
+
+    Workers that die within ``min_uptime`` seconds of being started are restarted with an exponential backoff
+    capped at ``max_backoff`` seconds, so a worker that can't start doesn't spin.
+    """
+
+    def __init__(self, partitions: int, worker_target=run_supervised_worker, min_uptime: float = 10,
+                 max_backoff: float = 30, check_interval: float = 1):
+        self.partitions = partitions
+        self.worker_target = worker_target
+        self.min_uptime = min_uptime
+        self.max_backoff = max_backoff
+        self.check_interval = check_interval
+        self.context = multiprocessing.get_context("spawn")
+        self.workers = {}
+        self.started_at = {}
+        self.backoff = {}
+        self.restart_at = {}
+
+    def start_worker(self, partition: int):
+        worker = self.context.Process(target=self.worker_target, args=(partition, self.partitions),
+                                      name=f"gps-worker-{partition}", daemon=True)
+        worker.start()
+        self.workers[partition] = worker
+        self.started_at[partition] = time.monotonic()
+        logger.info(f"Started worker for partition {partition} (pid {worker.pid})")
+
+    def check_workers(self):
+        now = time.monotonic()
+        for partition, worker in self.workers.items():
+            if worker.is_alive() or partition in self.restart_at:
+                continue
+            if now - self.started_at[partition] < self.min_uptime:
+                self.backoff[partition] = min(self.max_backoff, self.backoff.get(partition, 0.5) * 2)
+                delay = self.backoff[partition]
+            else:
+                self.backoff.pop(partition, None)
+                delay = 0
+            logger.error(f"Worker for partition {partition} exited with code {worker.exitcode}, "
+                         f"restarting in {delay}s")
+            self.restart_at[partition] = now + delay
+        for partition, restart_at in list(self.restart_at.items()):
+            if now >= restart_at:
+                del self.restart_at[partition]
+                self.start_worker(partition)
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.terminate()
+        for worker in self.workers.values():
+            worker.join()
+
+    def run(self):
+        for partition in range(self.partitions):
+            self.start_worker(partition)
+        try:
+            while True:
+                time.sleep(self.check_interval)
+                self.check_workers()
+        except (KeyboardInterrupt, InterruptedError):
+            logger.info('Terminating workers...')
+        finally:
+            self.stop()
+
+
 if __name__ == '__main__':
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL),
-                        format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
+    configure_logging()
 
-    gps_processor = GPSDataProcessor(db_url)
-    queue_listener = RabbitMQListener(process_method=gps_processor.process_gps_data, host=rabbitmq_host,
-                                      port=rabbitmq_port, queue_name=rabbitmq_gps_queue)
-    queue_listener.start()
+    if location_storage_lifecycle_enabled:
+        LocationStorageLifecycle(connect_to_db(db_url), raw_retention_days=location_raw_retention_days,
+                                 rollup_retention_days=location_rollup_retention_days,
+                                 partitions_ahead=location_partitions_ahead, rollup_delay=location_rollup_delay,
+                                 interval=location_storage_lifecycle_interval).start()
+    if rabbitmq_gps_partitions == 1:
+        run_worker(0, 1)
+    else:
+        ProcessorSupervisor(partitions=rabbitmq_gps_partitions).run()
@@ -1,25 +1,81 @@
+import logging
 import os
+from datetime import datetime
+from typing import Annotated, List, Optional
 
 import uvicorn
 from dotenv import load_dotenv
-from fastapi import FastAPI, Depends
-from sqlalchemy.orm import Session
+from fastapi import FastAPI, Depends, HTTPException, Query as QueryParameter
+from fastapi.responses import PlainTextResponse, StreamingResponse
+from sqlalchemy.ext.asyncio import AsyncSession
 from strawberry import Schema
 from strawberry.fastapi import GraphQLRouter
 
-from src.schema import Query, Mutation
+from src.last_location_cache import LastLocationCache
+from src.location_export import FORMAT_CSV, FORMAT_NDJSON, MEDIA_TYPES, encode_export
+from src.location_store import LOCATION_STORE_COLUMNAR, LOCATION_STORE_SQL, ColumnarLocationStore
+from src.location_subscriptions import LocationSubscriptionHub
+from src.metrics import CONTENT_TYPE, render
+from src.schema import Query, Mutation, Subscription, ResolverMetrics
 from src.service.database_service import connect_to_db
+from src.service.last_location_cache_service import LastLocationCacheSync
+from src.service.publisher_service import DeviceEventPublisher
+from src.sql_query import stream_locations_async
+from src.structured_logging import configure_logging
 
 load_dotenv()
+configure_logging()
+# uvicorn's records go through the root logger's queue instead of uvicorn's own synchronous handlers.
+for uvicorn_logger in ("uvicorn", "uvicorn.access"):
+    logging.getLogger(uvicorn_logger).handlers.clear()
+    logging.getLogger(uvicorn_logger).propagate = True
 
 app = FastAPI()
 database_url = os.getenv("DATABASE_URL")
-database_service = connect_to_db(database_url)
-schema = Schema(query=Query, mutation=Mutation)
+rabbitmq_host = os.getenv("RABBITMQ_HOST")
+rabbitmq_port = os.getenv("RABBITMQ_PORT")
+rabbitmq_device_events_exchange = os.getenv("RABBITMQ_DEVICE_EVENTS_EXCHANGE", "device_events")
+rabbitmq_location_updates_exchange = os.getenv("RABBITMQ_LOCATION_UPDATES_EXCHANGE", "location_updates")
+last_location_cache_enabled = os.getenv("LAST_LOCATION_CACHE_ENABLED", "true").lower() == "true"
+last_location_cache_max_staleness = float(os.getenv("LAST_LOCATION_CACHE_MAX_STALENESS", "5"))
+last_location_cache_reload_interval = float(os.getenv("LAST_LOCATION_CACHE_RELOAD_INTERVAL", "300"))
+location_subscription_coalesce_ms = float(os.getenv("LOCATION_SUBSCRIPTION_COALESCE_MS", "1000"))
+export_chunk_size = int(os.getenv("EXPORT_CHUNK_SIZE", "1000"))
+location_raw_retention_days = int(os.getenv("LOCATION_RAW_RETENTION_DAYS", "0"))
+location_store_backend = os.getenv("LOCATION_STORE", LOCATION_STORE_SQL)
+location_store_dir = os.getenv("LOCATION_STORE_DIR", "location_store")
+database_pool_size = int(os.getenv("DATABASE_POOL_SIZE", "10"))
+database_max_overflow = int(os.getenv("DATABASE_MAX_OVERFLOW", "10"))
+database_pool_timeout = float(os.getenv("DATABASE_POOL_TIMEOUT", "10"))
+database_connect_timeout = float(os.getenv("DATABASE_CONNECT_TIMEOUT", "10"))
+database_service = connect_to_db(database_url, use_async=True, pool_size=database_pool_size,
+                                 max_overflow=database_max_overflow, pool_timeout=database_pool_timeout,
+                                 connect_timeout=database_connect_timeout)
+device_event_publisher = DeviceEventPublisher(rabbitmq_device_events_exchange, rabbitmq_host=rabbitmq_host,
+                                              rabbitmq_port=rabbitmq_port) if rabbitmq_host else None
+# Raw fixes are read from the data processor's columnar store instead of the locations table.
+location_store = ColumnarLocationStore(location_store_dir, read_only=True,
+                                       retention_days=location_raw_retention_days) \
+    if location_store_backend == LOCATION_STORE_COLUMNAR else None
+last_location_cache = None
+location_subscription_hub = None
+if rabbitmq_host:
+    # The location updates feed keeps the cache fresh and drives the subscriptions.
+    last_location_cache = LastLocationCache(max_staleness=last_location_cache_max_staleness)
+    location_subscription_hub = LocationSubscriptionHub(coalesce_window=location_subscription_coalesce_ms / 1000)
+    LastLocationCacheSync(last_location_cache, database_service, rabbitmq_host, rabbitmq_port,
+                          exchange=rabbitmq_location_updates_exchange,
+                          device_events_exchange=rabbitmq_device_events_exchange,
+                          reload_interval=last_location_cache_reload_interval,
+                          listeners=[location_subscription_hub.publish]).start()
+schema = Schema(query=Query, mutation=Mutation, subscription=Subscription, extensions=[ResolverMetrics])
 
 
-async def get_context(db: Session = Depends(database_service.get_db)):
-    return {"db": db}
+async def get_context(db: AsyncSession = Depends(database_service.get_async_db)):
+    return {"db": db, "device_events": device_event_publisher,
+            "last_locations": last_location_cache if last_location_cache_enabled else None,
+            "location_updates": location_subscription_hub, "raw_retention_days": location_raw_retention_days,
+            "location_store": location_store}
 
 
 graphql_app = GraphQLRouter(schema, context_getter=get_context)
@@ -31,5 +87,35 @@ def read_root():
     return {"Hello": "World"}
 
 
+@app.get("/metrics", response_class=PlainTextResponse)
+def metrics():
+    return PlainTextResponse(render(), media_type=CONTENT_TYPE)
+
+
+@app.get("/export/locations")
+async def export_locations(
+        device_id: Annotated[List[int], QueryParameter()],
+        from_: Annotated[Optional[datetime], QueryParameter(alias="from")] = None,
+        to: Optional[datetime] = None,
+        format: str = FORMAT_NDJSON,
+        gzip: bool = False,
+):
+    """Streams the locations of the given devices within [from, to) ordered by device and time."""
+    if format not in MEDIA_TYPES:
+        raise HTTPException(status_code=400, detail=f"format must be one of {', '.join(MEDIA_TYPES)}")
+
+    async def chunks():
+        # The session has to outlive the endpoint, so it's opened by the response body rather than a dependency.
+        async with database_service.async_session_local() as db:
+            async for rows in stream_locations_async(device_id, db, start=from_, end=to, chunk_size=export_chunk_size,
+                                                     store=location_store):
+                yield rows
+
+    filename = f"locations.{'csv' if format == FORMAT_CSV else 'ndjson'}{'.gz' if gzip else ''}"
+    return StreamingResponse(encode_export(chunks(), format, compress=gzip),
+                             media_type="application/gzip" if gzip else MEDIA_TYPES[format],
+                             headers={"Content-Disposition": f'attachment; filename="{filename}"'})
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8081)
+    uvicorn.run(app, host="0.0.0.0", port=8081, log_config=None)
@@ -0,0 +1,57 @@
+"""
+Per-request DataLoaders of the nested GraphQL fields.
+
+Every loader collects the keys requested by all resolvers of one field level and loads them with a single
+``IN (...)`` query, so nested fields cost a constant number of statements however many objects they are
+resolved for. Loaders are created lazily once per request context and share its session; the lock keeps
+loaders of sibling fields from using the session concurrently.
+"""
+import asyncio
+from collections import defaultdict
+
+from sqlalchemy.ext.asyncio import AsyncSession
+from strawberry.dataloader import DataLoader
+
+from src.location_store import ColumnarLocationStore
+from src.sql_query import get_devices_by_ids_async, get_last_locations_by_devices_async, \
+    get_recent_locations_by_devices_async
+
+
+class Loaders:
+    def __init__(self, db: AsyncSession, location_store: ColumnarLocationStore = None):
+        self.db = db
+        self.location_store = location_store
+        self.lock = asyncio.Lock()
+        self.device = DataLoader(load_fn=self.load_devices)
+        self.last_location = DataLoader(load_fn=self.load_last_locations)
+        self.recent_locations = DataLoader(load_fn=self.load_recent_locations)
+
+    async def load_devices(self, device_ids: list[int]) -> list:
+        async with self.lock:
+            devices = {device.id: device for device in await get_devices_by_ids_async(device_ids, self.db)}
+        return [devices.get(device_id) for device_id in device_ids]
+
+    async def load_last_locations(self, device_ids: list[int]) -> list:
+        async with self.lock:
+            locations = {location.device_id: location
+                         for location in await get_last_locations_by_devices_async(device_ids, self.db)}
+        return [locations.get(device_id) for device_id in device_ids]
+
+    async def load_recent_locations(self, keys: list[tuple[int, int]]) -> list[list]:
+        """Loads (device_id, limit) keys with one query per distinct limit."""
+        device_ids_by_limit = defaultdict(list)
+        for device_id, limit in keys:
+            device_ids_by_limit[limit].append(device_id)
+        locations = defaultdict(list)
+        async with self.lock:
+            for limit, device_ids in device_ids_by_limit.items():
+                for location in await get_recent_locations_by_devices_async(device_ids, limit, self.db,
+                                                                            self.location_store):
+                    locations[location.device_id, limit].append(location)
+        return [locations[key] for key in keys]
+
+
+def get_loaders(context: dict) -> Loaders:
+    if "loaders" not in context:
+        context["loaders"] = Loaders(context["db"], context.get("location_store"))
+    return context["loaders"]
@@ -0,0 +1,95 @@
+import threading
+
+from src.gps_record import RECORD_SIZE
+
+
+class DeviceRegistry:
+    """
+    In-memory set of registered device ids, stored as a bitmap indexed by id.
+
+    Device ids are auto-increment integers, so a million devices fit in about 125 KB. Membership checks are
+    lock-free reads; updates and full resyncs are serialized. Events that arrive while a resync is loading ids
+    from the database are replayed on top of the fresh snapshot, so they are not lost to the swap.
+    """
+
+    def __init__(self, device_ids=()):
+        self.bitmap = self._build(device_ids)
+        self.lock = threading.Lock()
+        self.resync_lock = threading.Lock()
+        self.events_during_resync = None
+        self.rejected = 0
+
+    @staticmethod
+    def _build(device_ids) -> bytearray:
+        device_ids = list(device_ids)
+        bitmap = bytearray(max(device_ids, default=0) // 8 + 1)
+        for device_id in device_ids:
+            bitmap[device_id >> 3] |= 1 << (device_id & 7)
+        return bitmap
+
+    def __contains__(self, device_id: int) -> bool:
+        bitmap = self.bitmap
+        index = device_id >> 3
+        return 0 <= index < len(bitmap) and bool(bitmap[index] & (1 << (device_id & 7)))
+
+    def __len__(self) -> int:
+        return sum(bin(byte).count("1") for byte in self.bitmap)
+
+    def _set(self, bitmap: bytearray, device_id: int, registered: bool) -> bytearray:
+        if registered:
+            if device_id >> 3 >= len(bitmap):
+                bitmap = bitmap + bytearray((device_id >> 3) - len(bitmap) + 1)
+            bitmap[device_id >> 3] |= 1 << (device_id & 7)
+        elif device_id >> 3 < len(bitmap):
+            bitmap[device_id >> 3] &= ~(1 << (device_id & 7)) & 0xFF
+        return bitmap
+
+    def add(self, device_id: int):
+        self.apply(device_id, True)
+
+    def discard(self, device_id: int):
+        self.apply(device_id, False)
+
+    def apply(self, device_id: int, registered: bool):
+        with self.lock:
+            self.bitmap = self._set(self.bitmap, device_id, registered)
+            if self.events_during_resync is not None:
+                self.events_during_resync.append((device_id, registered))
+
+    def resync(self, load_device_ids) -> list[int]:
+        """
+        Replaces the registry with the ids returned by load_device_ids, keeping the events applied meanwhile.
+
+        Resyncs run one at a time, so one can't drop the events recorded for another.
+        """
+        with self.resync_lock:
+            self.begin_resync()
+            device_ids = load_device_ids()
+            self.finish_resync(device_ids)
+            return device_ids
+
+    def begin_resync(self):
+        """Starts recording events; call before reading the device ids from the database."""
+        with self.lock:
+            self.events_during_resync = []
+
+    def finish_resync(self, device_ids):
+        bitmap = self._build(device_ids)
+        with self.lock:
+            for device_id, registered in self.events_during_resync or ():
+                bitmap = self._set(bitmap, device_id, registered)
+            self.bitmap = bitmap
+            self.events_during_resync = None
+
+    def filter_fixes(self, gps_records: list[tuple]) -> list[tuple]:
+        """Returns the (device_id, timestamp, latitude, longitude) tuples of registered devices."""
+        registered = [gps_record for gps_record in gps_records if gps_record[0] in self]
+        self.rejected += len(gps_records) - len(registered)
+        return registered
+
+    def filter_records(self, records: bytes) -> bytes:
+        """Returns the binary records of registered devices, see src.gps_record."""
+        registered = [records[offset:offset + RECORD_SIZE] for offset in range(0, len(records), RECORD_SIZE)
+                      if int.from_bytes(records[offset:offset + 4], "little") in self]
+        self.rejected += len(records) // RECORD_SIZE - len(registered)
+        return b"".join(registered)
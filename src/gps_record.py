@@ -0,0 +1,40 @@
+"""
+Fixed-width binary encoding of a GPS fix.
+
+A record is 24 bytes, little-endian: ``device_id`` (uint32), ``timestamp`` (uint32, unix seconds),
+``latitude`` (float64) and ``longitude`` (float64). Records are concatenated back to back, so a batch of N
+fixes is exactly ``N * RECORD_SIZE`` bytes and can travel through the TCP server and RabbitMQ untouched.
+"""
+import json
+import struct
+
+RECORD_STRUCT = struct.Struct("<IIdd")
+RECORD_SIZE = RECORD_STRUCT.size
+CONTENT_TYPE_JSON = "application/json"
+CONTENT_TYPE_RECORDS = "application/x-gps-records"
+
+
+def encode_record(gps_data: dict) -> bytes:
+    return RECORD_STRUCT.pack(gps_data["device_id"], gps_data["timestamp"], gps_data["latitude"],
+                              gps_data["longitude"])
+
+
+def decode_records(body: bytes) -> list[tuple]:
+    """Decodes a batch of concatenated records into (device_id, timestamp, latitude, longitude) tuples."""
+    if len(body) % RECORD_SIZE:
+        raise ValueError(f"Record batch of {len(body)} bytes is not a multiple of {RECORD_SIZE}")
+    return list(RECORD_STRUCT.iter_unpack(body))
+
+
+def json_to_tuple(gps_data: dict) -> tuple:
+    return gps_data["device_id"], gps_data["timestamp"], gps_data["latitude"], gps_data["longitude"]
+
+
+def decode_message(body: bytes, content_type: str = None) -> list[tuple]:
+    """Decodes a queue message, either a record batch or a JSON fix / list of fixes, into tuples."""
+    if content_type == CONTENT_TYPE_RECORDS:
+        return decode_records(body)
+    message_data = json.loads(body)
+    if isinstance(message_data, list):
+        return [json_to_tuple(gps_data) for gps_data in message_data]
+    return [json_to_tuple(message_data)]
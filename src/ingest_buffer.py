@@ -0,0 +1,255 @@
+"""
+Bounded buffer between the TCP server and the RabbitMQ publisher.
+
+``IngestBuffer`` is a drop-in replacement for the ``queue.Queue`` the two used to share. It keeps at most
+``high_watermark`` items in memory. Once that is reached it either blocks producers until consumers have
+drained it down to ``low_watermark`` (``block``), or appends every new item to an on-disk segment log
+(``spill``) until the log has been replayed, so the order of fixes is preserved across memory and disk.
+
+Spilled items survive a restart of the TCP server: existing segments are replayed first. Items that have
+been read back into memory but not yet published are lost if the process dies, the same as before.
+"""
+import json
+import logging
+import os
+import queue
+import struct
+import threading
+import time
+
+from src.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+OVERFLOW_BLOCK = "block"
+OVERFLOW_SPILL = "spill"
+SEGMENT_SUFFIX = ".seg"
+RECORD_HEADER = struct.Struct("<BI")
+KIND_JSON = 0
+KIND_BYTES = 1
+
+QUEUE_WAIT_SECONDS = Histogram("ingest_buffer_wait_seconds",
+                               "Time items spend in the ingest buffer's memory before they are taken out.")
+
+
+class SegmentLog:
+    """Append-only log of length-prefixed items split over numbered segment files."""
+
+    def __init__(self, directory: str, segment_size: int):
+        self.directory = directory
+        self.segment_size = segment_size
+        os.makedirs(directory, exist_ok=True)
+        self.segments = sorted(int(name[:-len(SEGMENT_SUFFIX)]) for name in os.listdir(directory)
+                               if name.endswith(SEGMENT_SUFFIX))
+        self.items = 0
+        self.bytes = 0
+        for segment in self.segments:
+            items, size = self._scan(segment)
+            self.items += items
+            self.bytes += size
+        self.writer = None
+        self.reader = None
+        self.read_segment = None
+
+    def _path(self, segment: int) -> str:
+        return os.path.join(self.directory, f"{segment:020d}{SEGMENT_SUFFIX}")
+
+    def _scan(self, segment: int) -> tuple[int, int]:
+        """Counts the complete items of a segment, ignoring a record cut short by a crash."""
+        items = 0
+        size = os.path.getsize(self._path(segment))
+        with open(self._path(segment), "rb") as f:
+            while len(header := f.read(RECORD_HEADER.size)) == RECORD_HEADER.size:
+                _, length = RECORD_HEADER.unpack(header)
+                if f.tell() + length > size:
+                    break
+                f.seek(length, os.SEEK_CUR)
+                items += 1
+            return items, f.tell()
+
+    def append(self, item):
+        if isinstance(item, bytes):
+            kind, payload = KIND_BYTES, item
+        else:
+            kind, payload = KIND_JSON, json.dumps(item).encode()
+        if self.writer is None or self.writer.tell() >= self.segment_size:
+            self._rotate()
+        self.writer.write(RECORD_HEADER.pack(kind, len(payload)) + payload)
+        self.writer.flush()
+        self.items += 1
+        self.bytes += RECORD_HEADER.size + len(payload)
+
+    def _rotate(self):
+        if self.writer is not None:
+            self.writer.close()
+        segment = self.segments[-1] + 1 if self.segments else 0
+        self.segments.append(segment)
+        self.writer = open(self._path(segment), "ab")
+
+    def read(self, max_items: int) -> list:
+        items = []
+        while len(items) < max_items and self.items:
+            if self.reader is None:
+                self.read_segment = self.segments[0]
+                self.reader = open(self._path(self.read_segment), "rb")
+            header = self.reader.read(RECORD_HEADER.size)
+            if len(header) < RECORD_HEADER.size:
+                self._finish_read_segment()
+                continue
+            kind, length = RECORD_HEADER.unpack(header)
+            payload = self.reader.read(length)
+            if len(payload) < length:
+                self._finish_read_segment()
+                continue
+            items.append(payload if kind == KIND_BYTES else json.loads(payload))
+            self.items -= 1
+            self.bytes -= RECORD_HEADER.size + length
+        if not self.items:
+            self._reset()
+        return items
+
+    def _finish_read_segment(self):
+        self.reader.close()
+        os.remove(self._path(self.read_segment))
+        self.segments.pop(0)
+        self.reader = None
+
+    def _reset(self):
+        """Removes all segments once everything has been read back."""
+        for handle in (self.reader, self.writer):
+            if handle is not None:
+                handle.close()
+        for segment in self.segments:
+            os.remove(self._path(segment))
+        self.segments = []
+        self.reader = None
+        self.writer = None
+        self.bytes = 0
+
+
+class IngestBuffer:
+    """
+    Thread-safe, ``queue.Queue`` compatible FIFO with high/low watermarks and optional spilling to disk.
+
+    Args:
+        high_watermark: Number of in-memory items at which the overflow policy kicks in.
+        low_watermark: Number of in-memory items below which producers are released again, or spilled items
+            are read back into memory.
+        overflow: ``block`` to apply backpressure to producers, ``spill`` to append to the segment log.
+        spill_dir: Directory of the segment log, required for ``spill``.
+        segment_size: Size in bytes at which a new segment file is started.
+    """
+
+    def __init__(self, high_watermark: int, low_watermark: int, overflow: str = OVERFLOW_BLOCK,
+                 spill_dir: str = None, segment_size: int = 64 * 1024 * 1024):
+        if not 0 <= low_watermark < high_watermark:
+            raise ValueError("low_watermark must be smaller than high_watermark")
+        if overflow not in (OVERFLOW_BLOCK, OVERFLOW_SPILL):
+            raise ValueError(f"Unknown overflow policy: {overflow}")
+        if overflow == OVERFLOW_SPILL and not spill_dir:
+            raise ValueError("spill_dir is required to spill to disk")
+        self.high_watermark = high_watermark
+        self.low_watermark = low_watermark
+        self.overflow = overflow
+        self.memory = []
+        # When each item of memory was put in, or read back from the segment log.
+        self.put_times = []
+        self.head = 0
+        self.blocked = False
+        self.spilled_items_total = 0
+        self.spill_log = SegmentLog(spill_dir, segment_size) if overflow == OVERFLOW_SPILL else None
+        self.mutex = threading.Lock()
+        self.not_empty = threading.Condition(self.mutex)
+        self.not_full = threading.Condition(self.mutex)
+        if self.spill_log is not None and self.spill_log.items:
+            logger.info(f"Replaying {self.spill_log.items} spilled items from {spill_dir}")
+
+    def _memory_depth(self) -> int:
+        return len(self.memory) - self.head
+
+    def _spilling(self) -> bool:
+        return self.spill_log is not None and self.spill_log.items > 0
+
+    def qsize(self) -> int:
+        with self.mutex:
+            return self._memory_depth() + (self.spill_log.items if self.spill_log is not None else 0)
+
+    def empty(self) -> bool:
+        return self.qsize() == 0
+
+    def full(self) -> bool:
+        """True while producers are held back by the ``block`` policy."""
+        with self.mutex:
+            return self.blocked
+
+    def put(self, item, block: bool = True, timeout: float = None):
+        with self.not_full:
+            if self.overflow == OVERFLOW_SPILL:
+                if self._spilling() or self._memory_depth() >= self.high_watermark:
+                    self.spill_log.append(item)
+                    self.spilled_items_total += 1
+                    self.not_empty.notify()
+                    return
+            else:
+                if self._memory_depth() >= self.high_watermark:
+                    self.blocked = True
+                if self.blocked:
+                    if not block:
+                        raise queue.Full
+                    if not self.not_full.wait_for(lambda: not self.blocked, timeout):
+                        raise queue.Full
+            self.memory.append(item)
+            self.put_times.append(time.perf_counter())
+            self.not_empty.notify()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block: bool = True, timeout: float = None):
+        with self.not_empty:
+            if self._memory_depth() <= self.low_watermark and self._spilling():
+                self._refill()
+            if not self._memory_depth():
+                if not block:
+                    raise queue.Empty
+                if not self.not_empty.wait_for(lambda: self._memory_depth() or self._spilling(), timeout):
+                    raise queue.Empty
+                if not self._memory_depth():
+                    self._refill()
+            item = self.memory[self.head]
+            self.memory[self.head] = None
+            QUEUE_WAIT_SECONDS.observe(time.perf_counter() - self.put_times[self.head])
+            self.head += 1
+            if self.head > 1024 and self.head * 2 > len(self.memory):
+                del self.memory[:self.head]
+                del self.put_times[:self.head]
+                self.head = 0
+            if self.blocked and self._memory_depth() <= self.low_watermark:
+                self.blocked = False
+                self.not_full.notify_all()
+            return item
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def _refill(self):
+        items = self.spill_log.read(self.high_watermark - self._memory_depth())
+        self.memory.extend(items)
+        self.put_times.extend([time.perf_counter()] * len(items))
+
+    def stats(self) -> dict:
+        with self.mutex:
+            return {
+                "depth": self._memory_depth() + (self.spill_log.items if self.spill_log is not None else 0),
+                "memory_depth": self._memory_depth(),
+                "spilled_items": self.spill_log.items if self.spill_log is not None else 0,
+                "spilled_bytes": self.spill_log.bytes if self.spill_log is not None else 0,
+                "spilled_items_total": self.spilled_items_total,
+                "blocked": self.blocked,
+            }
+
+
+def report_buffer_stats(buffer: IngestBuffer, interval: float):
+    while True:
+        time.sleep(interval)
+        logger.info(f"Ingest buffer stats: {buffer.stats()}")
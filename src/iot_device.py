@@ -5,10 +5,13 @@ import random
 import socket
 import time
 
-import config as cfg
+from src.gps_record import encode_record
+from src.protocol import encode_handshake, encode_json_frame, parse_ack, ProtocolError, FORMAT_JSON, FORMAT_BINARY
+from src.structured_logging import configure_logging
 
 DEVICE_ID = 1
 DATA_SEND_INTERVAL = 5
+DATA_FORMAT = os.getenv("DEVICE_DATA_FORMAT", "JSON").encode()
 
 tcp_server_host = os.getenv("TCP_SERVER_HOST", "0.0.0.0")
 tcp_server_port = int(os.getenv("TCP_SERVER_PORT", "65432"))
@@ -34,6 +37,77 @@ class IoTDevice:
         }
 
 
+class DeviceConnection:
+    """
+    Persistent connection to the TCP server that streams many GPS fixes over a single socket.
+
+    Fixes are numbered from 1 in the order they are sent and the server acknowledges them cumulatively, so
+    callers can send a burst with ``send`` and wait once with ``wait_for_ack``. With ``FORMAT_BINARY`` each
+    fix is sent as a 24 byte record instead of a JSON line.
+    """
+
+    def __init__(self, tcp_host=tcp_server_host, tcp_port=tcp_server_port, timeout: float = 10,
+                 data_format: bytes = FORMAT_JSON):
+        self.tcp_host = tcp_host
+        self.tcp_port = tcp_port
+        self.timeout = timeout
+        self.data_format = data_format
+        self.encode = encode_record if data_format == FORMAT_BINARY else encode_json_frame
+        self.sock = None
+        self.reader = None
+        self.sent_seq = 0
+        self.acked_seq = 0
+
+    def connect(self):
+        self.sock = socket.create_connection((self.tcp_host, self.tcp_port), timeout=self.timeout)
+        self.reader = self.sock.makefile("rb")
+        self.sock.sendall(encode_handshake(self.data_format))
+        reply = self.reader.readline()
+        if reply.strip() != b"OK " + self.data_format:
+            self.close()
+            raise ProtocolError(f"Handshake rejected by server: {reply!r}")
+        self.sent_seq = 0
+        self.acked_seq = 0
+
+    def send(self, gps_data: dict) -> int:
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(self.encode(gps_data))
+        self.sent_seq += 1
+        return self.sent_seq
+
+    def send_many(self, gps_data_list: list[dict]) -> int:
+        if self.sock is None:
+            self.connect()
+        self.sock.sendall(b"".join(self.encode(gps_data) for gps_data in gps_data_list))
+        self.sent_seq += len(gps_data_list)
+        return self.sent_seq
+
+    def wait_for_ack(self, seq: int = None) -> int:
+        seq = self.sent_seq if seq is None else seq
+        while self.acked_seq < seq:
+            line = self.reader.readline()
+            if not line:
+                raise ConnectionError(f"Server closed connection, acknowledged {self.acked_seq}/{seq} messages")
+            self.acked_seq = parse_ack(line)
+        return self.acked_seq
+
+    def close(self):
+        if self.reader is not None:
+            self.reader.close()
+        if self.sock is not None:
+            self.sock.close()
+        self.sock = None
+        self.reader = None
+
+    def __enter__(self):
+        self.connect()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.close()
+
+
 def send_gps_data(gps_data: dict, tcp_host=tcp_server_host, tcp_port=tcp_server_port):
     with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
         try:
@@ -48,11 +122,17 @@ def send_gps_data(gps_data: dict, tcp_host=tcp_server_host, tcp_port=tcp_server_
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
+    configure_logging()
 
     iot_device = IoTDevice(device_id=DEVICE_ID)
+    connection = DeviceConnection(data_format=DATA_FORMAT)
     while True:
         iot_device.move()
         device_gps_data = iot_device.generate_gps_data()
-        send_gps_data(device_gps_data)
+        try:
+            connection.send(device_gps_data)
+            logger.info(f"Server acknowledged up to #{connection.wait_for_ack()}")
+        except (OSError, ProtocolError) as e:
+            logger.info(f"Error: {e}, reconnecting")
+            connection.close()
         time.sleep(DATA_SEND_INTERVAL)
@@ -0,0 +1,107 @@
+import threading
+import time
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+
+class CachedLocation(NamedTuple):
+    device_id: int
+    latitude: float
+    longitude: float
+    timestamp: datetime
+
+
+class LastLocationCache:
+    """
+    In-memory copy of ``latest_locations``, one entry per device.
+
+    The cache is only trusted while it is fresh: ``mark_synced`` is called whenever the update feed is known
+    to be alive, and ``is_fresh`` turns false once that hasn't happened for ``max_staleness`` seconds, so
+    readers fall back to the database while the feed is down. Like the ``latest_locations`` upsert, an entry
+    is only replaced by a newer fix. Full reloads replay the updates that arrived while they were running.
+    """
+
+    def __init__(self, max_staleness: float):
+        self.max_staleness = max_staleness
+        self.locations = {}
+        self.snapshot = None
+        self.synced_at = None
+        self.lock = threading.Lock()
+        self.reload_lock = threading.Lock()
+        self.updates_during_reload = None
+
+    def __len__(self) -> int:
+        return len(self.locations)
+
+    def mark_synced(self):
+        self.synced_at = time.monotonic()
+
+    def is_fresh(self) -> bool:
+        return self.synced_at is not None and time.monotonic() - self.synced_at <= self.max_staleness
+
+    def get(self, device_id: int) -> Optional[CachedLocation]:
+        return self.locations.get(device_id)
+
+    def all(self) -> list[CachedLocation]:
+        """Returns every device's last location; the list is shared between callers until the next update."""
+        snapshot = self.snapshot
+        if snapshot is None:
+            with self.lock:
+                snapshot = self.snapshot = list(self.locations.values())
+        return snapshot
+
+    @staticmethod
+    def _apply(locations: dict, location: CachedLocation) -> bool:
+        current = locations.get(location.device_id)
+        if current is not None and current.timestamp > location.timestamp:
+            return False
+        locations[location.device_id] = location
+        return True
+
+    def update(self, locations: list[CachedLocation]):
+        with self.lock:
+            changed = False
+            for location in locations:
+                changed |= self._apply(self.locations, location)
+            if self.updates_during_reload is not None:
+                self.updates_during_reload.extend(locations)
+            if changed:
+                self.snapshot = None
+
+    def remove(self, device_ids: list[int]):
+        with self.lock:
+            for device_id in device_ids:
+                self.locations.pop(device_id, None)
+            if self.updates_during_reload is not None:
+                self.updates_during_reload.append(list(device_ids))
+            self.snapshot = None
+
+    def reload(self, load_locations) -> list[CachedLocation]:
+        """
+        Replaces the cache with the locations returned by load_locations, keeping the updates applied meanwhile.
+
+        Reloads run one at a time, so one can't drop the updates recorded for another.
+        """
+        with self.reload_lock:
+            self.begin_reload()
+            locations = load_locations()
+            self.finish_reload(locations)
+            return locations
+
+    def begin_reload(self):
+        """Starts recording updates; call before reading latest_locations from the database."""
+        with self.lock:
+            self.updates_during_reload = []
+
+    def finish_reload(self, locations):
+        fresh = {location.device_id: location for location in locations}
+        with self.lock:
+            for update in self.updates_during_reload or ():
+                if isinstance(update, list):
+                    for device_id in update:
+                        fresh.pop(device_id, None)
+                else:
+                    self._apply(fresh, update)
+            self.locations = fresh
+            self.snapshot = None
+            self.updates_during_reload = None
@@ -0,0 +1,224 @@
+"""
+Load generator that simulates a large fleet of devices against the TCP server.
+
+Device positions live in NumPy arrays (``DeviceFleet``) and a batch of devices is moved and encoded with a few
+array operations, so one process can keep a million devices moving. ``LoadGenerator`` sends from a pool of
+persistent asyncio connections at a target rate; every device is always sent over the same connection, so its
+fixes stay in order. Each connection keeps a bounded window of unacknowledged batches and measures the time
+from writing a batch to the server's cumulative ``ACK`` covering it.
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+import numpy as np
+
+from src.protocol import FORMAT_BINARY, ProtocolError, encode_handshake, parse_ack
+
+logger = logging.getLogger(__name__)
+
+RECORD_DTYPE = np.dtype([("device_id", "<u4"), ("timestamp", "<u4"), ("latitude", "<f8"), ("longitude", "<f8")])
+STEP_DEGREES = 0.0001
+
+
+class DeviceFleet:
+    def __init__(self, device_ids=(), seed: int = None):
+        self.rng = np.random.default_rng(seed)
+        self.device_ids = np.zeros(0, dtype=np.uint32)
+        self.latitudes = np.zeros(0)
+        self.longitudes = np.zeros(0)
+        self.set_devices(device_ids)
+
+    def __len__(self) -> int:
+        return len(self.device_ids)
+
+    def set_devices(self, device_ids):
+        """Replaces the fleet; devices that were already in it keep their position, new ones start anywhere."""
+        device_ids = np.unique(np.asarray(device_ids, dtype=np.uint32))
+        latitudes = self.rng.uniform(-90.0, 90.0, len(device_ids))
+        longitudes = self.rng.uniform(-180.0, 180.0, len(device_ids))
+        known = np.isin(device_ids, self.device_ids)
+        if known.any():
+            # Both id arrays are sorted, so the old positions are found with a binary search.
+            old = np.searchsorted(self.device_ids, device_ids[known])
+            latitudes[known] = self.latitudes[old]
+            longitudes[known] = self.longitudes[old]
+        self.device_ids, self.latitudes, self.longitudes = device_ids, latitudes, longitudes
+
+    def move(self, indices=slice(None), step: float = STEP_DEGREES):
+        """Moves the selected devices by a random step of at most ``step`` degrees on both axes."""
+        count = len(self.device_ids[indices])
+        latitudes = self.latitudes[indices] + self.rng.uniform(-step, step, count)
+        longitudes = self.longitudes[indices] + self.rng.uniform(-step, step, count)
+        self.latitudes[indices] = np.clip(latitudes, -90.0, 90.0)
+        self.longitudes[indices] = (longitudes + 180.0) % 360.0 - 180.0
+
+    def encode_records(self, indices, timestamp: int) -> bytes:
+        records = np.empty(len(self.device_ids[indices]), dtype=RECORD_DTYPE)
+        records["device_id"] = self.device_ids[indices]
+        records["timestamp"] = timestamp
+        records["latitude"] = self.latitudes[indices]
+        records["longitude"] = self.longitudes[indices]
+        return records.tobytes()
+
+    def encode_json(self, indices, timestamp: int) -> bytes:
+        return "".join(
+            f'{{"device_id":{device_id},"timestamp":{timestamp},"latitude":{latitude},"longitude":{longitude}}}\n'
+            for device_id, latitude, longitude in zip(self.device_ids[indices].tolist(),
+                                                      self.latitudes[indices].tolist(),
+                                                      self.longitudes[indices].tolist())).encode()
+
+
+class LoadStats:
+    def __init__(self):
+        self.started = time.perf_counter()
+        self.sent = 0
+        self.acked = 0
+        self.errors = 0
+        self.latencies = []
+
+    def record_acked(self, latency: float, count: int):
+        self.latencies.append(latency)
+        self.acked += count
+
+    def summary(self) -> dict:
+        """Returns the rates and ACK latency percentiles since the stats were started."""
+        elapsed = max(time.perf_counter() - self.started, 1e-9)
+        latencies = np.array(self.latencies) * 1000
+        p50, p90, p99 = np.percentile(latencies, [50, 90, 99]) if len(latencies) else (float("nan"),) * 3
+        return {"sent/s": self.sent / elapsed, "acked/s": self.acked / elapsed, "ack_p50_ms": p50,
+                "ack_p90_ms": p90, "ack_p99_ms": p99,
+                "ack_max_ms": latencies.max() if len(latencies) else float("nan"), "errors": self.errors}
+
+    def take(self) -> dict:
+        """Returns the summary and starts a new period."""
+        summary = self.summary()
+        self.started, self.sent, self.acked, self.errors, self.latencies = time.perf_counter(), 0, 0, 0, []
+        return summary
+
+
+class LoadGenerator:
+    """
+    Sends fixes of a fleet at ``rate`` fixes per second over ``connections`` persistent connections.
+
+    Device ``d`` is served by connection ``d % connections``, which cycles through its devices ``batch_size`` at
+    a time, moving them right before they are sent. A connection stops sending while ``max_in_flight`` batches are
+    unacknowledged, so the achieved rate drops below the target when the server can't keep up.
+    """
+
+    def __init__(self, host: str, port: int, device_ids, rate: float, connections: int = 4,
+                 batch_size: int = 500, max_in_flight: int = 16, data_format: bytes = FORMAT_BINARY,
+                 seed: int = None):
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.connections = connections
+        self.batch_size = batch_size
+        self.max_in_flight = max_in_flight
+        self.data_format = data_format
+        self.fleets = [DeviceFleet(seed=None if seed is None else seed + i) for i in range(connections)]
+        self.set_devices(device_ids)
+        # The period stats are reset by every report, the totals cover the whole run.
+        self.stats = LoadStats()
+        self.totals = LoadStats()
+
+    def set_devices(self, device_ids):
+        device_ids = np.asarray(device_ids, dtype=np.uint32)
+        for connection, fleet in enumerate(self.fleets):
+            fleet.set_devices(device_ids[device_ids % self.connections == connection])
+
+    async def run(self, duration: float = None) -> dict:
+        """Runs for duration seconds, or until cancelled, and returns the summary of the whole run."""
+        self.stats, self.totals = LoadStats(), LoadStats()
+        tasks = [asyncio.create_task(self.run_connection(fleet)) for fleet in self.fleets]
+        try:
+            await asyncio.wait(tasks, timeout=duration)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        return self.totals.summary()
+
+    async def run_connection(self, fleet: DeviceFleet):
+        while True:
+            try:
+                await self.stream(fleet)
+            except (OSError, ProtocolError) as e:
+                self.stats.errors += 1
+                self.totals.errors += 1
+                logger.info(f"Connection error: {e}, reconnecting")
+                await asyncio.sleep(1)
+
+    async def stream(self, fleet: DeviceFleet):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(encode_handshake(self.data_format))
+            reply = await reader.readline()
+            if reply.strip() != b"OK " + self.data_format:
+                raise ProtocolError(f"Handshake rejected by server: {reply!r}")
+            in_flight = deque()
+            window = asyncio.Semaphore(self.max_in_flight)
+            tasks = [asyncio.create_task(self.send_batches(fleet, writer, in_flight, window)),
+                     asyncio.create_task(self.read_acks(reader, in_flight, window))]
+            try:
+                done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+            finally:
+                for task in tasks:
+                    task.cancel()
+            for task in done:
+                task.result()
+        finally:
+            writer.close()
+
+    async def send_batches(self, fleet: DeviceFleet, writer: asyncio.StreamWriter, in_flight: deque,
+                           window: asyncio.Semaphore):
+        encode = fleet.encode_records if self.data_format == FORMAT_BINARY else fleet.encode_json
+        interval = self.batch_size * self.connections / self.rate
+        next_send = time.perf_counter()
+        position = seq = 0
+        while True:
+            if not len(fleet):
+                await asyncio.sleep(1)
+                continue
+            position = position if position < len(fleet) else 0
+            batch = slice(position, position + self.batch_size)
+            position += self.batch_size
+            fleet.move(batch)
+            data = encode(batch, int(time.time()))
+            count = len(fleet.device_ids[batch])
+            await window.acquire()
+            seq += count
+            in_flight.append((seq, time.perf_counter(), count))
+            writer.write(data)
+            await writer.drain()
+            self.stats.sent += count
+            self.totals.sent += count
+            next_send += interval
+            delay = next_send - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            elif delay < -1:
+                # Don't try to catch up on more than a second of backlog.
+                next_send = time.perf_counter()
+
+    async def read_acks(self, reader: asyncio.StreamReader, in_flight: deque, window: asyncio.Semaphore):
+        while True:
+            line = await reader.readline()
+            if not line:
+                raise ConnectionError("Server closed the connection")
+            acked_seq = parse_ack(line)
+            now = time.perf_counter()
+            while in_flight and in_flight[0][0] <= acked_seq:
+                _, sent_at, count = in_flight.popleft()
+                self.stats.record_acked(now - sent_at, count)
+                self.totals.record_acked(now - sent_at, count)
+                window.release()
+
+    async def report_forever(self, interval: float):
+        while True:
+            await asyncio.sleep(interval)
+            summary = self.stats.take()
+            logger.info(" ".join(f"{key}={value:.1f}" if isinstance(value, float) else f"{key}={value}"
+                                 for key, value in summary.items()))
+
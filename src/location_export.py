@@ -0,0 +1,48 @@
+"""
+Encoding of exported location rows as NDJSON or CSV, optionally gzip compressed.
+
+Rows are encoded one chunk at a time, so an export of any size only ever holds one chunk of rows in memory.
+"""
+import csv
+import io
+import json
+import zlib
+from typing import AsyncIterator
+
+FORMAT_NDJSON = "ndjson"
+FORMAT_CSV = "csv"
+MEDIA_TYPES = {FORMAT_NDJSON: "application/x-ndjson", FORMAT_CSV: "text/csv"}
+CSV_HEADER = ("device_id", "timestamp", "latitude", "longitude")
+
+
+def encode_ndjson(rows) -> bytes:
+    return "".join(json.dumps({"device_id": device_id, "timestamp": timestamp.isoformat(), "latitude": latitude,
+                               "longitude": longitude}) + "\n"
+                   for device_id, timestamp, latitude, longitude in rows).encode()
+
+
+def encode_csv(rows, header: bool = False) -> bytes:
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    if header:
+        writer.writerow(CSV_HEADER)
+    writer.writerows((device_id, timestamp.isoformat(), latitude, longitude)
+                     for device_id, timestamp, latitude, longitude in rows)
+    return buffer.getvalue().encode()
+
+
+async def encode_export(chunks: AsyncIterator[list], export_format: str, compress: bool = False) -> AsyncIterator[bytes]:
+    """Encodes chunks of (device_id, timestamp, latitude, longitude) rows into the body of an export."""
+    compressor = zlib.compressobj(wbits=31) if compress else None
+    encode = encode_csv if export_format == FORMAT_CSV else encode_ndjson
+    if export_format == FORMAT_CSV:
+        header = encode_csv((), header=True)
+        yield compressor.compress(header) if compressor is not None else header
+    async for rows in chunks:
+        data = encode(rows)
+        if compressor is not None:
+            data = compressor.compress(data)
+        if data:
+            yield data
+    if compressor is not None:
+        yield compressor.flush()
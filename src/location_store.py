@@ -0,0 +1,543 @@
+"""
+Append-only columnar store of the raw fixes, an alternative to the ``locations`` table for history-heavy workloads.
+
+Every device has a directory of segment files, each holding up to ``segment_capacity`` fixes of one
+``segment_seconds`` window as three columns: timestamps (int64 unix seconds), latitudes and longitudes (float64),
+24 bytes per fix. Segment files are sparse, so the unused tail of a segment takes no disk space. Within a segment
+fixes are sorted by time; a fix older than the newest fix of the device's open segment, or past the segment's
+window, seals the segment and starts a new one. Sealed segments are listed in the device's ``catalog`` file with
+their time range, and every segment keeps the timestamp of every ``index_interval``-th fix in its header, so a
+range read opens only the segments that overlap the range and touches one index page and one block per bound.
+
+Reads map the segments read-only and return NumPy slices of the mapped columns, without copying, unless the range
+spans several segments. A fix's id is its position in the device's stream, so ``(timestamp, id)`` orders fixes as
+the ``locations`` table does and cursors work with both.
+
+Every device is appended to by a single process, which the data processor's partitioning guarantees; readers in
+other processes see fixes once the segment's count is updated after they were written. Appends land in the page
+cache and survive a crash of the process; with ``sync`` they are flushed to disk before ``append`` returns.
+Segments are only ever removed by the writer of their device, which owns the devices of its ``partition`` (see
+``src.partitioning``), so an open segment is never removed while it is appended to. Other processes delete a device
+by leaving a tombstone in the ``deleted`` directory: readers stop returning the device's fixes at once, and the
+writer removes its segments and then the tombstone. Readers drop a mapped segment once its file was removed, and
+with ``retention_days`` they skip segments past retention before their writer gets to remove them.
+"""
+import mmap
+import os
+import shutil
+import threading
+import time
+from collections import OrderedDict
+from datetime import datetime
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from src.partitioning import partition_for
+
+LOCATION_STORE_SQL = "sql"
+LOCATION_STORE_COLUMNAR = "columnar"
+SEGMENT_CAPACITY = 65536
+INDEX_INTERVAL = 512
+SEGMENT_SECONDS = 86400
+MAX_OPEN_SEGMENTS = 4096
+PAGE_SIZE = 4096
+MAGIC = b"GPSCOL1"
+SEGMENT_SUFFIX = ".seg"
+CATALOG_NAME = "catalog"
+TOMBSTONE_DIRECTORY = "deleted"
+EPOCH = datetime(1970, 1, 1)
+
+HEADER_DTYPE = np.dtype([("magic", "S8"), ("capacity", "<u4"), ("index_interval", "<u4"), ("first_id", "<u8"),
+                         ("count", "<u8"), ("sealed", "u1")])
+HEADER_SIZE = 64
+# One entry per sealed segment of a device, appended when it is sealed.
+CATALOG_DTYPE = np.dtype([("first_id", "<u8"), ("count", "<u8"), ("first_timestamp", "<i8"),
+                          ("last_timestamp", "<i8")])
+
+
+class StoredLocation(NamedTuple):
+    id: int
+    device_id: int
+    latitude: float
+    longitude: float
+    timestamp: datetime
+
+
+class LocationColumns(NamedTuple):
+    """
+    Fixes of one device ordered by (timestamp, id); timestamps are datetime64, in seconds when read from segments
+    and in microseconds when read from the database.
+    """
+    ids: np.ndarray
+    timestamps: np.ndarray
+    latitudes: np.ndarray
+    longitudes: np.ndarray
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    @classmethod
+    def from_rows(cls, rows: list) -> "LocationColumns":
+        """Builds the columns of (id, timestamp, latitude, longitude) rows read from the database."""
+        if not rows:
+            return EMPTY_COLUMNS
+        ids, timestamps, latitudes, longitudes = zip(*rows)
+        return cls(np.array(ids, dtype=np.int64), np.array(timestamps, dtype="datetime64[us]"),
+                   np.array(latitudes, dtype=np.float64), np.array(longitudes, dtype=np.float64))
+
+    @classmethod
+    def concatenate(cls, chunks: list["LocationColumns"]) -> "LocationColumns":
+        """Joins consecutive columns; a single one is returned as is, without copying."""
+        if len(chunks) == 1:
+            return chunks[0]
+        if not chunks:
+            return EMPTY_COLUMNS
+        return cls(*map(np.concatenate, zip(*chunks)))
+
+    def rows(self) -> list[tuple]:
+        """Returns (id, timestamp, latitude, longitude) rows, like the columns of ``locations``."""
+        return list(zip(self.ids.tolist(), self.timestamps.tolist(), self.latitudes.tolist(),
+                        self.longitudes.tolist()))
+
+    def locations(self, device_id: int) -> list[StoredLocation]:
+        return [StoredLocation(location_id, device_id, latitude, longitude, timestamp)
+                for location_id, timestamp, latitude, longitude in self.rows()]
+
+
+EMPTY_COLUMNS = LocationColumns(np.zeros(0, np.int64), np.zeros(0, "datetime64[s]"), np.zeros(0), np.zeros(0))
+
+
+def to_seconds(timestamp: datetime) -> float:
+    """Unix seconds of a datetime; naive datetimes are UTC, as in the database."""
+    if timestamp.tzinfo is not None:
+        return timestamp.timestamp()
+    return (timestamp - EPOCH).total_seconds()
+
+
+def next_segment_id(entries: np.ndarray) -> int:
+    """Returns the first id of the segment after the sealed ones of a catalog."""
+    return int(entries[-1]["first_id"] + entries[-1]["count"]) if len(entries) else 0
+
+
+def data_offset(capacity: int, index_interval: int) -> int:
+    index_end = HEADER_SIZE + 8 * (capacity // index_interval)
+    return -(-index_end // PAGE_SIZE) * PAGE_SIZE
+
+
+class Segment:
+    """One segment file mapped into memory; the count in its header is the number of fixes written so far."""
+
+    def __init__(self, path: str, writable: bool = False):
+        self.path = path
+        with open(path, "r+b" if writable else "rb") as file:
+            self.inode = os.fstat(file.fileno()).st_ino
+            self.map = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        self.header = np.ndarray(1, HEADER_DTYPE, self.map)
+        if self.header["magic"][0] != MAGIC:
+            raise ValueError(f"{path} is not a location segment")
+        self.capacity = int(self.header["capacity"][0])
+        self.index_interval = int(self.header["index_interval"][0])
+        self.first_id = int(self.header["first_id"][0])
+        self.index = np.ndarray(self.capacity // self.index_interval, "<i8", self.map, HEADER_SIZE)
+        offset = data_offset(self.capacity, self.index_interval)
+        self.timestamps = np.ndarray(self.capacity, "<i8", self.map, offset)
+        self.latitudes = np.ndarray(self.capacity, "<f8", self.map, offset + 8 * self.capacity)
+        self.longitudes = np.ndarray(self.capacity, "<f8", self.map, offset + 16 * self.capacity)
+
+    @staticmethod
+    def create(path: str, first_id: int, capacity: int, index_interval: int) -> "Segment":
+        """Creates an empty sparse segment file; it's renamed into place, so readers never see it half written."""
+        header = np.zeros(1, HEADER_DTYPE)
+        header[0] = (MAGIC, capacity, index_interval, first_id, 0, 0)
+        temporary_path = path + ".tmp"
+        with open(temporary_path, "wb") as file:
+            file.write(header.tobytes())
+            file.truncate(data_offset(capacity, index_interval) + 24 * capacity)
+        os.replace(temporary_path, path)
+        return Segment(path, writable=True)
+
+    @property
+    def count(self) -> int:
+        return int(self.header["count"][0])
+
+    @property
+    def sealed(self) -> bool:
+        return bool(self.header["sealed"][0])
+
+    def search(self, timestamp: float, side: str, count: int) -> int:
+        """Like np.searchsorted on the first count timestamps, but only reads one index block of them."""
+        interval = self.index_interval
+        block = int(np.searchsorted(self.index[:-(-count // interval)], timestamp, side))
+        low, high = max(0, (block - 1) * interval), min(count, block * interval)
+        return low + int(np.searchsorted(self.timestamps[low:high], timestamp, side))
+
+    def append(self, timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray):
+        count, end = self.count, self.count + len(timestamps)
+        self.timestamps[count:end] = timestamps
+        self.latitudes[count:end] = latitudes
+        self.longitudes[count:end] = longitudes
+        first_block = -(-count // self.index_interval)
+        self.index[first_block:-(-end // self.index_interval)] = \
+            self.timestamps[first_block * self.index_interval:end:self.index_interval]
+        # The count is updated last: readers never see fixes that aren't fully written.
+        self.header["count"] = end
+
+    def seal(self):
+        self.header["sealed"] = 1
+
+    def flush(self):
+        self.map.flush()
+
+
+class ColumnarLocationStore:
+    """
+    Per-device segment files under ``directory``, see the module documentation.
+
+    At most ``max_open_segments`` segments are kept mapped; slices returned by reads keep their segment mapped
+    until they are released. A writer's appends and removals may run on different threads.
+    """
+
+    def __init__(self, directory: str, read_only: bool = False, segment_capacity: int = SEGMENT_CAPACITY,
+                 index_interval: int = INDEX_INTERVAL, segment_seconds: int = SEGMENT_SECONDS,
+                 max_open_segments: int = MAX_OPEN_SEGMENTS, sync: bool = False, partition: int = 0,
+                 partitions: int = 1, retention_days: float = 0):
+        if segment_capacity % index_interval:
+            raise ValueError("segment_capacity must be a multiple of index_interval")
+        self.directory = directory
+        self.read_only = read_only
+        self.segment_capacity = segment_capacity
+        self.index_interval = index_interval
+        self.segment_seconds = segment_seconds
+        self.max_open_segments = max_open_segments
+        self.sync = sync
+        self.partition = partition
+        self.partitions = partitions
+        self.retention_days = retention_days
+        self.lock = threading.Lock()
+        self.segments = OrderedDict()
+        self.catalogs = {}
+        # device_id -> first id of the segment the device's fixes are appended to, which may not exist yet.
+        self.active = {}
+        if not read_only:
+            os.makedirs(directory, exist_ok=True)
+
+    def device_directory(self, device_id: int) -> str:
+        return os.path.join(self.directory, str(device_id))
+
+    def segment_path(self, device_id: int, first_id: int) -> str:
+        return os.path.join(self.device_directory(device_id), f"{first_id:020d}{SEGMENT_SUFFIX}")
+
+    def tombstone_path(self, device_id: int) -> str:
+        return os.path.join(self.directory, TOMBSTONE_DIRECTORY, str(device_id))
+
+    def is_deleted(self, device_id: int) -> bool:
+        return os.path.exists(self.tombstone_path(device_id))
+
+    def mark_deleted(self, device_id: int):
+        """
+        Hides a device's fixes from readers and leaves their removal to its writer, see ``apply_deletions``.
+
+        Only a tombstone is written, never a segment or catalog, so any process may call this, read-only or not.
+        """
+        os.makedirs(os.path.join(self.directory, TOMBSTONE_DIRECTORY), exist_ok=True)
+        with open(self.tombstone_path(device_id), "w"):
+            pass
+
+    def open_segment(self, path: str) -> Optional[Segment]:
+        """Returns the mapped segment at path, None if it doesn't exist."""
+        segment = self.segments.get(path)
+        if segment is not None and self.read_only and not self._still_exists(segment):
+            # Removed by its writer, and maybe replaced by a new segment of a device deleted and created again.
+            del self.segments[path]
+            segment = None
+        if segment is not None:
+            self.segments.move_to_end(path)
+            return segment
+        try:
+            segment = Segment(path, writable=not self.read_only)
+        except FileNotFoundError:
+            return None
+        self.remember(segment)
+        return segment
+
+    @staticmethod
+    def _still_exists(segment: Segment) -> bool:
+        # The mapping keeps the removed file's inode allocated, so a new file at the path has another one.
+        try:
+            return os.stat(segment.path).st_ino == segment.inode
+        except FileNotFoundError:
+            return False
+
+    def remember(self, segment: Segment):
+        self.segments[segment.path] = segment
+        if len(self.segments) > self.max_open_segments:
+            # Unmapped once the slices handed out of it are released too.
+            self.segments.popitem(last=False)
+
+    def catalog(self, device_id: int) -> np.ndarray:
+        """Returns the catalog entries of the device's sealed segments, re-reading the file only when it changed."""
+        path = os.path.join(self.device_directory(device_id), CATALOG_NAME)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            self.catalogs.pop(device_id, None)
+            return np.zeros(0, CATALOG_DTYPE)
+        size = stat.st_size
+        cached = self.catalogs.get(device_id)
+        if cached is not None and cached[0] == (stat.st_ino, size):
+            return cached[1]
+        with open(path, "rb") as file:
+            data = file.read(size - size % CATALOG_DTYPE.itemsize)
+        entries = np.frombuffer(data, CATALOG_DTYPE)
+        self.catalogs[device_id] = ((stat.st_ino, size), entries)
+        return entries
+
+    def device_segments(self, device_id: int) -> list[tuple]:
+        """
+        Returns (first timestamp, last timestamp, path) of the device's segments ordered by id, the open one last.
+
+        Sealed segments are described by the catalog without mapping them; removed ones may still be listed. With
+        ``retention_days``, segments whose fixes are all older than the retention are left out.
+        """
+        if self.is_deleted(device_id):
+            return []
+        entries = self.catalog(device_id)
+        segments = [(entry["first_timestamp"], entry["last_timestamp"],
+                     self.segment_path(device_id, int(entry["first_id"]))) for entry in entries]
+        path = self.segment_path(device_id, next_segment_id(entries))
+        segment = self.open_segment(path)
+        count = 0 if segment is None else segment.count
+        if count:
+            segments.append((segment.timestamps[0], segment.timestamps[count - 1], path))
+        if self.retention_days:
+            cutoff_seconds = time.time() - self.retention_days * 86400
+            segments = [segment for segment in segments if segment[1] >= cutoff_seconds]
+        return segments
+
+    def read(self, device_id: int, start: datetime = None, end: datetime = None,
+             after: tuple[datetime, int] = None, limit: int = None) -> LocationColumns:
+        """
+        Returns the device's fixes within [start, end) after a (timestamp, id) position, at most limit of them.
+
+        The columns are views of a mapped segment when they come from a single one.
+        """
+        start_seconds = None if start is None else to_seconds(start)
+        end_seconds = None if end is None else to_seconds(end)
+        after_seconds = None if after is None else to_seconds(after[0])
+        chunks = []
+        for first_timestamp, last_timestamp, path in self.device_segments(device_id):
+            if (start_seconds is not None and last_timestamp < start_seconds
+                    or end_seconds is not None and first_timestamp >= end_seconds
+                    or after_seconds is not None and last_timestamp < after_seconds):
+                continue
+            segment = self.open_segment(path)
+            if segment is None:
+                continue
+            count = segment.count
+            low = 0 if start_seconds is None else segment.search(start_seconds, "left", count)
+            if after is not None:
+                # Fixes at the cursor's timestamp only come after it if their id is larger.
+                at_cursor = segment.search(after_seconds, "left", count)
+                past_cursor = segment.search(after_seconds, "right", count)
+                low = max(low, at_cursor, min(past_cursor, after[1] - segment.first_id + 1))
+            high = count if end_seconds is None else segment.search(end_seconds, "left", count)
+            if low < high:
+                chunks.append((segment, low, high))
+        return self._collect(chunks, limit)
+
+    def recent(self, device_id: int, limit: int) -> LocationColumns:
+        """Returns the device's newest limit fixes, ordered by (timestamp, id)."""
+        chunks, newest = [], np.zeros(0, np.int64)
+        for _, last_timestamp, path in sorted(self.device_segments(device_id), key=lambda segment: segment[1],
+                                              reverse=True):
+            if len(newest) >= limit and last_timestamp < newest[-limit]:
+                break
+            segment = self.open_segment(path)
+            if segment is None:
+                continue
+            count = segment.count
+            chunks.append((segment, max(0, count - limit), count))
+            newest = np.sort(np.concatenate([newest, segment.timestamps[max(0, count - limit):count]]))
+        chunks.sort(key=lambda chunk: chunk[0].first_id)
+        return LocationColumns(*(column[-limit:] for column in self._collect(chunks, None)))
+
+    @staticmethod
+    def _collect(chunks: list, limit: Optional[int]) -> LocationColumns:
+        """Orders the (segment, low, high) slices of segments ordered by id by (timestamp, id)."""
+        if not chunks:
+            return EMPTY_COLUMNS
+        in_order = all(previous.timestamps[previous_high - 1] <= segment.timestamps[low]
+                       for (previous, _, previous_high), (segment, low, _) in zip(chunks, chunks[1:]))
+        if in_order and limit is not None:
+            trimmed, remaining = [], limit
+            for segment, low, high in chunks:
+                if remaining <= 0:
+                    break
+                trimmed.append((segment, low, min(high, low + remaining)))
+                remaining -= trimmed[-1][2] - low
+            chunks = trimmed
+        if len(chunks) == 1:
+            segment, low, high = chunks[0]
+            return LocationColumns(np.arange(segment.first_id + low, segment.first_id + high),
+                                   segment.timestamps[low:high].view("datetime64[s]"),
+                                   segment.latitudes[low:high], segment.longitudes[low:high])
+        ids = np.concatenate([np.arange(segment.first_id + low, segment.first_id + high)
+                              for segment, low, high in chunks])
+        timestamps = np.concatenate([segment.timestamps[low:high] for segment, low, high in chunks])
+        latitudes = np.concatenate([segment.latitudes[low:high] for segment, low, high in chunks])
+        longitudes = np.concatenate([segment.longitudes[low:high] for segment, low, high in chunks])
+        if not in_order:
+            # Late fixes started segments of their own; ids within equal timestamps stay ascending.
+            order = np.argsort(timestamps, kind="stable")[:limit]
+            ids, timestamps, latitudes, longitudes = ids[order], timestamps[order], latitudes[order], longitudes[order]
+        return LocationColumns(ids, timestamps.view("datetime64[s]"), latitudes, longitudes)
+
+    def append_records(self, records: list[tuple]):
+        """Appends (device_id, timestamp, latitude, longitude) tuples, with unix second timestamps."""
+        if records:
+            columns = np.array(records, dtype=np.float64).T
+            self.append(columns[0].astype(np.int64), columns[1].astype(np.int64), columns[2], columns[3])
+
+    def append(self, device_ids: np.ndarray, timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray):
+        """Appends fixes of any devices; each device's fixes are sorted by time first."""
+        order = np.lexsort((timestamps, device_ids))
+        device_ids, timestamps = device_ids[order], timestamps[order]
+        latitudes, longitudes = latitudes[order], longitudes[order]
+        bounds = [0, *(np.flatnonzero(np.diff(device_ids)) + 1).tolist(), len(device_ids)]
+        written = set()
+        with self.lock:
+            for low, high in zip(bounds, bounds[1:]):
+                written.update(self._append_device(int(device_ids[low]), timestamps[low:high],
+                                                   latitudes[low:high], longitudes[low:high]))
+            if self.sync:
+                for segment in written:
+                    segment.flush()
+
+    def _append_device(self, device_id: int, timestamps: np.ndarray, latitudes: np.ndarray,
+                       longitudes: np.ndarray) -> list[Segment]:
+        first_id = self.active.get(device_id)
+        if first_id is None:
+            first_id = self._recover(device_id)
+        segment = self.open_segment(self.segment_path(device_id, first_id))
+        written, position = [], 0
+        while position < len(timestamps):
+            count = 0 if segment is None else segment.count
+            if count and (count == segment.capacity or timestamps[position] < segment.timestamps[count - 1]
+                          or timestamps[position] >= self.window_end(segment.timestamps[0])):
+                first_id = self._seal(device_id, segment)
+                segment = None
+            if segment is None:
+                os.makedirs(self.device_directory(device_id), exist_ok=True)
+                segment = Segment.create(self.segment_path(device_id, first_id), first_id, self.segment_capacity,
+                                         self.index_interval)
+                self.remember(segment)
+            window_end = self.window_end(segment.timestamps[0] if segment.count else timestamps[position])
+            end = min(position + segment.capacity - segment.count,
+                      position + int(np.searchsorted(timestamps[position:], window_end, "left")))
+            segment.append(timestamps[position:end], latitudes[position:end], longitudes[position:end])
+            written.append(segment)
+            position = end
+        self.active[device_id] = first_id
+        return written
+
+    def window_end(self, first_timestamp: int) -> int:
+        """End of the segment_seconds window a segment starting at first_timestamp may hold fixes of."""
+        return (int(first_timestamp) // self.segment_seconds + 1) * self.segment_seconds
+
+    def _seal(self, device_id: int, segment: Segment) -> int:
+        """Seals a segment, lists it in the catalog and returns the first id of the next one."""
+        count = segment.count
+        segment.seal()
+        entry = np.array([(segment.first_id, count, segment.timestamps[0], segment.timestamps[count - 1])],
+                         CATALOG_DTYPE)
+        with open(os.path.join(self.device_directory(device_id), CATALOG_NAME), "ab") as catalog:
+            size = os.fstat(catalog.fileno()).st_size
+            if size % CATALOG_DTYPE.itemsize:
+                # An entry cut short by a crash would misalign every entry appended after it.
+                catalog.truncate(size - size % CATALOG_DTYPE.itemsize)
+            catalog.write(entry.tobytes())
+            if self.sync:
+                segment.flush()
+                os.fsync(catalog.fileno())
+        return segment.first_id + count
+
+    def _recover(self, device_id: int) -> int:
+        """Returns the first id of the device's open segment, finishing a seal that was interrupted."""
+        first_id = next_segment_id(self.catalog(device_id))
+        segment = self.open_segment(self.segment_path(device_id, first_id))
+        if segment is not None and segment.sealed:
+            first_id = self._seal(device_id, segment)
+        return first_id
+
+    def delete_device(self, device_id: int):
+        """Removes all fixes of a device; only its writer may, other processes use ``mark_deleted``."""
+        if self.read_only:
+            raise ValueError("A read-only store can't remove segments, use mark_deleted")
+        with self.lock:
+            self._delete_device(device_id)
+
+    def _delete_device(self, device_id: int):
+        directory = self.device_directory(device_id)
+        for path in [path for path in self.segments if os.path.dirname(path) == directory]:
+            del self.segments[path]
+        self.catalogs.pop(device_id, None)
+        self.active.pop(device_id, None)
+        shutil.rmtree(directory, ignore_errors=True)
+
+    def apply_deletions(self) -> int:
+        """Removes the fixes and tombstones of the deleted devices of this writer's partition, returns how many."""
+        if self.read_only:
+            raise ValueError("Segments can only be removed by the store's writer")
+        try:
+            names = os.listdir(os.path.join(self.directory, TOMBSTONE_DIRECTORY))
+        except FileNotFoundError:
+            return 0
+        device_ids = [int(name) for name in names
+                      if name.isdigit() and partition_for(int(name), self.partitions) == self.partition]
+        with self.lock:
+            for device_id in device_ids:
+                self._delete_device(device_id)
+                os.remove(self.tombstone_path(device_id))
+        return len(device_ids)
+
+    def owned_devices(self) -> list[int]:
+        """Returns the ids of the devices with fixes in the store that belong to this writer's partition."""
+        try:
+            with os.scandir(self.directory) as devices:
+                device_ids = [int(entry.name) for entry in devices if entry.is_dir() and entry.name.isdigit()]
+        except FileNotFoundError:
+            return []
+        return [device_id for device_id in device_ids if partition_for(device_id, self.partitions) == self.partition]
+
+    def delete_before(self, cutoff: datetime) -> int:
+        """
+        Removes the segments whose fixes are all older than cutoff and returns how many were removed.
+
+        Only the writer removes segments, and only those of its partition's devices. An open segment that is past
+        cutoff, because its device stopped reporting, is sealed first. Catalog entries are kept, so ids aren't
+        reused.
+        """
+        if self.read_only:
+            raise ValueError("Segments can only be removed by the store's writer")
+        cutoff_seconds = to_seconds(cutoff)
+        deleted = 0
+        with self.lock:
+            for device_id in self.owned_devices():
+                first_id = self.active.get(device_id)
+                if first_id is None:
+                    first_id = self._recover(device_id)
+                segment = self.open_segment(self.segment_path(device_id, first_id))
+                if segment is not None and segment.count and segment.timestamps[segment.count - 1] < cutoff_seconds:
+                    self.active[device_id] = self._seal(device_id, segment)
+                for entry in self.catalog(device_id):
+                    if entry["last_timestamp"] >= cutoff_seconds:
+                        continue
+                    path = self.segment_path(device_id, int(entry["first_id"]))
+                    self.segments.pop(path, None)
+                    try:
+                        os.remove(path)
+                        deleted += 1
+                    except FileNotFoundError:
+                        pass
+        return deleted
@@ -0,0 +1,110 @@
+"""
+Fan-out of committed location updates to GraphQL subscribers.
+
+The location updates feed (see src.service.last_location_cache_service) runs in a background thread and hands
+every batch of updates to ``LocationSubscriptionHub.publish``, which moves it onto the event loop. Each
+subscriber keeps at most one pending position per device and is woken up once per coalescing window, so a slow
+client receives the latest positions instead of a growing backlog.
+"""
+import asyncio
+from collections import defaultdict
+from typing import AsyncIterator, Iterable, Optional
+
+
+class BoundingBox:
+    def __init__(self, min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float):
+        self.min_latitude = min_latitude
+        self.min_longitude = min_longitude
+        self.max_latitude = max_latitude
+        self.max_longitude = max_longitude
+
+    def __contains__(self, location) -> bool:
+        if not self.min_latitude <= location.latitude <= self.max_latitude:
+            return False
+        if self.min_longitude <= self.max_longitude:
+            return self.min_longitude <= location.longitude <= self.max_longitude
+        return location.longitude >= self.min_longitude or location.longitude <= self.max_longitude
+
+
+class Subscriber:
+    def __init__(self, device_ids: Optional[set], bounding_box: Optional[BoundingBox]):
+        self.device_ids = device_ids
+        self.bounding_box = bounding_box
+        self.pending = {}
+        self.ready = asyncio.Event()
+
+    def offer(self, location):
+        current = self.pending.get(location.device_id)
+        if current is None or location.timestamp >= current.timestamp:
+            self.pending[location.device_id] = location
+            self.ready.set()
+
+    def take(self) -> list:
+        pending, self.pending = self.pending, {}
+        self.ready.clear()
+        return list(pending.values())
+
+
+class LocationSubscriptionHub:
+    """
+    Routes location updates to the subscribers of their device, or whose bounding box contains them.
+
+    Subscribers by device id are indexed, so an update only touches the subscribers interested in it; bounding
+    box subscribers are checked one by one.
+    """
+
+    def __init__(self, coalesce_window: float):
+        self.coalesce_window = coalesce_window
+        self.loop = None
+        self.by_device = defaultdict(set)
+        self.by_box = set()
+
+    def __len__(self) -> int:
+        return len(self.by_box) + len({subscriber for subscribers in self.by_device.values()
+                                       for subscriber in subscribers})
+
+    def publish(self, locations: list):
+        """Thread-safe; updates published before the first subscription are dropped."""
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.dispatch, locations)
+
+    def dispatch(self, locations: Iterable):
+        by_device, by_box = self.by_device, self.by_box
+        for location in locations:
+            for subscriber in by_device.get(location.device_id, ()):
+                subscriber.offer(location)
+            for subscriber in by_box:
+                if location in subscriber.bounding_box:
+                    subscriber.offer(location)
+
+    def _add(self, subscriber: Subscriber):
+        if subscriber.device_ids is not None:
+            for device_id in subscriber.device_ids:
+                self.by_device[device_id].add(subscriber)
+        else:
+            self.by_box.add(subscriber)
+
+    def _remove(self, subscriber: Subscriber):
+        if subscriber.device_ids is not None:
+            for device_id in subscriber.device_ids:
+                self.by_device[device_id].discard(subscriber)
+                if not self.by_device[device_id]:
+                    del self.by_device[device_id]
+        else:
+            self.by_box.discard(subscriber)
+
+    async def subscribe(self, device_ids: Iterable[int] = None,
+                        bounding_box: BoundingBox = None) -> AsyncIterator[list]:
+        """Yields batches holding the newest position of every matching device that moved during a window."""
+        if (device_ids is None) == (bounding_box is None):
+            raise ValueError("Subscribe either to device ids or to a bounding box")
+        self.loop = asyncio.get_running_loop()
+        subscriber = Subscriber(set(device_ids) if device_ids is not None else None, bounding_box)
+        self._add(subscriber)
+        try:
+            while True:
+                await subscriber.ready.wait()
+                await asyncio.sleep(self.coalesce_window)
+                yield subscriber.take()
+        finally:
+            self._remove(subscriber)
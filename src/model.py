@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float
+from sqlalchemy import Column, Integer, String, ForeignKey, DateTime, Float, Index, UniqueConstraint
 from sqlalchemy.orm import declarative_base
 
 Base = declarative_base()
@@ -12,6 +12,10 @@ class Device(Base):
 
 class Location(Base):
     __tablename__ = "locations"
+    __table_args__ = (
+        Index("ix_locations_device_id_timestamp_id", "device_id", "timestamp", "id"),
+        Index("ix_locations_timestamp", "timestamp"),
+    )
 
     id = Column(Integer, primary_key=True, index=True)
     device_id = Column(Integer, ForeignKey("devices.id", ondelete='CASCADE'))
@@ -23,5 +27,27 @@ class Location(Base):
 class LatestLocation(Base):
     __tablename__ = "latest_locations"
     device_id = Column(Integer, ForeignKey("devices.id", ondelete='CASCADE'), primary_key=True)
-    location_id = Column(Integer, ForeignKey("locations.id", ondelete='CASCADE'))
+    latitude = Column(Float)
+    longitude = Column(Float)
+    timestamp = Column(DateTime)
+    cell = Column(Integer, index=True)
+
+
+class LocationRollup(Base):
+    """One row per device and hour, standing in for the raw fixes of that hour once they are past retention."""
+    __tablename__ = "location_rollups"
+    __table_args__ = (
+        UniqueConstraint("device_id", "hour"),
+        Index("ix_location_rollups_device_id_timestamp_id", "device_id", "timestamp", "id"),
+    )
 
+    id = Column(Integer, primary_key=True)
+    device_id = Column(Integer, ForeignKey("devices.id", ondelete='CASCADE'))
+    hour = Column(DateTime, index=True)
+    fix_count = Column(Integer)
+    # Position and time of the last fix of the hour.
+    latitude = Column(Float)
+    longitude = Column(Float)
+    timestamp = Column(DateTime)
+    average_latitude = Column(Float)
+    average_longitude = Column(Float)
@@ -0,0 +1,36 @@
+"""
+Partitioning of the GPS queue by device.
+
+With ``partitions > 1`` the TCP server publishes every fix to ``<queue>.<partition>``, where the partition is
+``device_id % partitions``, and the data processor runs one single-consumer worker per partition queue. All fixes
+of a device therefore go through the same queue and worker, in the order they were received. A single partition
+keeps using the plain queue name.
+"""
+from src.gps_record import RECORD_SIZE
+
+
+def partition_for(device_id: int, partitions: int) -> int:
+    return device_id % partitions
+
+
+def partition_queue_name(queue_name: str, partition: int, partitions: int) -> str:
+    return queue_name if partitions == 1 else f"{queue_name}.{partition}"
+
+
+def split_by_partition(messages: list, partitions: int) -> dict[int, list]:
+    """Splits queued messages (JSON fixes or binary record batches) by partition, keeping their order."""
+    if partitions == 1:
+        return {0: messages}
+    split = {}
+    for message_data in messages:
+        if isinstance(message_data, bytes):
+            records_by_partition = {}
+            for offset in range(0, len(message_data), RECORD_SIZE):
+                record = message_data[offset:offset + RECORD_SIZE]
+                partition = partition_for(int.from_bytes(record[:4], "little"), partitions)
+                records_by_partition.setdefault(partition, []).append(record)
+            for partition, records in records_by_partition.items():
+                split.setdefault(partition, []).append(b"".join(records))
+        else:
+            split.setdefault(partition_for(message_data["device_id"], partitions), []).append(message_data)
+    return split
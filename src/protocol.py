@@ -0,0 +1,203 @@
+"""
+Wire protocol spoken between IoT devices and the TCP server.
+
+A device opens a connection and sends a handshake line naming the data format it wants to use, either
+``GPS1 JSON\\n`` or ``GPS1 BIN\\n``. The server answers ``OK <format>\\n`` and from then on the device streams
+GPS fixes: newline-delimited JSON objects for ``JSON``, or fixed-width 24 byte records (see
+``src.gps_record``) for ``BIN``. Binary records are handed to the output queue as raw bytes. Frames are numbered
+implicitly from 1 in the order they are sent, and the server acknowledges them cumulatively with
+``ACK <seq>\\n`` once every frame up to and including ``seq`` has been queued. A malformed frame is answered
+with ``ERR <seq> <reason>\\n`` and the connection is closed.
+
+Connections that start with ``{`` are treated as legacy one-shot devices: the server reads a single JSON
+document (across as many reads as it takes), replies with a bare ``ACK`` and closes the connection.
+"""
+import json
+
+from src.gps_record import RECORD_SIZE
+
+PROTOCOL_VERSION = b"GPS1"
+FORMAT_JSON = b"JSON"
+FORMAT_BINARY = b"BIN"
+SUPPORTED_FORMATS = (FORMAT_JSON, FORMAT_BINARY)
+MAX_FRAME_SIZE = 64 * 1024
+LEGACY_ACK = b"ACK"
+
+
+class ProtocolError(Exception):
+    pass
+
+
+def encode_handshake(data_format: bytes = FORMAT_JSON) -> bytes:
+    return PROTOCOL_VERSION + b" " + data_format + b"\n"
+
+
+def encode_json_frame(gps_data: dict) -> bytes:
+    return json.dumps(gps_data, separators=(",", ":")).encode("utf-8") + b"\n"
+
+
+def encode_ack(seq: int) -> bytes:
+    return b"ACK %d\n" % seq
+
+
+def parse_ack(line: bytes) -> int:
+    parts = line.split()
+    if len(parts) == 2 and parts[0] == b"ACK":
+        return int(parts[1])
+    raise ProtocolError(f"Unexpected reply from server: {line!r}")
+
+
+class LineFrameDecoder:
+    """Splits a byte stream into newline-terminated frames, keeping any partial frame for the next feed."""
+
+    def __init__(self, max_frame_size: int = MAX_FRAME_SIZE):
+        self.max_frame_size = max_frame_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> list[bytes]:
+        self.buffer += data
+        end = self.buffer.rfind(b"\n")
+        if end == -1:
+            if len(self.buffer) > self.max_frame_size:
+                raise ProtocolError(f"Frame exceeds {self.max_frame_size} bytes")
+            return []
+        frames = bytes(self.buffer[:end]).split(b"\n")
+        del self.buffer[:end + 1]
+        return [frame for frame in frames if frame]
+
+    def flush(self) -> list[bytes]:
+        frames = [bytes(self.buffer)] if self.buffer.strip() else []
+        self.buffer.clear()
+        return frames
+
+
+class RecordFrameDecoder:
+    """Splits a byte stream into whole fixed-width records, returned together as one bytes object."""
+
+    def __init__(self, record_size: int = RECORD_SIZE):
+        self.record_size = record_size
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> bytes:
+        if not self.buffer and len(data) % self.record_size == 0:
+            return bytes(data)
+        self.buffer += data
+        end = len(self.buffer) - len(self.buffer) % self.record_size
+        records = bytes(self.buffer[:end])
+        del self.buffer[:end]
+        return records
+
+    def flush(self) -> bytes:
+        if self.buffer:
+            raise ProtocolError(f"Connection closed with a partial record of {len(self.buffer)} bytes")
+        return b""
+
+
+class DeviceSession:
+    """
+    Server side state of a single device connection, independent of how the socket is driven.
+
+    Args:
+        on_message: Called with every accepted fix as a dict (JSON) or with a bytes object holding one or
+            more records (BIN).
+    """
+
+    def __init__(self, on_message):
+        self.on_message = on_message
+        self.handshake_buffer = bytearray()
+        self.decoder = None
+        self.data_format = None
+        self.legacy_buffer = None
+        self.seq = 0
+        self.closed = False
+
+    def feed(self, data: bytes) -> bytes:
+        """Consumes bytes read from the socket and returns the reply to write back, if any."""
+        if self.data_format is not None:
+            return self._feed_frames(data)
+        if self.legacy_buffer is not None:
+            return self._feed_legacy(data)
+        if not self.handshake_buffer and data[:1] == b"{":
+            self.legacy_buffer = bytearray()
+            return self._feed_legacy(data)
+
+        self.handshake_buffer += data
+        end = self.handshake_buffer.find(b"\n")
+        if end == -1:
+            if len(self.handshake_buffer) > MAX_FRAME_SIZE:
+                raise ProtocolError("Handshake line is too long")
+            return b""
+        reply = self._handshake(bytes(self.handshake_buffer[:end]))
+        rest = bytes(self.handshake_buffer[end + 1:])
+        self.handshake_buffer.clear()
+        if rest and not self.closed:
+            reply += self._feed_frames(rest)
+        return reply
+
+    def feed_eof(self) -> bytes:
+        self.closed = True
+        if self.legacy_buffer:
+            return self._finish_legacy()
+        if self.data_format == FORMAT_JSON:
+            return self._accept_json_frames(self.decoder.flush())
+        if self.data_format == FORMAT_BINARY:
+            self.decoder.flush()
+        return b""
+
+    def _feed_frames(self, data: bytes) -> bytes:
+        if self.data_format == FORMAT_BINARY:
+            return self._accept_records(self.decoder.feed(data))
+        return self._accept_json_frames(self.decoder.feed(data))
+
+    def _accept_json_frames(self, frames: list[bytes]) -> bytes:
+        reply = b""
+        accepted = self.seq
+        for frame in frames:
+            try:
+                self.on_message(json.loads(frame))
+            except Exception as e:
+                self.closed = True
+                if accepted > self.seq:
+                    self.seq = accepted
+                    reply += encode_ack(accepted)
+                return reply + b"ERR %d %s\n" % (accepted + 1, type(e).__name__.encode())
+            accepted += 1
+        if accepted > self.seq:
+            self.seq = accepted
+            reply += encode_ack(accepted)
+        return reply
+
+    def _accept_records(self, records: bytes) -> bytes:
+        if not records:
+            return b""
+        self.on_message(records)
+        self.seq += len(records) // RECORD_SIZE
+        return encode_ack(self.seq)
+
+    def _handshake(self, line: bytes) -> bytes:
+        parts = line.split()
+        if len(parts) != 2 or parts[0] != PROTOCOL_VERSION or parts[1] not in SUPPORTED_FORMATS:
+            self.closed = True
+            return b"ERR 0 unsupported\n"
+        self.data_format = parts[1]
+        self.decoder = RecordFrameDecoder() if self.data_format == FORMAT_BINARY else LineFrameDecoder()
+        return b"OK " + self.data_format + b"\n"
+
+    def _feed_legacy(self, data: bytes) -> bytes:
+        self.legacy_buffer += data
+        if len(self.legacy_buffer) > MAX_FRAME_SIZE:
+            raise ProtocolError(f"Message exceeds {MAX_FRAME_SIZE} bytes")
+        try:
+            gps_data = json.loads(self.legacy_buffer)
+        except ValueError:
+            return b""
+        return self._reply_legacy(gps_data)
+
+    def _finish_legacy(self) -> bytes:
+        return self._reply_legacy(json.loads(self.legacy_buffer))
+
+    def _reply_legacy(self, gps_data: dict) -> bytes:
+        self.on_message(gps_data)
+        self.legacy_buffer = None
+        self.closed = True
+        return LEGACY_ACK
@@ -1,12 +1,39 @@
+import time
 from datetime import datetime
-from typing import List, Optional
+from enum import Enum
+from inspect import isawaitable
+from typing import Annotated, AsyncGenerator, List, Optional
 
+import numpy as np
 import strawberry
-from sqlalchemy.orm import Session
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 from strawberry import Info
+from strawberry.extensions import SchemaExtension
+from strawberry.extensions.tracing.utils import should_skip_tracing
 
+from src.dataloaders import get_loaders
+from src.last_location_cache import LastLocationCache
+from src.location_store import ColumnarLocationStore
+from src.location_subscriptions import BoundingBox, LocationSubscriptionHub
+from src.metrics import Counter, Histogram
 from src.model import Device
-from src.sql_query import get_location_history_by_device, get_last_location_for_all_devices
+from src.sql_query import get_location_history_by_device_async, get_last_location_for_all_devices_async, \
+    encode_location_cursor, encode_cursor, decode_location_cursor, get_location_history_columns_async, \
+    get_nearby_last_locations_async, get_last_locations_in_box_async, get_last_location_by_device_async, \
+    get_raw_history_start_async, insert_devices_async, delete_devices_async, delete_device_locations_async, \
+    INSERT_CHUNK_SIZE
+from src.trajectory import BUCKET_AVERAGE, BUCKET_LAST, bucket, douglas_peucker
+
+DEFAULT_PAGE_SIZE = 100
+MAX_PAGE_SIZE = 1000
+DEFAULT_RECENT_LOCATIONS = 10
+MAX_SIMPLIFY_INPUT = 100_000
+MAX_BULK_DEVICES = 100_000
+MAX_DEVICE_NAME_LENGTH = Device.name.type.length
+
+RESOLVER_SECONDS = Histogram("graphql_resolver_seconds", "Time spent in GraphQL resolvers.", ("field",))
+RESOLVER_ERRORS = Counter("graphql_resolver_errors_total", "GraphQL resolvers that raised an error.", ("field",))
 
 
 @strawberry.type(name="Device")
@@ -14,6 +41,19 @@ class DeviceType:
     id: int
     name: str
 
+    @strawberry.field
+    async def last_location(self, info: Info) -> Optional["LocationType"]:
+        cache: LastLocationCache = info.context.get("last_locations")
+        if cache is not None and cache.is_fresh():
+            return cache.get(self.id)
+        return await get_loaders(info.context).last_location.load(self.id)
+
+    @strawberry.field
+    async def recent_locations(self, info: Info, limit: int = DEFAULT_RECENT_LOCATIONS) -> List["LocationType"]:
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise Exception(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        return await get_loaders(info.context).recent_locations.load((self.id, limit))
+
 
 @strawberry.type(name="Location")
 class LocationType:
@@ -22,6 +62,48 @@ class LocationType:
     longitude: float
     timestamp: datetime
 
+    @strawberry.field
+    async def device(self, info: Info) -> Optional[DeviceType]:
+        return await get_loaders(info.context).device.load(self.device_id)
+
+
+@strawberry.type(name="NearbyLocation")
+class NearbyLocationType(LocationType):
+    distance_meters: float
+
+
+@strawberry.type(name="PageInfo")
+class PageInfoType:
+    has_next_page: bool
+    end_cursor: Optional[str]
+
+
+@strawberry.type(name="LocationEdge")
+class LocationEdgeType:
+    cursor: str
+    node: LocationType
+
+
+@strawberry.type(name="LocationConnection")
+class LocationConnectionType:
+    edges: List[LocationEdgeType]
+    page_info: PageInfoType
+
+
+@strawberry.type(name="DeviceConflict")
+class DeviceConflictType:
+    """An input of a bulk mutation that was skipped; index is its position in the inputs."""
+    index: int
+    id: Optional[int]
+    name: Optional[str]
+    reason: str
+
+
+@strawberry.type(name="BulkDeviceResult")
+class BulkDeviceResultType:
+    devices: List[DeviceType]
+    conflicts: List[DeviceConflictType]
+
 
 @strawberry.input
 class DeviceCreateInput:
@@ -33,71 +115,335 @@ class DeviceDeleteInput:
     id: int
 
 
+@strawberry.enum
+class BucketMode(Enum):
+    LAST = BUCKET_LAST
+    AVERAGE = BUCKET_AVERAGE
+
+
+@strawberry.input
+class SimplifyInput:
+    """Either a Douglas-Peucker tolerance in meters, or a time bucket keeping the last or average position."""
+    tolerance_meters: Optional[float] = None
+    bucket_seconds: Optional[int] = None
+    bucket_mode: BucketMode = BucketMode.LAST
+
+
+@strawberry.input
+class BoundingBoxInput:
+    min_latitude: float
+    min_longitude: float
+    max_latitude: float
+    max_longitude: float
+
+
+async def simplified_location_history(session: AsyncSession, device_id: int, start: Optional[datetime],
+                                      end: Optional[datetime], first: int, after: Optional[str],
+                                      simplify: SimplifyInput, raw_since: Optional[datetime] = None,
+                                      store: ColumnarLocationStore = None) -> LocationConnectionType:
+    """
+    Simplifies up to MAX_SIMPLIFY_INPUT raw fixes following the cursor and returns the first simplified points.
+
+    Every returned point carries the cursor of the raw fix it ends at, so the next page continues behind it.
+    """
+    if (simplify.tolerance_meters is None) == (simplify.bucket_seconds is None):
+        raise Exception("simplify needs either toleranceMeters or bucketSeconds")
+    if (simplify.tolerance_meters or 1) <= 0 or (simplify.bucket_seconds or 1) <= 0:
+        raise Exception("toleranceMeters and bucketSeconds must be positive")
+    # The page starts at the fix the previous page ended at, so simplification continues from the same point.
+    anchor = decode_location_cursor(after) if after else None
+    columns = await get_location_history_columns_async(device_id, session, start=start, end=end,
+                                                       after=(anchor[0], anchor[1] - 1) if anchor else None,
+                                                       limit=MAX_SIMPLIFY_INPUT + 1, raw_since=raw_since, store=store)
+    truncated = len(columns) > MAX_SIMPLIFY_INPUT
+    # Only the returned points are turned into Python objects.
+    ids, timestamps, latitudes, longitudes = (column[:MAX_SIMPLIFY_INPUT] for column in columns)
+    if simplify.tolerance_meters is not None:
+        kept, latitudes, longitudes = douglas_peucker(latitudes, longitudes, simplify.tolerance_meters)
+    else:
+        seconds = timestamps.astype("datetime64[s]", copy=False).view(np.int64)
+        kept, latitudes, longitudes = bucket(seconds, latitudes, longitudes, simplify.bucket_seconds,
+                                             simplify.bucket_mode.value)
+    points = list(zip(kept.tolist(), latitudes.tolist(), longitudes.tolist()))
+    if anchor and points and ids[points[0][0]] == anchor[1]:
+        points = points[1:]
+    if truncated and len(points) > 1:
+        # The last point only ends the truncated input; the next page picks up from the one before it.
+        points = points[:-1]
+    edges = [
+        LocationEdgeType(
+            cursor=encode_cursor(timestamps[index].item(), int(ids[index])),
+            node=LocationType(
+                device_id=device_id,
+                latitude=latitude,
+                longitude=longitude,
+                timestamp=timestamps[index].item()
+            )
+        ) for index, latitude, longitude in points[:first]
+    ]
+    return LocationConnectionType(
+        edges=edges,
+        page_info=PageInfoType(has_next_page=len(points) > first or truncated,
+                               end_cursor=edges[-1].cursor if edges else None)
+    )
+
+
 @strawberry.type
 class Query:
     @strawberry.field
-    def all_devices(self, info: Info) -> List[DeviceType]:
-        session: Session = info.context['db']
-        devices = session.query(Device).all()
+    async def all_devices(self, info: Info) -> List[DeviceType]:
+        session: AsyncSession = info.context['db']
+        devices = (await session.execute(select(Device))).scalars().all()
         return [DeviceType(id=device.id, name=device.name) for device in devices]
 
     @strawberry.field
-    def device_by_id(self, info: Info, device_id: int) -> Optional[DeviceType]:
-        session: Session = info.context['db']
-        device = session.query(Device).filter(Device.id == device_id).first()
+    async def device_by_id(self, info: Info, device_id: int) -> Optional[DeviceType]:
+        session: AsyncSession = info.context['db']
+        device = await session.get(Device, device_id)
         if device:
             return DeviceType(id=device.id, name=device.name)
         return None
 
     @strawberry.field
-    def device_by_name(self, info: Info, device_name: str) -> Optional[DeviceType]:
-        session: Session = info.context['db']
-        device = session.query(Device).filter(Device.name == device_name).first()
+    async def device_by_name(self, info: Info, device_name: str) -> Optional[DeviceType]:
+        session: AsyncSession = info.context['db']
+        device = (await session.execute(select(Device).where(Device.name == device_name))).scalars().first()
         if device:
             return DeviceType(id=device.id, name=device.name)
         return None
 
     @strawberry.field
-    def location_history_by_device(self, info: Info, device_id: int) -> List[LocationType]:
-        session: Session = info.context['db']
-        locations = get_location_history_by_device(device_id, session)
+    async def location_history_by_device(
+            self, info: Info, device_id: int,
+            from_: Annotated[Optional[datetime], strawberry.argument(name="from")] = None,
+            to: Optional[datetime] = None,
+            first: int = DEFAULT_PAGE_SIZE,
+            after: Optional[str] = None,
+            simplify: Optional[SimplifyInput] = None,
+    ) -> LocationConnectionType:
+        if not 0 < first <= MAX_PAGE_SIZE:
+            raise Exception(f"first must be between 1 and {MAX_PAGE_SIZE}")
+        session: AsyncSession = info.context['db']
+        # Beyond the raw retention window, history is served from the hourly rollups.
+        raw_since = await get_raw_history_start_async(session, info.context.get("raw_retention_days"), from_)
+        store = info.context.get("location_store")
+        if simplify is not None:
+            return await simplified_location_history(session, device_id, from_, to, first, after, simplify,
+                                                     raw_since, store)
+        locations = await get_location_history_by_device_async(device_id, session, start=from_, end=to,
+                                                               after=decode_location_cursor(after) if after else None,
+                                                               limit=first + 1, raw_since=raw_since, store=store)
+        edges = [
+            LocationEdgeType(
+                cursor=encode_location_cursor(loc),
+                node=LocationType(
+                    device_id=loc.device_id,
+                    latitude=loc.latitude,
+                    longitude=loc.longitude,
+                    timestamp=loc.timestamp
+                )
+            ) for loc in locations[:first]
+        ]
+        return LocationConnectionType(
+            edges=edges,
+            page_info=PageInfoType(has_next_page=len(locations) > first,
+                                   end_cursor=edges[-1].cursor if edges else None)
+        )
+
+    @strawberry.field
+    async def last_locations(self, info: Info) -> List[LocationType]:
+        cache: LastLocationCache = info.context.get("last_locations")
+        if cache is not None and cache.is_fresh():
+            return cache.all()
+        session: AsyncSession = info.context['db']
+        last_locations = await get_last_location_for_all_devices_async(session)
+        return last_locations
+
+    @strawberry.field
+    async def last_location_by_device(self, info: Info, device_id: int) -> Optional[LocationType]:
+        cache: LastLocationCache = info.context.get("last_locations")
+        if cache is not None and cache.is_fresh():
+            return cache.get(device_id)
+        session: AsyncSession = info.context['db']
+        return await get_last_location_by_device_async(device_id, session)
+
+    @strawberry.field
+    async def nearby_devices(self, info: Info, latitude: float, longitude: float, radius_meters: float,
+                             limit: int = DEFAULT_PAGE_SIZE) -> List[NearbyLocationType]:
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise Exception(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        session: AsyncSession = info.context['db']
+        nearby = await get_nearby_last_locations_async(session, latitude, longitude, radius_meters, limit)
         return [
-            LocationType(
-                id=loc.id,
+            NearbyLocationType(
                 device_id=loc.device_id,
                 latitude=loc.latitude,
                 longitude=loc.longitude,
-                timestamp=loc.timestamp
-            ) for loc in locations
+                timestamp=loc.timestamp,
+                distance_meters=distance
+            ) for loc, distance in nearby
         ]
 
     @strawberry.field
-    def last_locations(self, info: Info) -> List[LocationType]:
-        session: Session = info.context['db']
-        last_locations = get_last_location_for_all_devices(session)
-        return last_locations
+    async def devices_in_bounding_box(self, info: Info, min_latitude: float, min_longitude: float, max_latitude: float,
+                                      max_longitude: float, limit: int = MAX_PAGE_SIZE) -> List[LocationType]:
+        if not 0 < limit <= MAX_PAGE_SIZE:
+            raise Exception(f"limit must be between 1 and {MAX_PAGE_SIZE}")
+        session: AsyncSession = info.context['db']
+        return await get_last_locations_in_box_async(session, min_latitude, min_longitude, max_latitude, max_longitude,
+                                                     limit)
 
 
 @strawberry.type
 class Mutation:
     @strawberry.mutation
-    def create_device(self, info: Info, input: DeviceCreateInput) -> DeviceType:
-        session: Session = info.context['db']
+    async def create_device(self, info: Info, input: DeviceCreateInput) -> DeviceType:
+        session: AsyncSession = info.context['db']
         db_device = Device(name=input.name)
         session.add(db_device)
-        session.commit()
+        await session.commit()
+        if device_events := info.context.get("device_events"):
+            device_events.device_created([db_device.id])
         return DeviceType(id=db_device.id, name=db_device.name)
 
     @strawberry.mutation
-    def delete_device(self, info: Info, input: DeviceDeleteInput) -> DeviceType:
-        session: Session = info.context['db']
-        device_to_delete = session.get(Device, input.id)
+    async def delete_device(self, info: Info, input: DeviceDeleteInput) -> DeviceType:
+        session: AsyncSession = info.context['db']
+        device_to_delete = await session.get(Device, input.id)
         if not device_to_delete:
             raise Exception("Device with ID %d not found" % input.id)
         try:
-            session.delete(device_to_delete)
-            session.commit()
+            await delete_device_locations_async([device_to_delete.id], session)
+            await session.delete(device_to_delete)
+            await session.commit()
+            if device_events := info.context.get("device_events"):
+                device_events.device_deleted([device_to_delete.id])
+            if store := info.context.get("location_store"):
+                store.mark_deleted(device_to_delete.id)
             return DeviceType(id=device_to_delete.id, name=device_to_delete.name)
         except Exception as e:
-            session.rollback()
+            await session.rollback()
             raise Exception(f"Error deleting device: {str(e)}")
+
+    @strawberry.mutation
+    async def create_devices(self, info: Info, inputs: List[DeviceCreateInput]) -> BulkDeviceResultType:
+        """
+        Creates devices with one multi-row insert and commit per chunk. Names that already exist, repeat an
+        earlier input or are too long are reported as conflicts and the other devices are still created.
+        """
+        if len(inputs) > MAX_BULK_DEVICES:
+            raise Exception(f"At most {MAX_BULK_DEVICES} devices can be created at once")
+        session: AsyncSession = info.context['db']
+        device_events = info.context.get("device_events")
+        devices, conflicts, pending, seen = [], [], [], set()
+        for index, device_input in enumerate(inputs):
+            if len(device_input.name) > MAX_DEVICE_NAME_LENGTH:
+                conflicts.append(DeviceConflictType(index=index, id=None, name=device_input.name,
+                                                    reason=f"name is longer than {MAX_DEVICE_NAME_LENGTH} characters"))
+            elif device_input.name in seen:
+                conflicts.append(DeviceConflictType(index=index, id=None, name=device_input.name,
+                                                    reason="name is repeated in the inputs"))
+            else:
+                seen.add(device_input.name)
+                pending.append((index, device_input.name))
+        for start in range(0, len(pending), INSERT_CHUNK_SIZE):
+            chunk = pending[start:start + INSERT_CHUNK_SIZE]
+            created = await insert_devices_async([name for _, name in chunk], session)
+            await session.commit()
+            if device_events and created:
+                device_events.device_created(list(created.values()))
+            for index, name in chunk:
+                if name in created:
+                    devices.append(DeviceType(id=created[name], name=name))
+                else:
+                    conflicts.append(DeviceConflictType(index=index, id=None, name=name,
+                                                        reason="a device with this name already exists"))
+        return BulkDeviceResultType(devices=devices, conflicts=sorted(conflicts, key=lambda conflict: conflict.index))
+
+    @strawberry.mutation
+    async def delete_devices(self, info: Info, inputs: List[DeviceDeleteInput]) -> BulkDeviceResultType:
+        """Deletes devices with one statement and commit per chunk; unknown ids are reported as conflicts."""
+        if len(inputs) > MAX_BULK_DEVICES:
+            raise Exception(f"At most {MAX_BULK_DEVICES} devices can be deleted at once")
+        session: AsyncSession = info.context['db']
+        device_events = info.context.get("device_events")
+        devices, conflicts, pending, seen = [], [], [], set()
+        for index, device_input in enumerate(inputs):
+            if device_input.id in seen:
+                conflicts.append(DeviceConflictType(index=index, id=device_input.id, name=None,
+                                                    reason="id is repeated in the inputs"))
+            else:
+                seen.add(device_input.id)
+                pending.append((index, device_input.id))
+        for start in range(0, len(pending), INSERT_CHUNK_SIZE):
+            chunk = pending[start:start + INSERT_CHUNK_SIZE]
+            deleted = {device.id: device.name
+                       for device in await delete_devices_async([device_id for _, device_id in chunk], session)}
+            await session.commit()
+            if device_events and deleted:
+                device_events.device_deleted(list(deleted))
+            if store := info.context.get("location_store"):
+                for device_id in deleted:
+                    store.mark_deleted(device_id)
+            for index, device_id in chunk:
+                if device_id in deleted:
+                    devices.append(DeviceType(id=device_id, name=deleted[device_id]))
+                else:
+                    conflicts.append(DeviceConflictType(index=index, id=device_id, name=None,
+                                                        reason="device not found"))
+        return BulkDeviceResultType(devices=devices, conflicts=sorted(conflicts, key=lambda conflict: conflict.index))
+
+
+@strawberry.type
+class Subscription:
+    @strawberry.subscription
+    async def location_updates(
+            self, info: Info, device_ids: Optional[List[int]] = None, bounding_box: Optional[BoundingBoxInput] = None
+    ) -> AsyncGenerator[List[LocationType], None]:
+        """Streams the newest positions of the given devices, or of the devices inside a box, once per window."""
+        if (device_ids is None) == (bounding_box is None):
+            raise Exception("Pass either deviceIds or boundingBox")
+        hub: LocationSubscriptionHub = info.context.get("location_updates")
+        if hub is None:
+            raise Exception("Location updates are not available")
+        box = BoundingBox(bounding_box.min_latitude, bounding_box.min_longitude, bounding_box.max_latitude,
+                          bounding_box.max_longitude) if bounding_box is not None else None
+        async for locations in hub.subscribe(device_ids=device_ids, bounding_box=box):
+            yield locations
+
+
+class ResolverMetrics(SchemaExtension):
+    """Times every resolver of the schema's own types, labelled as ``Type.field``; default resolvers are skipped."""
+
+    # (type name, field name) -> (histogram, error counter), or None for fields that aren't timed.
+    timers = {}
+
+    def resolve(self, _next, root, info: Info, *args, **kwargs):
+        key = (info.parent_type.name, info.field_name)
+        timer = self.timers.get(key, False)
+        if timer is False:
+            field = ".".join(key)
+            timer = self.timers[key] = None if should_skip_tracing(_next, info) else (
+                RESOLVER_SECONDS.labels(field), RESOLVER_ERRORS.labels(field))
+        if timer is None:
+            return _next(root, info, *args, **kwargs)
+        started = time.perf_counter()
+        try:
+            result = _next(root, info, *args, **kwargs)
+        except Exception:
+            timer[1].inc()
+            raise
+        if isawaitable(result):
+            return self.observe_async(result, timer, started)
+        timer[0].observe(time.perf_counter() - started)
+        return result
+
+    @staticmethod
+    async def observe_async(result, timer: tuple, started: float):
+        try:
+            return await result
+        except Exception:
+            timer[1].inc()
+            raise
+        finally:
+            timer[0].observe(time.perf_counter() - started)
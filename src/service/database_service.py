@@ -3,19 +3,62 @@ import os
 import time
 
 from sqlalchemy import create_engine
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker, Session
 
 from src.model import Base
 
 logger = logging.getLogger(__name__)
 
+DEFAULT_POOL_SIZE = 10
+DEFAULT_MAX_OVERFLOW = 10
+DEFAULT_POOL_TIMEOUT = 10
+DEFAULT_POOL_RECYCLE = 3600
+DEFAULT_CONNECT_TIMEOUT = 10
+ASYNC_DRIVERS = {"mysql": "aiomysql", "sqlite": "aiosqlite"}
+
+
+def async_database_url(database_url: str) -> str:
+    """Returns the URL of the same database with the dialect's asyncio driver, e.g. mysql+aiomysql."""
+    url = make_url(database_url)
+    backend = url.get_backend_name()
+    if backend not in ASYNC_DRIVERS:
+        raise ValueError(f"No asyncio driver configured for {backend}")
+    return str(url.set(drivername=f"{backend}+{ASYNC_DRIVERS[backend]}"))
+
 
 class DatabaseService:
-    def __init__(self, database_url=None):
+    """
+    Creates the engines and session factories of a database.
+
+    ``session_local`` opens blocking sessions. With ``use_async`` the same database is also reachable through
+    ``async_session_local``, which opens ``AsyncSession`` objects on the dialect's asyncio driver, so web
+    requests waiting on a slow query don't block the event loop. Both engines get an explicit connection pool:
+    at most ``pool_size + max_overflow`` connections each, ``pool_timeout`` seconds to wait for a free one and
+    ``connect_timeout`` seconds to establish a new one. SQLite databases keep SQLAlchemy's default pools.
+    """
+
+    def __init__(self, database_url=None, use_async: bool = False, pool_size: int = DEFAULT_POOL_SIZE,
+                 max_overflow: int = DEFAULT_MAX_OVERFLOW, pool_timeout: float = DEFAULT_POOL_TIMEOUT,
+                 pool_recycle: float = DEFAULT_POOL_RECYCLE, connect_timeout: float = DEFAULT_CONNECT_TIMEOUT):
+        self.async_session_local = None
         if database_url:
-            engine = create_engine(database_url)
+            if make_url(database_url).get_backend_name() == "sqlite":
+                engine_options = {}
+                # FastAPI closes sync sessions from a different worker thread than the one that used them.
+                engine = create_engine(database_url, connect_args={"check_same_thread": False})
+            else:
+                engine_options = {"pool_size": pool_size, "max_overflow": max_overflow, "pool_timeout": pool_timeout,
+                                  "pool_recycle": pool_recycle, "pool_pre_ping": True,
+                                  "connect_args": {"connect_timeout": connect_timeout}}
+                engine = create_engine(database_url, **engine_options)
             self.session_local = sessionmaker(autocommit=False, autoflush=False, bind=engine)
             Base.metadata.create_all(bind=engine)
+            if use_async:
+                async_engine = create_async_engine(async_database_url(database_url), **engine_options)
+                self.async_session_local = sessionmaker(autocommit=False, autoflush=False, bind=async_engine,
+                                                        class_=AsyncSession, expire_on_commit=False)
 
     def get_db(self):
         db: Session = self.session_local()
@@ -25,12 +68,19 @@ class DatabaseService:
             if hasattr(db, "close"):
                 db.close()
 
+    async def get_async_db(self):
+        db: AsyncSession = self.async_session_local()
+        try:
+            yield db
+        finally:
+            await db.close()
+
 
-def connect_to_db(database_url) -> DatabaseService:
+def connect_to_db(database_url, **kwargs) -> DatabaseService:
     while True:
         try:
             logger.info("Trying to connect to DB.")
-            database_service = DatabaseService(database_url=database_url)
+            database_service = DatabaseService(database_url=database_url, **kwargs)
             logger.info("Connected to DB.")
             break
         except Exception as e:
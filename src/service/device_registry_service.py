@@ -0,0 +1,85 @@
+import json
+import logging
+import threading
+import time
+
+import pika
+from sqlalchemy import select
+
+from src.device_registry import DeviceRegistry
+from src.model import Device
+from src.service.database_service import DatabaseService
+from src.service.publisher_service import DEVICE_CREATED
+
+logger = logging.getLogger(__name__)
+
+
+class DeviceRegistrySync:
+    """
+    Keeps a DeviceRegistry up to date from the device events fanout exchange and periodic full resyncs.
+
+    Every consumer binds its own exclusive queue to the exchange, so all TCP servers and processor workers see
+    every event. After the event connection is (re)established the registry is resynced from the database to
+    cover events that were missed while disconnected.
+    """
+
+    def __init__(self, registry: DeviceRegistry, database_service: DatabaseService, rabbitmq_host, rabbitmq_port,
+                 exchange: str, resync_interval: float = 300):
+        self.registry = registry
+        self.database_service = database_service
+        self.rabbitmq_connection_parameters = pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port)
+        self.exchange = exchange
+        self.resync_interval = resync_interval
+
+    def resync(self, connection: pika.BlockingConnection = None):
+        """Reloads the registry; with the event connection, the events queued on it are applied first."""
+        def load_device_ids():
+            if connection is not None:
+                connection.process_data_events(time_limit=0)
+            with self.database_service.session_local() as db:
+                return db.execute(select(Device.id)).scalars().all()
+
+        device_ids = self.registry.resync(load_device_ids)
+        logger.info(f"Device registry resynced with {len(device_ids)} devices")
+
+    def on_event(self, channel, method, properties, body):
+        try:
+            event = json.loads(body)
+            for device_id in event["device_ids"]:
+                self.registry.apply(device_id, event["event"] == DEVICE_CREATED)
+        except Exception:
+            logger.exception(f"Error: unable to apply device event: {body}")
+
+    def listen_events(self):
+        connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
+        channel = connection.channel()
+        channel.exchange_declare(exchange=self.exchange, exchange_type='fanout')
+        result = channel.queue_declare(queue='', exclusive=True)
+        channel.queue_bind(exchange=self.exchange, queue=result.method.queue)
+        channel.basic_consume(queue=result.method.queue, auto_ack=True, on_message_callback=self.on_event)
+        # Events are consumed from here on, so every event after the resync's snapshot is either recorded and
+        # replayed by it or applied after it.
+        self.resync(connection)
+        channel.start_consuming()
+
+    def listen_events_forever(self):
+        while True:
+            try:
+                self.listen_events()
+            except Exception:
+                logger.exception("Error occurred while listening to device events:")
+                time.sleep(1)
+
+    def resync_forever(self):
+        while True:
+            time.sleep(self.resync_interval)
+            try:
+                self.resync()
+            except Exception:
+                logger.exception("Error occurred while resyncing the device registry:")
+
+    def start(self):
+        """Loads the registry once and keeps it fresh from background threads."""
+        self.resync()
+        threading.Thread(target=self.listen_events_forever, daemon=True).start()
+        threading.Thread(target=self.resync_forever, daemon=True).start()
@@ -0,0 +1,98 @@
+import json
+import logging
+import threading
+import time
+from datetime import datetime
+
+import pika
+
+from src.gps_record import CONTENT_TYPE_RECORDS, decode_records
+from src.last_location_cache import CachedLocation, LastLocationCache
+from src.service.database_service import DatabaseService
+from src.service.publisher_service import DEVICE_DELETED
+from src.sql_query import get_last_location_for_all_devices
+
+logger = logging.getLogger(__name__)
+
+
+class LastLocationCacheSync:
+    """
+    Keeps a LastLocationCache up to date from the location updates the data processor publishes after each commit.
+
+    The same exclusive queue is bound to the device events exchange, so deleted devices disappear from the cache.
+    After the connection is (re)established the cache is reloaded from the database to cover updates that were
+    missed while disconnected, and it is reloaded every ``reload_interval`` seconds to repair dropped updates.
+    While connected, the cache is marked as synced at least every ``heartbeat_interval`` seconds. Every batch of
+    updates is also passed to the ``listeners``, e.g. the GraphQL subscription hub.
+    """
+
+    def __init__(self, cache: LastLocationCache, database_service: DatabaseService, rabbitmq_host, rabbitmq_port,
+                 exchange: str, device_events_exchange: str, reload_interval: float = 300,
+                 heartbeat_interval: float = 1, listeners: list = ()):
+        self.cache = cache
+        self.database_service = database_service
+        self.rabbitmq_connection_parameters = pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port)
+        self.exchange = exchange
+        self.device_events_exchange = device_events_exchange
+        self.reload_interval = reload_interval
+        self.heartbeat_interval = heartbeat_interval
+        self.listeners = list(listeners)
+
+    def reload(self):
+        def load_locations():
+            with self.database_service.session_local() as db:
+                return [CachedLocation(location.device_id, location.latitude, location.longitude, location.timestamp)
+                        for location in get_last_location_for_all_devices(db)]
+
+        locations = self.cache.reload(load_locations)
+        logger.info(f"Last location cache reloaded with {len(locations)} devices")
+
+    def on_message(self, body: bytes, content_type: str):
+        try:
+            if content_type == CONTENT_TYPE_RECORDS:
+                locations = [CachedLocation(device_id, latitude, longitude, datetime.utcfromtimestamp(timestamp))
+                             for device_id, timestamp, latitude, longitude in decode_records(body)]
+                self.cache.update(locations)
+                for listener in self.listeners:
+                    listener(locations)
+            else:
+                event = json.loads(body)
+                if event["event"] == DEVICE_DELETED:
+                    self.cache.remove(event["device_ids"])
+        except Exception:
+            logger.exception(f"Error: unable to apply location update: {body}")
+
+    def listen_updates(self):
+        connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
+        channel = connection.channel()
+        result = channel.queue_declare(queue='', exclusive=True)
+        for exchange in (self.exchange, self.device_events_exchange):
+            channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+            channel.queue_bind(exchange=exchange, queue=result.method.queue)
+        self.reload()
+        for method, properties, body in channel.consume(result.method.queue, auto_ack=True,
+                                                        inactivity_timeout=self.heartbeat_interval):
+            self.cache.mark_synced()
+            if method is not None:
+                self.on_message(body, properties.content_type)
+
+    def listen_updates_forever(self):
+        while True:
+            try:
+                self.listen_updates()
+            except Exception:
+                logger.exception("Error occurred while listening to location updates:")
+                time.sleep(1)
+
+    def reload_forever(self):
+        while True:
+            time.sleep(self.reload_interval)
+            try:
+                self.reload()
+            except Exception:
+                logger.exception("Error occurred while reloading the last location cache:")
+
+    def start(self):
+        """Keeps the cache fresh from background threads; it is served once the update feed is connected."""
+        threading.Thread(target=self.listen_updates_forever, daemon=True).start()
+        threading.Thread(target=self.reload_forever, daemon=True).start()
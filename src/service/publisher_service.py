@@ -1,30 +1,128 @@
+import calendar
 import json
 import logging
+import queue
+import threading
+import time
 
-import pika
+from src.gps_record import CONTENT_TYPE_JSON, CONTENT_TYPE_RECORDS, encode_record
+from src.metrics import Counter, Histogram
+from src.service.transport_service import RabbitMQTransport, Transport
+from src.structured_logging import EventLogger
 
 logger = logging.getLogger(__name__)
+published_log = EventLogger(logger, "batch_published")
+
+DEVICE_CREATED = "created"
+DEVICE_DELETED = "deleted"
+
+PUBLISH_SECONDS = Histogram("broker_publish_seconds", "Time to publish a batch until the transport took it.")
+PUBLISHED_MESSAGES = Counter("broker_published_messages_total", "Messages published in batches to the transport.")
 
 
 class RabbitMQPublisherService:
-    def __init__(self, rabbitmq_host, rabbitmq_port, queues_to_declare: list = None):
-        self.rabbitmq_connection_parameters = pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port)
-        self.declared_queues = set()
-        if queues_to_declare:
-            queues_to_declare = set(queues_to_declare)
-            connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
-            channel = connection.channel()
-            for queue_name in queues_to_declare:
-                channel.queue_declare(queue=queue_name)
-            self.declared_queues = queues_to_declare
+    """
+    Publishes GPS messages through a transport, by default RabbitMQ with publisher confirms, see
+    src.service.transport_service.
+    """
+
+    def __init__(self, rabbitmq_host, rabbitmq_port, queues_to_declare: list = None, max_retries: int = 5,
+                 retry_interval: float = 1, transport: Transport = None):
+        self.transport = transport or RabbitMQTransport(rabbitmq_host, rabbitmq_port,
+                                                        queues_to_declare=queues_to_declare,
+                                                        max_retries=max_retries, retry_interval=retry_interval)
 
     def publish(self, queue_name, message_data):
-        connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
-        channel = connection.channel()
-        if queue_name not in self.declared_queues:
-            channel.queue_declare(queue=queue_name)
-            self.declared_queues.add(queue_name)
-
-        body = json.dumps(message_data).encode()
-        channel.basic_publish(exchange='', routing_key=queue_name, body=json.dumps(message_data).encode())
-        logger.info(f"RabbitMQ publisher sent: {body}")
+        self.publish_batch(queue_name, [message_data])
+
+    def publish_batch(self, queue_name, messages: list):
+        """
+        Publishes messages as few transport messages as possible and waits for the transport to take them.
+
+        Consecutive binary record batches are concatenated into one body and consecutive JSON fixes are sent
+        as one JSON list, so the order of fixes is preserved. Raises the last error if the batch still could
+        not be handed over after ``max_retries`` reconnects.
+        """
+        started = time.perf_counter()
+        bodies = encode_batch(messages)
+        self.transport.publish(queue_name, bodies)
+        PUBLISH_SECONDS.observe(time.perf_counter() - started)
+        PUBLISHED_MESSAGES.inc(len(messages))
+        published_log.info("Publisher sent %d messages in %d bodies", len(messages), len(bodies))
+
+    def publish_to_exchange(self, exchange, message_data):
+        """Publishes a JSON message to a fanout exchange, declaring it if needed."""
+        self.transport.publish_to_exchange(exchange, [encode_batch([message_data])[0]])
+
+    def close(self):
+        self.transport.close()
+
+
+class ExchangePublisher(RabbitMQPublisherService):
+    """
+    Publishes messages to a fanout exchange from a background thread.
+
+    Callers never block on the broker. Messages that can't be delivered, or that don't fit in a full backlog of
+    ``max_pending`` messages, are dropped; consumers of the exchange periodically resync from the database anyway.
+    """
+
+    def __init__(self, exchange, *args, max_pending: int = 0, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.exchange = exchange
+        self.events = queue.Queue(max_pending)
+        threading.Thread(target=self.publish_events, daemon=True).start()
+
+    def submit(self, message_data):
+        try:
+            self.events.put_nowait(message_data)
+        except queue.Full:
+            logger.warning(f"Dropping message for exchange {self.exchange}, {self.events.qsize()} are pending")
+
+    def publish_events(self):
+        while True:
+            event = self.events.get()
+            try:
+                self.publish_to_exchange(self.exchange, event)
+            except Exception as e:
+                logger.error(f"Dropping message for exchange {self.exchange}: {e!r}")
+
+
+class DeviceEventPublisher(ExchangePublisher):
+    """Announces device registrations and deletions on a fanout exchange."""
+
+    def device_created(self, device_ids: list[int]):
+        self.submit({"event": DEVICE_CREATED, "device_ids": device_ids})
+
+    def device_deleted(self, device_ids: list[int]):
+        self.submit({"event": DEVICE_DELETED, "device_ids": device_ids})
+
+
+class LocationUpdatePublisher(ExchangePublisher):
+    """Announces the newest stored position of each device as binary records, see src.gps_record."""
+
+    def __init__(self, exchange, *args, max_pending: int = 1000, **kwargs):
+        super().__init__(exchange, *args, max_pending=max_pending, **kwargs)
+
+    def locations_saved(self, rows: list[dict]):
+        self.submit(b"".join(encode_record({**row, "timestamp": calendar.timegm(row["timestamp"].timetuple())})
+                             for row in rows))
+
+
+def encode_batch(messages: list) -> list[tuple[bytes, str]]:
+    """Groups consecutive messages of the same kind into (body, content_type) pairs."""
+    bodies = []
+    run = []
+    for message_data in messages:
+        if run and isinstance(message_data, bytes) != isinstance(run[0], bytes):
+            bodies.append(_encode_run(run))
+            run = []
+        run.append(message_data)
+    if run:
+        bodies.append(_encode_run(run))
+    return bodies
+
+
+def _encode_run(run: list) -> tuple[bytes, str]:
+    if isinstance(run[0], bytes):
+        return b"".join(run), CONTENT_TYPE_RECORDS
+    return json.dumps(run[0] if len(run) == 1 else run).encode(), CONTENT_TYPE_JSON
@@ -0,0 +1,200 @@
+import logging
+import re
+import threading
+import time
+from datetime import date, datetime, timedelta
+from typing import Optional
+
+from sqlalchemy import text
+from sqlalchemy.orm import Session
+
+from src.location_store import ColumnarLocationStore
+from src.service.database_service import DatabaseService
+from src.sql_query import ROLLUP_PERIOD, delete_locations_before, delete_rollups_before, \
+    get_next_location_timestamp, get_rollup_watermark, retention_cutoff, rollup_locations
+
+logger = logging.getLogger(__name__)
+
+PARTITION_NAME_FORMAT = "before_%Y%m%d"
+PARTITION_NAME_PATTERN = re.compile(r"before_\d{8}")
+MAX_PARTITION = "pmax"
+
+
+def partition_name(day: date) -> str:
+    return day.strftime(PARTITION_NAME_FORMAT)
+
+
+def partition_day(name: str) -> Optional[date]:
+    """Returns the exclusive upper bound of a daily partition, None for the MAXVALUE partition."""
+    if not PARTITION_NAME_PATTERN.fullmatch(name):
+        return None
+    return datetime.strptime(name, PARTITION_NAME_FORMAT).date()
+
+
+def partition_definition(day: date) -> str:
+    return f"PARTITION {partition_name(day)} VALUES LESS THAN (TO_DAYS('{day.isoformat()}'))"
+
+
+def floor_hour(timestamp: datetime) -> datetime:
+    return timestamp.replace(minute=0, second=0, microsecond=0)
+
+
+class LocationStorageLifecycle:
+    """
+    Keeps the raw ``locations`` table bounded.
+
+    On MySQL with a ``raw_retention_days``, ``locations`` is range partitioned by day on its timestamp, with
+    ``partitions_ahead`` empty partitions created in advance, and raw fixes past it are removed by dropping whole
+    partitions. Partitioned InnoDB tables can't have foreign keys, so the table's foreign key to ``devices`` is
+    dropped and deleting a device deletes its fixes explicitly. Without a retention the table is left as it is,
+    unless it was partitioned already. Other databases delete expired fixes in chunks
+    instead.
+
+    Before raw fixes expire, every complete hour older than ``rollup_delay`` seconds is rolled up into
+    ``location_rollups``, one row per device, which history queries serve beyond the raw window. Partitions are
+    only dropped once all of their hours are rolled up. Rollups are kept for ``rollup_retention_days``, 0 keeps them
+    forever.
+    """
+
+    def __init__(self, database_service: DatabaseService, raw_retention_days: int, rollup_retention_days: int = 0,
+                 partitions_ahead: int = 7, rollup_delay: float = 7200, max_rollup_hours: int = 168,
+                 interval: float = 3600):
+        self.database_service = database_service
+        self.raw_retention_days = raw_retention_days
+        self.rollup_retention_days = rollup_retention_days
+        self.partitions_ahead = partitions_ahead
+        self.rollup_delay = timedelta(seconds=rollup_delay)
+        self.max_rollup_hours = max_rollup_hours
+        self.interval = interval
+
+    def run_once(self, now: datetime = None):
+        now = now or datetime.utcnow()
+        with self.database_service.session_local() as db:
+            # Partitioning rewrites the whole table, so it's only worth it once raw fixes expire.
+            partitioned = db.get_bind().dialect.name == "mysql" and bool(self.raw_retention_days
+                                                                        or self.get_partitions(db))
+            if partitioned:
+                self.ensure_partitions(db, now.date())
+            if self.raw_retention_days:
+                rolled_up_until = self.roll_up(db, now)
+                cutoff = min(retention_cutoff(now, self.raw_retention_days), rolled_up_until)
+                if partitioned:
+                    self.drop_partitions_before(db, cutoff)
+                else:
+                    deleted = delete_locations_before(cutoff, db)
+                    logger.info(f"Deleted {deleted} fixes older than {cutoff}")
+            if self.rollup_retention_days:
+                deleted = delete_rollups_before(retention_cutoff(now, self.rollup_retention_days), db)
+                logger.info(f"Deleted {deleted} expired location rollups")
+
+    def roll_up(self, db: Session, now: datetime) -> datetime:
+        """Rolls up at most max_rollup_hours hours and returns the time up to which everything is rolled up."""
+        until = floor_hour(now - self.rollup_delay)
+        hour = get_rollup_watermark(db)
+        for _ in range(self.max_rollup_hours):
+            # Hours without fixes are skipped with one index lookup.
+            timestamp = get_next_location_timestamp(db, since=hour, until=until)
+            if timestamp is None:
+                return until
+            hour = floor_hour(timestamp)
+            devices = rollup_locations(hour, db)
+            db.commit()
+            logger.info(f"Rolled up the locations of {devices} devices for {hour}")
+            hour += ROLLUP_PERIOD
+        return hour
+
+    @staticmethod
+    def get_partitions(db: Session) -> list[str]:
+        return db.execute(text(
+            "SELECT PARTITION_NAME FROM information_schema.PARTITIONS "
+            "WHERE TABLE_SCHEMA = DATABASE() AND TABLE_NAME = 'locations' AND PARTITION_NAME IS NOT NULL "
+            "ORDER BY PARTITION_ORDINAL_POSITION")).scalars().all()
+
+    def ensure_partitions(self, db: Session, today: date):
+        """Partitions the table on first use and creates the partitions up to partitions_ahead days ahead."""
+        partitions = self.get_partitions(db)
+        if not partitions:
+            self.partition_table(db, today)
+            partitions = self.get_partitions(db)
+        days = [day for day in map(partition_day, partitions) if day is not None]
+        last_day = today + timedelta(days=self.partitions_ahead + 1)
+        new_days = []
+        day = max(days) + timedelta(days=1)
+        while day <= last_day:
+            new_days.append(day)
+            day += timedelta(days=1)
+        if new_days:
+            definitions = ", ".join(map(partition_definition, new_days))
+            db.execute(text(f"ALTER TABLE locations REORGANIZE PARTITION {MAX_PARTITION} INTO "
+                            f"({definitions}, PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE)"))
+            logger.info(f"Created {len(new_days)} location partitions up to {new_days[-1]}")
+
+    @staticmethod
+    def partition_table(db: Session, today: date):
+        """
+        Converts the existing table in place; all fixes before today end up in the first partition, which is
+        dropped once today is past retention.
+        """
+        logger.info("Partitioning the locations table, this rewrites the table once")
+        foreign_keys = db.execute(text(
+            "SELECT CONSTRAINT_NAME FROM information_schema.REFERENTIAL_CONSTRAINTS "
+            "WHERE CONSTRAINT_SCHEMA = DATABASE() AND TABLE_NAME = 'locations'")).scalars().all()
+        for foreign_key in foreign_keys:
+            db.execute(text(f"ALTER TABLE locations DROP FOREIGN KEY `{foreign_key}`"))
+        # Every unique key of a partitioned table has to contain the partitioning column.
+        db.execute(text("ALTER TABLE locations MODIFY `timestamp` DATETIME NOT NULL, "
+                        "DROP PRIMARY KEY, ADD PRIMARY KEY (id, `timestamp`)"))
+        db.execute(text(f"ALTER TABLE locations PARTITION BY RANGE (TO_DAYS(`timestamp`)) "
+                        f"({partition_definition(today)}, PARTITION {MAX_PARTITION} VALUES LESS THAN MAXVALUE)"))
+
+    def drop_partitions_before(self, db: Session, cutoff: datetime):
+        expired = [name for name in self.get_partitions(db)
+                   if partition_day(name) is not None and partition_day(name) <= cutoff.date()]
+        if expired:
+            db.execute(text(f"ALTER TABLE locations DROP PARTITION {', '.join(expired)}"))
+            logger.info(f"Dropped location partitions {', '.join(expired)}")
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Error occurred while maintaining location storage:")
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run_forever, daemon=True).start()
+
+
+class LocationStoreLifecycle:
+    """
+    Removes the segments of a columnar location store past ``raw_retention_days``, which aren't rolled up, and
+    those of deleted devices.
+
+    Only a device's writer may remove its segments, so every data processor worker runs one for its own store.
+    """
+
+    def __init__(self, location_store: ColumnarLocationStore, raw_retention_days: int, interval: float = 3600):
+        self.location_store = location_store
+        self.raw_retention_days = raw_retention_days
+        self.interval = interval
+
+    def run_once(self, now: datetime = None):
+        now = now or datetime.utcnow()
+        devices = self.location_store.apply_deletions()
+        if devices:
+            logger.info(f"Removed the location store segments of {devices} deleted devices")
+        if self.raw_retention_days:
+            deleted = self.location_store.delete_before(retention_cutoff(now, self.raw_retention_days))
+            logger.info(f"Deleted {deleted} expired location store segments")
+
+    def run_forever(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                logger.exception("Error occurred while maintaining the location store:")
+            time.sleep(self.interval)
+
+    def start(self):
+        threading.Thread(target=self.run_forever, daemon=True).start()
@@ -0,0 +1,392 @@
+"""
+Transports that carry GPS message bodies from the TCP server's publisher to the data processor's listener.
+
+``RabbitMQTransport`` goes through the broker. ``UnixSocketTransport`` is the brokerless single-node backend: every
+processor worker listens on ``<socket_dir>/<queue name>.sock`` and the TCP server streams bodies to it directly.
+
+Durability of the Unix socket transport: there is no broker holding messages, the publisher keeps every body it
+wrote in memory until the listener acknowledges it, which happens after the batch was committed to the database.
+If the processor restarts, the publisher reconnects and resends everything unacknowledged, so fixes are delivered
+at least once, as with RabbitMQ. Bodies held by the publisher are lost if the TCP server dies, like the items of
+its in-memory ingest buffer; while the processor is down, the TCP server's ingest buffer fills up and applies its
+overflow policy instead of the broker queueing fixes.
+"""
+import logging
+import os
+import select
+import socket
+import struct
+import time
+from collections import deque, namedtuple
+from typing import Iterator, Optional
+
+import pika
+from pika.exceptions import AMQPError
+
+from src.metrics import Counter
+
+logger = logging.getLogger(__name__)
+
+TRANSPORT_RABBITMQ = "rabbitmq"
+TRANSPORT_UNIX = "unix"
+# Body length and content type length of a frame, followed by the content type and the body.
+FRAME_HEADER = struct.Struct("<IB")
+# Number of frames of the connection acknowledged so far, sent back by the listener.
+ACK = struct.Struct("<Q")
+READ_CHUNK_SIZE = 256 * 1024
+
+PUBLISH_RETRIES = Counter("broker_publish_retries_total", "Publish attempts that failed with a transport error.")
+
+Delivery = namedtuple("Delivery", "delivery_tag body content_type")
+
+
+class Transport:
+    """
+    Publishes (body, content_type) pairs to named queues and consumes them with cumulative acknowledgements.
+
+    A transport is used by a single thread, either for publishing or for consuming.
+    """
+
+    def publish(self, queue_name: str, bodies: list[tuple[bytes, str]]):
+        """Returns once the transport took responsibility for the bodies, raises if it couldn't."""
+        raise NotImplementedError
+
+    def publish_to_exchange(self, exchange: str, bodies: list[tuple[bytes, str]]):
+        raise NotImplementedError(f"{type(self).__name__} doesn't support exchanges")
+
+    def consume(self, queue_name: str, prefetch_count: int, inactivity_timeout: float) -> Iterator[Optional[Delivery]]:
+        """Yields deliveries in order, or None after inactivity_timeout seconds without one."""
+        raise NotImplementedError
+
+    def ack(self, delivery_tag: int):
+        """Acknowledges every delivery up to delivery_tag."""
+        raise NotImplementedError
+
+    def nack(self, delivery_tag: int):
+        """Returns every unacknowledged delivery up to delivery_tag to the queue."""
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class RabbitMQTransport(Transport):
+    """
+    Publishes over a single long-lived RabbitMQ connection with publisher confirms enabled.
+
+    The connection is opened lazily and re-opened after any connection or channel error, so a broker
+    restart costs a few retries instead of a crashed publisher.
+    """
+
+    def __init__(self, rabbitmq_host, rabbitmq_port, queues_to_declare: list = None, max_retries: int = 5,
+                 retry_interval: float = 1):
+        self.rabbitmq_connection_parameters = pika.ConnectionParameters(host=rabbitmq_host, port=rabbitmq_port)
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.connection = None
+        self.channel = None
+        self.declared_queues = set()
+        self.declared_exchanges = set()
+        self.queues_to_declare = set(queues_to_declare or [])
+        if self.queues_to_declare:
+            self.get_channel()
+
+    def get_channel(self):
+        if self.channel is None or not self.channel.is_open:
+            self.close()
+            self.connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
+            self.channel = self.connection.channel()
+            self.channel.confirm_delivery()
+            self.declared_queues = set()
+            self.declared_exchanges = set()
+            for queue_name in self.queues_to_declare:
+                self.declare_queue(queue_name)
+        return self.channel
+
+    def declare_queue(self, queue_name):
+        if queue_name not in self.declared_queues:
+            self.channel.queue_declare(queue=queue_name)
+            self.declared_queues.add(queue_name)
+
+    def declare_exchange(self, exchange):
+        if exchange not in self.declared_exchanges:
+            self.channel.exchange_declare(exchange=exchange, exchange_type='fanout')
+            self.declared_exchanges.add(exchange)
+
+    def publish(self, queue_name: str, bodies: list[tuple[bytes, str]]):
+        self._publish(bodies, routing_key=queue_name, queue_name=queue_name)
+
+    def publish_to_exchange(self, exchange: str, bodies: list[tuple[bytes, str]]):
+        self._publish(bodies, exchange=exchange)
+
+    def _publish(self, bodies: list[tuple[bytes, str]], exchange='', routing_key='', queue_name=None):
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                channel = self.get_channel()
+                if queue_name:
+                    self.declare_queue(queue_name)
+                if exchange:
+                    self.declare_exchange(exchange)
+                for body, content_type in bodies:
+                    channel.basic_publish(exchange=exchange, routing_key=routing_key, body=body,
+                                          properties=pika.BasicProperties(content_type=content_type))
+                return
+            except AMQPError as e:
+                PUBLISH_RETRIES.inc()
+                logger.warning(f"RabbitMQ publish failed ({attempt}/{self.max_retries}): {e!r}")
+                self.close()
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(self.retry_interval)
+
+    def consume(self, queue_name: str, prefetch_count: int, inactivity_timeout: float) -> Iterator[Optional[Delivery]]:
+        self.close()
+        self.connection = pika.BlockingConnection(self.rabbitmq_connection_parameters)
+        self.channel = self.connection.channel()
+        self.channel.queue_declare(queue=queue_name)
+        self.channel.basic_qos(prefetch_count=prefetch_count)
+        # A single exclusive consumer per queue keeps each device's fixes in order; another processor trying
+        # to consume the same queue is refused and retries, acting as a standby.
+        for method, properties, body in self.channel.consume(queue_name, exclusive=True,
+                                                             inactivity_timeout=inactivity_timeout):
+            yield None if method is None else Delivery(method.delivery_tag, body, properties.content_type)
+
+    def ack(self, delivery_tag: int):
+        self.channel.basic_ack(delivery_tag=delivery_tag, multiple=True)
+
+    def nack(self, delivery_tag: int):
+        self.channel.basic_nack(delivery_tag=delivery_tag, multiple=True, requeue=True)
+
+    def close(self):
+        if self.connection is not None and self.connection.is_open:
+            try:
+                self.connection.close()
+            except AMQPError:
+                pass
+        self.connection = None
+        self.channel = None
+
+
+def encode_frame(body: bytes, content_type: str) -> bytes:
+    content_type = content_type.encode()
+    return FRAME_HEADER.pack(len(body), len(content_type)) + content_type + body
+
+
+class UnixSocketLink:
+    """The publisher's connection to one queue's socket and the bodies the listener hasn't acknowledged yet."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self.sock = None
+        self.seq = 0
+        self.pending = deque()
+        self.unacked = deque()
+        self.ack_buffer = b""
+
+    def connect(self):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.sock.connect(self.path)
+        except OSError:
+            self.close()
+            raise
+        # Frames are numbered per connection, so everything unacknowledged is resent on the new one.
+        self.seq = 0
+        self.pending.extendleft(reversed([(body, content_type) for _, body, content_type in self.unacked]))
+        self.unacked.clear()
+        self.ack_buffer = b""
+
+    def flush(self, max_in_flight: int):
+        if self.sock is None:
+            self.connect()
+        frames = []
+        while self.pending:
+            body, content_type = self.pending.popleft()
+            self.seq += 1
+            self.unacked.append((self.seq, body, content_type))
+            frames.append(encode_frame(body, content_type))
+        self.sock.sendall(b"".join(frames))
+        self.read_acks(block=False)
+        while len(self.unacked) > max_in_flight:
+            self.read_acks(block=True)
+
+    def read_acks(self, block: bool):
+        try:
+            data = self.sock.recv(READ_CHUNK_SIZE, 0 if block else socket.MSG_DONTWAIT)
+        except BlockingIOError:
+            return
+        if not data:
+            raise ConnectionResetError(f"{self.path} closed the connection")
+        self.ack_buffer += data
+        complete = len(self.ack_buffer) - len(self.ack_buffer) % ACK.size
+        if complete:
+            acked = ACK.unpack_from(self.ack_buffer, complete - ACK.size)[0]
+            self.ack_buffer = self.ack_buffer[complete:]
+            while self.unacked and self.unacked[0][0] <= acked:
+                self.unacked.popleft()
+
+    def in_flight(self) -> int:
+        return len(self.unacked) + len(self.pending)
+
+    def discard_newest(self, count: int):
+        """Forgets the last count bodies handed to the link, whether they were sent already or not."""
+        for _ in range(count):
+            (self.pending or self.unacked).pop()
+
+    def close(self):
+        if self.sock is not None:
+            self.sock.close()
+            self.sock = None
+
+
+class UnixSocketTransport(Transport):
+    """
+    Streams bodies over Unix domain sockets, see the module docstring for its durability.
+
+    The publisher doesn't wait for every batch to be acknowledged: up to ``max_in_flight`` bodies per queue may be
+    unacknowledged before ``publish`` blocks, so the listener can batch across publishes.
+    """
+
+    def __init__(self, socket_dir: str, max_in_flight: int = 1000, max_retries: int = 5, retry_interval: float = 1):
+        self.socket_dir = socket_dir
+        self.max_in_flight = max_in_flight
+        self.max_retries = max_retries
+        self.retry_interval = retry_interval
+        self.links = {}
+        self.server = None
+        self.connection = None
+        self.frames = 0
+        self.delivery_tags = 0
+        # (delivery tag, frame number on the connection, body, content type) of every unacknowledged delivery.
+        self.unacked = deque()
+        self.redeliveries = deque()
+
+    def socket_path(self, queue_name: str) -> str:
+        return os.path.join(self.socket_dir, f"{queue_name}.sock")
+
+    def publish(self, queue_name: str, bodies: list[tuple[bytes, str]]):
+        link = self.links.get(queue_name)
+        if link is None:
+            link = self.links[queue_name] = UnixSocketLink(self.socket_path(queue_name))
+        link.pending.extend(bodies)
+        for attempt in range(1, self.max_retries + 1):
+            try:
+                link.flush(self.max_in_flight)
+                return
+            except OSError as e:
+                PUBLISH_RETRIES.inc()
+                logger.warning(f"Publishing to {link.path} failed ({attempt}/{self.max_retries}): {e!r}")
+                link.close()
+                if attempt == self.max_retries:
+                    # Acknowledgements are cumulative, so the link holds fewer than len(bodies) bodies only if
+                    # part of this batch was acknowledged. Then the rest is resent after reconnecting and the
+                    # batch is reported as published; otherwise the caller publishes all of it again, so the
+                    # link forgets it.
+                    if link.in_flight() < len(bodies):
+                        return
+                    link.discard_newest(len(bodies))
+                    raise
+                time.sleep(self.retry_interval)
+
+    def listen(self, queue_name: str) -> socket.socket:
+        os.makedirs(self.socket_dir, exist_ok=True)
+        path = self.socket_path(queue_name)
+        if os.path.exists(path):
+            os.unlink(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(1)
+        return server
+
+    def consume(self, queue_name: str, prefetch_count: int, inactivity_timeout: float) -> Iterator[Optional[Delivery]]:
+        """
+        Accepts one publisher at a time; a new connection replaces the current one. The publisher's
+        ``max_in_flight`` takes the place of ``prefetch_count``.
+        """
+        self.close()
+        self.server = self.listen(queue_name)
+        logger.info(f"Listening on {self.socket_path(queue_name)}")
+        buffer = bytearray()
+        while True:
+            if self.redeliveries:
+                yield self.deliver(*self.redeliveries.popleft())
+                continue
+            if len(buffer) >= FRAME_HEADER.size:
+                body_length, type_length = FRAME_HEADER.unpack_from(buffer)
+                frame_length = FRAME_HEADER.size + type_length + body_length
+                if len(buffer) >= frame_length:
+                    content_type = buffer[FRAME_HEADER.size:FRAME_HEADER.size + type_length].decode()
+                    body = bytes(buffer[FRAME_HEADER.size + type_length:frame_length])
+                    del buffer[:frame_length]
+                    self.frames += 1
+                    yield self.deliver(self.frames, body, content_type)
+                    continue
+            sockets = [self.server] if self.connection is None else [self.server, self.connection]
+            readable, _, _ = select.select(sockets, [], [], inactivity_timeout)
+            if not readable:
+                yield None
+                continue
+            if self.server in readable:
+                if self.connection is not None:
+                    logger.warning("A new publisher connected, dropping the previous connection")
+                self.drop_connection(buffer)
+                self.connection, _ = self.server.accept()
+            elif self.connection in readable:
+                data = self.connection.recv(READ_CHUNK_SIZE)
+                if data:
+                    buffer += data
+                else:
+                    self.drop_connection(buffer)
+
+    def drop_connection(self, buffer: bytearray):
+        """Forgets everything unacknowledged of the connection, its publisher sends it again when it reconnects."""
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        self.frames = 0
+        self.unacked.clear()
+        self.redeliveries.clear()
+        buffer.clear()
+
+    def deliver(self, frame: int, body: bytes, content_type: str) -> Delivery:
+        self.delivery_tags += 1
+        self.unacked.append((self.delivery_tags, frame, body, content_type))
+        return Delivery(self.delivery_tags, body, content_type)
+
+    def ack(self, delivery_tag: int):
+        frame = None
+        while self.unacked and self.unacked[0][0] <= delivery_tag:
+            frame = self.unacked.popleft()[1]
+        if frame is not None and self.connection is not None:
+            try:
+                self.connection.sendall(ACK.pack(frame))
+            except OSError as e:
+                # The publisher resends the bodies after reconnecting, they are stored twice.
+                logger.warning(f"Unable to acknowledge frame {frame}: {e!r}")
+
+    def nack(self, delivery_tag: int):
+        redeliveries = []
+        while self.unacked and self.unacked[0][0] <= delivery_tag:
+            redeliveries.append(self.unacked.popleft()[1:])
+        self.redeliveries.extendleft(reversed(redeliveries))
+
+    def close(self):
+        for link in self.links.values():
+            link.close()
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+        if self.server is not None:
+            self.server.close()
+            self.server = None
+
+
+def create_transport(kind: str, rabbitmq_host=None, rabbitmq_port=None, socket_dir: str = None,
+                     max_in_flight: int = 1000) -> Transport:
+    if kind == TRANSPORT_RABBITMQ:
+        return RabbitMQTransport(rabbitmq_host, rabbitmq_port)
+    if kind == TRANSPORT_UNIX:
+        if not socket_dir:
+            raise ValueError("socket_dir is required for the unix transport")
+        return UnixSocketTransport(socket_dir, max_in_flight=max_in_flight)
+    raise ValueError(f"Unknown transport: {kind}")
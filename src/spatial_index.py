@@ -0,0 +1,74 @@
+"""
+Fixed grid spatial index over latitude/longitude.
+
+The globe is cut into cells of CELL_SIZE_DEGREES, numbered row-major from the south-west corner, so the cells
+of one latitude row form a contiguous integer range. The data processor stores the cell of every device's latest
+position in ``latest_locations.cell`` and an area query becomes a handful of ``cell BETWEEN lo AND hi`` index range
+scans followed by an exact filter on the few candidate rows.
+"""
+import math
+
+CELL_SIZE_DEGREES = 0.01
+ROWS = round(180 / CELL_SIZE_DEGREES)
+COLUMNS = round(360 / CELL_SIZE_DEGREES)
+MAX_ROW_RANGES = 256
+EARTH_RADIUS_METERS = 6_371_008.8
+METERS_PER_DEGREE_LATITUDE = math.pi * EARTH_RADIUS_METERS / 180
+
+
+def _row(latitude: float) -> int:
+    return min(ROWS - 1, max(0, int((latitude + 90) / CELL_SIZE_DEGREES)))
+
+
+def _column(longitude: float) -> int:
+    return int((longitude + 180) / CELL_SIZE_DEGREES) % COLUMNS
+
+
+def cell_for(latitude: float, longitude: float) -> int:
+    return _row(latitude) * COLUMNS + _column(longitude)
+
+
+def cell_ranges(min_latitude: float, min_longitude: float, max_latitude: float, max_longitude: float) -> list:
+    """
+    Returns inclusive (first_cell, last_cell) ranges covering a bounding box.
+
+    A box with ``min_longitude > max_longitude`` crosses the antimeridian. Boxes spanning more than
+    MAX_ROW_RANGES rows are covered by one range per latitude band; callers filter the candidates exactly anyway.
+    """
+    first_row, last_row = _row(min_latitude), _row(max_latitude)
+    if last_row - first_row + 1 > MAX_ROW_RANGES:
+        return [(first_row * COLUMNS, last_row * COLUMNS + COLUMNS - 1)]
+    last_column = COLUMNS - 1 if max_longitude >= 180 else _column(max_longitude)
+    if max_longitude - min_longitude >= 360:
+        column_ranges = [(0, COLUMNS - 1)]
+    elif min_longitude <= max_longitude:
+        column_ranges = [(_column(min_longitude), last_column)]
+    else:
+        column_ranges = [(_column(min_longitude), COLUMNS - 1), (0, last_column)]
+    if column_ranges == [(0, COLUMNS - 1)]:
+        return [(first_row * COLUMNS, last_row * COLUMNS + COLUMNS - 1)]
+    return [(row * COLUMNS + first, row * COLUMNS + last)
+            for row in range(first_row, last_row + 1) for first, last in column_ranges]
+
+
+def bounding_box(latitude: float, longitude: float, radius_meters: float) -> tuple:
+    """Returns (min_latitude, min_longitude, max_latitude, max_longitude) of a circle around a point."""
+    delta_latitude = radius_meters / METERS_PER_DEGREE_LATITUDE
+    min_latitude, max_latitude = max(-90.0, latitude - delta_latitude), min(90.0, latitude + delta_latitude)
+    widest_latitude = max(abs(min_latitude), abs(max_latitude))
+    if widest_latitude >= 90 or math.cos(math.radians(widest_latitude)) * 180 <= delta_latitude:
+        return min_latitude, -180.0, max_latitude, 180.0
+    delta_longitude = delta_latitude / math.cos(math.radians(widest_latitude))
+    return (min_latitude, _wrap_longitude(longitude - delta_longitude), max_latitude,
+            _wrap_longitude(longitude + delta_longitude))
+
+
+def _wrap_longitude(longitude: float) -> float:
+    return (longitude + 180) % 360 - 180 if not -180 <= longitude <= 180 else longitude
+
+
+def haversine_meters(latitude1: float, longitude1: float, latitude2: float, longitude2: float) -> float:
+    phi1, phi2 = math.radians(latitude1), math.radians(latitude2)
+    a = (math.sin((phi2 - phi1) / 2) ** 2 +
+         math.cos(phi1) * math.cos(phi2) * math.sin(math.radians(longitude2 - longitude1) / 2) ** 2)
+    return 2 * EARTH_RADIUS_METERS * math.asin(min(1.0, math.sqrt(a)))
@@ -1,15 +1,459 @@
+import base64
+import heapq
+from datetime import datetime, time, timedelta
+from itertools import repeat
+from typing import Optional
+
 from fastapi import Depends, HTTPException
-from sqlalchemy import func
+from sqlalchemy import DateTime, and_, delete, func, insert, literal, or_, select
+from sqlalchemy.dialects import mysql, sqlite
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.orm import Session
 
-from src.model import Location, Device, LatestLocation
+from src.location_store import ColumnarLocationStore, LocationColumns
+from src.model import Location, Device, LatestLocation, LocationRollup
+from src.spatial_index import bounding_box, cell_for, cell_ranges, haversine_meters
+
+INSERT_CHUNK_SIZE = 1000
+DELETE_ID_RANGE = 10_000
+NEAREST_SEARCH_START_METERS = 500
+ROLLUP_PERIOD = timedelta(hours=1)
+
+
+def encode_location_cursor(location) -> str:
+    return encode_cursor(location.timestamp, location.id)
+
+
+def encode_cursor(timestamp: datetime, location_id: int) -> str:
+    return base64.urlsafe_b64encode(f"{timestamp.isoformat()}|{location_id}".encode()).decode()
+
+
+def decode_location_cursor(cursor: str) -> tuple[datetime, int]:
+    try:
+        timestamp, location_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(timestamp), int(location_id)
+    except ValueError:
+        raise ValueError(f"Invalid cursor: {cursor}")
+
+
+def location_history_statement(device_id: int, start: datetime = None, end: datetime = None,
+                               after: tuple[datetime, int] = None, limit: int = None, model=Location):
+    """
+    Selects a device's locations ordered by (timestamp, id), optionally within [start, end) and after a
+    (timestamp, id) keyset position, served by the (device_id, timestamp, id) index. ``model`` may also be
+    LocationRollup, whose rows have the same columns.
+    """
+    statement = select(model).where(model.device_id == device_id)
+    if start is not None:
+        statement = statement.where(model.timestamp >= start)
+    if end is not None:
+        statement = statement.where(model.timestamp < end)
+    if after is not None:
+        after_timestamp, after_id = after
+        statement = statement.where(or_(model.timestamp > after_timestamp,
+                                        and_(model.timestamp == after_timestamp, model.id > after_id)))
+    statement = statement.order_by(model.timestamp, model.id)
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
 
 
-def get_location_history_by_device(device_id: int, db: Session):
-    locations = db.query(Location).filter(Location.device_id == device_id).all()
+def history_sources(start: Optional[datetime], end: Optional[datetime], raw_since: Optional[datetime]) -> list:
+    """
+    Splits [start, end) into (model, start, end) parts: hourly rollups before raw_since and raw fixes from it on.
+
+    The parts don't overlap in time, so a (timestamp, id) cursor of either table can be applied to both.
+    """
+    if raw_since is None:
+        return [(Location, start, end)]
+    sources = []
+    if start is None or start < raw_since:
+        sources.append((LocationRollup, start, raw_since if end is None else min(end, raw_since)))
+    if end is None or end > raw_since:
+        sources.append((Location, raw_since if start is None else max(start, raw_since), end))
+    return sources
+
+
+def get_location_history_by_device(device_id: int, db: Session, start: datetime = None, end: datetime = None,
+                                   after: tuple[datetime, int] = None, limit: int = None,
+                                   raw_since: datetime = None, store: ColumnarLocationStore = None):
+    locations = []
+    for model, source_start, source_end in history_sources(start, end, raw_since):
+        remaining = None if limit is None else limit - len(locations)
+        if remaining == 0:
+            break
+        if store is not None and model is Location:
+            locations.extend(store.read(device_id, source_start, source_end, after, remaining).locations(device_id))
+            continue
+        statement = location_history_statement(device_id, source_start, source_end, after, remaining, model)
+        locations.extend(db.execute(statement).scalars().all())
+    return locations
+
+
+async def get_location_history_by_device_async(device_id: int, db: AsyncSession, start: datetime = None,
+                                               end: datetime = None, after: tuple[datetime, int] = None,
+                                               limit: int = None, raw_since: datetime = None,
+                                               store: ColumnarLocationStore = None):
+    """
+    Returns a page of a device's history; with raw_since, the part before it comes from the hourly rollups. Raw
+    fixes are read from ``store`` instead of ``locations`` when one is given.
+    """
+    locations = []
+    for model, source_start, source_end in history_sources(start, end, raw_since):
+        remaining = None if limit is None else limit - len(locations)
+        if remaining == 0:
+            break
+        if store is not None and model is Location:
+            locations.extend(store.read(device_id, source_start, source_end, after, remaining).locations(device_id))
+            continue
+        statement = location_history_statement(device_id, source_start, source_end, after, remaining, model)
+        locations.extend((await db.execute(statement)).scalars().all())
     return locations
 
 
+def location_export_statement(device_ids: list[int], start: datetime = None, end: datetime = None):
+    """Selects plain (device_id, timestamp, latitude, longitude) rows of devices ordered by device and time."""
+    table = Location.__table__
+    statement = (select(table.c.device_id, table.c.timestamp, table.c.latitude, table.c.longitude)
+                 .where(table.c.device_id.in_(device_ids)))
+    if start is not None:
+        statement = statement.where(table.c.timestamp >= start)
+    if end is not None:
+        statement = statement.where(table.c.timestamp < end)
+    return statement.order_by(table.c.device_id, table.c.timestamp, table.c.id)
+
+
+async def stream_locations_async(device_ids: list[int], db: AsyncSession, start: datetime = None,
+                                 end: datetime = None, chunk_size: int = INSERT_CHUNK_SIZE,
+                                 store: ColumnarLocationStore = None):
+    """
+    Yields lists of at most chunk_size location rows fetched through a server-side cursor, or read from
+    ``store`` one device at a time.
+    """
+    if store is not None:
+        for device_id in sorted(set(device_ids)):
+            columns = store.read(device_id, start, end)
+            for offset in range(0, len(columns), chunk_size):
+                chunk = slice(offset, offset + chunk_size)
+                yield list(zip(repeat(device_id), columns.timestamps[chunk].tolist(),
+                               columns.latitudes[chunk].tolist(), columns.longitudes[chunk].tolist()))
+        return
+    statement = location_export_statement(device_ids, start, end).execution_options(yield_per=chunk_size)
+    result = await db.stream(statement)
+    async for rows in result.partitions(chunk_size):
+        yield rows
+
+
+async def get_location_history_columns_async(device_id: int, db: AsyncSession, start: datetime = None,
+                                             end: datetime = None, after: tuple[datetime, int] = None,
+                                             limit: int = None, raw_since: datetime = None,
+                                             store: ColumnarLocationStore = None) -> LocationColumns:
+    """
+    Like get_location_history_by_device_async, as NumPy columns. Fixes read from the store are returned as views
+    of its segments when they come from a single one.
+    """
+    chunks = []
+    for model, source_start, source_end in history_sources(start, end, raw_since):
+        remaining = None if limit is None else limit - sum(map(len, chunks))
+        if remaining == 0:
+            break
+        if store is not None and model is Location:
+            chunks.append(store.read(device_id, source_start, source_end, after, remaining))
+            continue
+        statement = location_history_statement(device_id, source_start, source_end, after, remaining,
+                                               model).with_only_columns(model.id, model.timestamp, model.latitude,
+                                                                        model.longitude)
+        chunks.append(LocationColumns.from_rows((await db.execute(statement)).all()))
+    return LocationColumns.concatenate(chunks)
+
+
+def retention_cutoff(now: datetime, retention_days: int) -> datetime:
+    """Returns the start of the oldest day that a retention of retention_days days keeps."""
+    return datetime.combine((now - timedelta(days=retention_days)).date(), time.min)
+
+
+async def get_raw_history_start_async(db: AsyncSession, raw_retention_days: int,
+                                      start: datetime = None) -> Optional[datetime]:
+    """
+    Returns the time from which history is read from raw fixes rather than rollups, or None to read only raw
+    fixes: when no raw retention is configured, nothing was rolled up yet, or the range starts inside the raw window.
+    """
+    if not raw_retention_days:
+        return None
+    cutoff = retention_cutoff(datetime.utcnow(), raw_retention_days)
+    if start is not None and start >= cutoff:
+        return None
+    rolled_up = await db.scalar(select(func.max(LocationRollup.hour)))
+    if rolled_up is None:
+        return None
+    return min(cutoff, rolled_up + ROLLUP_PERIOD)
+
+
 def get_last_location_for_all_devices(db: Session):
-    last_locations = db.query(Location).join(LatestLocation, Location.id == LatestLocation.location_id).all()
+    last_locations = db.query(LatestLocation).all()
     return last_locations
+
+
+async def get_last_location_for_all_devices_async(db: AsyncSession):
+    result = await db.execute(select(LatestLocation))
+    return result.scalars().all()
+
+
+def get_last_location_by_device(device_id: int, db: Session):
+    return db.get(LatestLocation, device_id)
+
+
+async def get_last_location_by_device_async(device_id: int, db: AsyncSession):
+    return await db.get(LatestLocation, device_id)
+
+
+async def get_devices_by_ids_async(device_ids: list[int], db: AsyncSession) -> list[Device]:
+    result = await db.execute(select(Device).where(Device.id.in_(device_ids)))
+    return result.scalars().all()
+
+
+async def get_last_locations_by_devices_async(device_ids: list[int], db: AsyncSession) -> list[LatestLocation]:
+    result = await db.execute(select(LatestLocation).where(LatestLocation.device_id.in_(device_ids)))
+    return result.scalars().all()
+
+
+async def get_recent_locations_by_devices_async(device_ids: list[int], limit: int, db: AsyncSession,
+                                                store: ColumnarLocationStore = None) -> list[Location]:
+    """Returns up to limit newest locations of each device in one query, or from ``store``, newest first per device."""
+    if store is not None:
+        return [location for device_id in sorted(set(device_ids))
+                for location in reversed(store.recent(device_id, limit).locations(device_id))]
+    rank = func.row_number().over(partition_by=Location.device_id,
+                                  order_by=(Location.timestamp.desc(), Location.id.desc())).label("rank")
+    ranked = select(Location.id, rank).where(Location.device_id.in_(device_ids)).subquery()
+    statement = (select(Location).join(ranked, ranked.c.id == Location.id).where(ranked.c.rank <= limit)
+                 .order_by(Location.device_id, Location.timestamp.desc(), Location.id.desc()))
+    result = await db.execute(statement)
+    return result.scalars().all()
+
+
+def last_locations_in_box_statement(min_latitude: float, min_longitude: float, max_latitude: float,
+                                    max_longitude: float, limit: int = None):
+    """Selects the latest locations inside a bounding box; min_longitude > max_longitude crosses the antimeridian."""
+    if min_longitude <= max_longitude:
+        longitude_filter = LatestLocation.longitude.between(min_longitude, max_longitude)
+    else:
+        longitude_filter = or_(LatestLocation.longitude >= min_longitude, LatestLocation.longitude <= max_longitude)
+    ranges = cell_ranges(min_latitude, min_longitude, max_latitude, max_longitude)
+    statement = (select(LatestLocation)
+                 .where(or_(*(LatestLocation.cell.between(first, last) for first, last in ranges)))
+                 .where(LatestLocation.latitude.between(min_latitude, max_latitude), longitude_filter)
+                 .order_by(LatestLocation.device_id))
+    if limit is not None:
+        statement = statement.limit(limit)
+    return statement
+
+
+def get_last_locations_in_box(db: Session, min_latitude: float, min_longitude: float, max_latitude: float,
+                              max_longitude: float, limit: int = None):
+    statement = last_locations_in_box_statement(min_latitude, min_longitude, max_latitude, max_longitude, limit)
+    return db.execute(statement).scalars().all()
+
+
+async def get_last_locations_in_box_async(db: AsyncSession, min_latitude: float, min_longitude: float,
+                                          max_latitude: float, max_longitude: float, limit: int = None):
+    statement = last_locations_in_box_statement(min_latitude, min_longitude, max_latitude, max_longitude, limit)
+    return (await db.execute(statement)).scalars().all()
+
+
+def _nearest(latitude: float, longitude: float, search_radius: float, locations) -> list[tuple]:
+    nearby = []
+    for location in locations:
+        distance = haversine_meters(latitude, longitude, location.latitude, location.longitude)
+        if distance <= search_radius:
+            nearby.append((location, distance))
+    return nearby
+
+
+def get_nearby_last_locations(db: Session, latitude: float, longitude: float, radius_meters: float,
+                              limit: int) -> list[tuple]:
+    """
+    Returns up to limit (latest location, distance in meters) pairs within a radius, nearest first.
+
+    The search starts with a small radius and widens it until enough devices are found, so dense areas only scan
+    the cells around the point.
+    """
+    search_radius = min(radius_meters, NEAREST_SEARCH_START_METERS)
+    while True:
+        locations = get_last_locations_in_box(db, *bounding_box(latitude, longitude, search_radius))
+        nearby = _nearest(latitude, longitude, search_radius, locations)
+        if len(nearby) >= limit or search_radius >= radius_meters:
+            return heapq.nsmallest(limit, nearby, key=lambda pair: pair[1])
+        search_radius = min(radius_meters, search_radius * 4)
+
+
+async def get_nearby_last_locations_async(db: AsyncSession, latitude: float, longitude: float,
+                                          radius_meters: float, limit: int) -> list[tuple]:
+    search_radius = min(radius_meters, NEAREST_SEARCH_START_METERS)
+    while True:
+        locations = await get_last_locations_in_box_async(db, *bounding_box(latitude, longitude, search_radius))
+        nearby = _nearest(latitude, longitude, search_radius, locations)
+        if len(nearby) >= limit or search_radius >= radius_meters:
+            return heapq.nsmallest(limit, nearby, key=lambda pair: pair[1])
+        search_radius = min(radius_meters, search_radius * 4)
+
+
+async def insert_devices_async(names: list[str], db: AsyncSession) -> dict[str, int]:
+    """
+    Inserts devices with one multi-row statement, skipping names that already exist, and returns the ids of the
+    devices it created by name.
+
+    A device created concurrently under one of the names fails the statement. The devices are then inserted one by
+    one, so only those this call created are returned, never the concurrent one.
+    """
+    existing = set((await db.execute(select(Device.name).where(Device.name.in_(names)))).scalars())
+    new_names = [name for name in names if name not in existing]
+    if not new_names:
+        return {}
+    table = Device.__table__
+    try:
+        async with db.begin_nested():
+            await db.execute(insert(table).values([{"name": name} for name in new_names]))
+    except IntegrityError:
+        created = {}
+        for name in new_names:
+            try:
+                async with db.begin_nested():
+                    result = await db.execute(insert(table).values(name=name))
+                created[name] = result.inserted_primary_key[0]
+            except IntegrityError:
+                pass
+        return created
+    # Every name was inserted by the statement above, so they are all this call's devices.
+    result = await db.execute(select(Device.name, Device.id).where(Device.name.in_(new_names)))
+    return dict(result.all())
+
+
+async def delete_devices_async(device_ids: list[int], db: AsyncSession) -> list[Device]:
+    """Deletes the existing devices among device_ids and their fixes, and returns them."""
+    devices = (await db.execute(select(Device).where(Device.id.in_(device_ids)))).scalars().all()
+    if devices:
+        await delete_device_locations_async([device.id for device in devices], db)
+        await db.execute(delete(Device).where(Device.id.in_([device.id for device in devices])))
+    return devices
+
+
+async def delete_device_locations_async(device_ids: list[int], db: AsyncSession):
+    """Deletes the raw fixes of devices; once ``locations`` is partitioned there's no foreign key to cascade."""
+    await db.execute(delete(Location).where(Location.device_id.in_(device_ids)))
+
+
+def get_existing_device_ids(device_ids, db: Session) -> set:
+    return set(db.execute(select(Device.id).where(Device.id.in_(set(device_ids)))).scalars())
+
+
+def insert_locations(rows: list[dict], db: Session):
+    """Inserts location rows with one multi-row INSERT per chunk of INSERT_CHUNK_SIZE rows."""
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        db.execute(insert(Location.__table__).values(rows[start:start + INSERT_CHUNK_SIZE]))
+
+
+def newest_location_per_device(rows: list[dict]) -> list[dict]:
+    newest = {}
+    for row in rows:
+        current = newest.get(row["device_id"])
+        if current is None or row["timestamp"] >= current["timestamp"]:
+            newest[row["device_id"]] = row
+    return list(newest.values())
+
+
+def upsert_latest_locations(rows: list[dict], db: Session):
+    """
+    Stores the newest of the given locations per device in latest_locations, one statement per chunk.
+
+    An existing row is only overwritten by a strictly newer timestamp, so fixes that arrive out of order can't
+    move a device back to an older position.
+    """
+    rows = newest_location_per_device(rows)
+    table = LatestLocation.__table__
+    dialect = db.get_bind().dialect.name
+    # MySQL applies the assignments left to right, so timestamp has to be compared before it's updated.
+    updated_columns = ("latitude", "longitude", "cell", "timestamp")
+    for start in range(0, len(rows), INSERT_CHUNK_SIZE):
+        chunk = [{"device_id": row["device_id"], "latitude": row["latitude"], "longitude": row["longitude"],
+                  "timestamp": row["timestamp"], "cell": cell_for(row["latitude"], row["longitude"])}
+                 for row in rows[start:start + INSERT_CHUNK_SIZE]]
+        if dialect == "mysql":
+            statement = mysql.insert(table).values(chunk)
+            is_newer = statement.inserted.timestamp > table.c.timestamp
+            statement = statement.on_duplicate_key_update([
+                (column, func.if_(is_newer, statement.inserted[column], table.c[column])) for column in updated_columns
+            ])
+        elif dialect == "sqlite":
+            statement = sqlite.insert(table).values(chunk)
+            statement = statement.on_conflict_do_update(
+                index_elements=["device_id"],
+                set_={column: statement.excluded[column] for column in updated_columns},
+                where=statement.excluded.timestamp > table.c.timestamp)
+        else:
+            raise NotImplementedError(f"Upserting latest locations is not supported on {dialect}")
+        db.execute(statement)
+
+
+def get_rollup_watermark(db: Session) -> Optional[datetime]:
+    """Returns the end of the newest rolled up hour."""
+    hour = db.scalar(select(func.max(LocationRollup.hour)))
+    return None if hour is None else hour + ROLLUP_PERIOD
+
+
+def get_next_location_timestamp(db: Session, since: datetime = None, until: datetime = None) -> Optional[datetime]:
+    """Returns the oldest fix timestamp in [since, until), served by the timestamp index."""
+    statement = select(func.min(Location.timestamp))
+    if since is not None:
+        statement = statement.where(Location.timestamp >= since)
+    if until is not None:
+        statement = statement.where(Location.timestamp < until)
+    return db.scalar(statement)
+
+
+def rollup_locations(hour: datetime, db: Session) -> int:
+    """
+    (Re)builds the rollups of the hour starting at ``hour`` from its raw fixes with one INSERT ... SELECT and
+    returns the number of devices rolled up. Fixes of deleted devices are skipped.
+    """
+    window = {"partition_by": Location.device_id}
+    ranked = (select(Location.device_id, Location.latitude, Location.longitude, Location.timestamp,
+                     func.row_number().over(order_by=(Location.timestamp.desc(), Location.id.desc()),
+                                            **window).label("rank"),
+                     func.count().over(**window).label("fix_count"),
+                     func.avg(Location.latitude).over(**window).label("average_latitude"),
+                     func.avg(Location.longitude).over(**window).label("average_longitude"))
+              .join(Device, Device.id == Location.device_id)
+              .where(Location.timestamp >= hour, Location.timestamp < hour + ROLLUP_PERIOD)
+              .subquery())
+    columns = ["device_id", "latitude", "longitude", "timestamp", "fix_count", "average_latitude",
+               "average_longitude"]
+    rows = select(literal(hour, DateTime), *(ranked.c[column] for column in columns)).where(ranked.c.rank == 1)
+    db.execute(delete(LocationRollup).where(LocationRollup.hour == hour))
+    return db.execute(insert(LocationRollup.__table__).from_select(["hour", *columns], rows)).rowcount
+
+
+def delete_locations_before(cutoff: datetime, db: Session, chunk_size: int = DELETE_ID_RANGE) -> int:
+    """
+    Deletes raw fixes older than cutoff by ranges of chunk_size ids, committing after each range.
+
+    This is the fallback for databases that aren't partitioned: unlike dropping a MySQL partition, its cost grows
+    with the number of expired fixes.
+    """
+    low, high = db.execute(select(func.min(Location.id), func.max(Location.id))
+                           .where(Location.timestamp < cutoff)).one()
+    deleted = 0
+    if low is None:
+        return deleted
+    for start in range(low, high + 1, chunk_size):
+        deleted += db.execute(delete(Location).where(Location.id >= start, Location.id < start + chunk_size,
+                                                     Location.timestamp < cutoff)).rowcount
+        db.commit()
+    return deleted
+
+
+def delete_rollups_before(cutoff: datetime, db: Session) -> int:
+    deleted = db.execute(delete(LocationRollup).where(LocationRollup.hour < cutoff)).rowcount
+    db.commit()
+    return deleted
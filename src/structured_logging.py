@@ -0,0 +1,163 @@
+"""
+Logging setup shared by all entry points, see ``config.py``.
+
+``configure_logging`` hands every record to a bounded in-memory queue and returns immediately; a background thread
+formats and writes them, as one JSON object per line by default. Records are queued as they are, so messages are
+only built from their ``%`` arguments once they are written; pass arguments instead of f-strings and don't mutate
+them after logging. When the queue is full, records are dropped rather than blocking the caller.
+
+Per-message events are logged through an ``EventLogger``, which samples them (one in every N) and rate limits them
+(at most N per second) before a record is even created, as configured per event name in ``config.py``.
+"""
+import atexit
+import json
+import logging
+import logging.handlers
+import queue
+import sys
+import time
+from datetime import datetime, timezone
+
+import config as cfg
+from src.metrics import Counter
+
+LOG_FORMAT_JSON = "json"
+LOG_FORMAT_TEXT = "text"
+# Attributes every LogRecord has, and uvicorn's colored duplicate of the message; anything else on a record was
+# passed in ``extra`` and is written as a field.
+RECORD_ATTRIBUTES = frozenset(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime",
+                                                                                      "color_message"}
+
+DROPPED_RECORDS = Counter("log_records_dropped_total", "Log records dropped because the log queue was full.")
+
+_listener = None
+
+
+class JsonFormatter(logging.Formatter):
+    def __init__(self, static_fields: dict = None):
+        super().__init__()
+        self.static_fields = static_fields or {}
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec="milliseconds"),
+                 "level": record.levelname, "logger": record.name, "message": record.getMessage(),
+                 **self.static_fields}
+        entry.update((key, value) for key, value in vars(record).items() if key not in RECORD_ATTRIBUTES)
+        if record.exc_info:
+            entry["exception"] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            entry["exception"] = record.exc_text
+        if record.stack_info:
+            entry["stack"] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundQueueHandler(logging.handlers.QueueHandler):
+    """Queues records unformatted and drops them when the queue is full."""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.inc()
+
+
+def configure_logging(level: str = None, log_format: str = None, queue_size: int = None, stream=None,
+                      **static_fields) -> logging.handlers.QueueListener:
+    """
+    Replaces the handlers of the root logger with a queue drained by a background writer thread.
+
+    Arguments left out are taken from ``config.py``. ``static_fields`` are added to every JSON record, e.g. the
+    worker of a process. Calling it again replaces the previous setup; queued records are flushed at exit.
+    """
+    global _listener
+    level = level or cfg.LOG_LEVEL
+    log_format = log_format or cfg.LOG_FORMAT
+    if log_format == LOG_FORMAT_JSON:
+        formatter = JsonFormatter(static_fields)
+    elif log_format == LOG_FORMAT_TEXT:
+        prefix = "".join(f"-[{key} {value}]" for key, value in static_fields.items())
+        formatter = logging.Formatter(cfg.LOGGING_FORMAT.replace("->", f"{prefix}->"), datefmt=cfg.TIME_FORMAT)
+    else:
+        raise ValueError(f"Unknown log format: {log_format}")
+    writer = logging.StreamHandler(stream or sys.stderr)
+    writer.setFormatter(formatter)
+
+    if _listener is not None:
+        _listener.stop()
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    log_queue = queue.Queue(queue_size if queue_size is not None else cfg.LOG_QUEUE_SIZE)
+    root.addHandler(BackgroundQueueHandler(log_queue))
+    root.setLevel(getattr(logging, level))
+    for name, logger_level in cfg.LOGGER_LEVELS.items():
+        logging.getLogger(name).setLevel(getattr(logging, logger_level))
+    _listener = logging.handlers.QueueListener(log_queue, writer)
+    _listener.start()
+    return _listener
+
+
+def stop_logging():
+    """Writes the records still queued and stops the writer thread."""
+    global _listener
+    if _listener is not None:
+        _listener.stop()
+        _listener = None
+
+
+atexit.register(stop_logging)
+
+
+class EventLogger:
+    """
+    Logs one kind of per-message event, e.g. every fix received, without a record for every occurrence.
+
+    Only every ``sample_every``-th occurrence is logged, and at most ``rate_limit`` per second (0 for no limit);
+    both default to the event's entry in ``config.py``. Each record carries the event name and how many
+    occurrences were skipped since the previous one. Counting isn't synchronized, so with several threads the
+    sampling is approximate.
+    """
+
+    def __init__(self, logger: logging.Logger, event: str, sample_every: int = None, rate_limit: float = None):
+        self.logger = logger
+        self.event = event
+        if sample_every is None:
+            sample_every = cfg.LOG_EVENT_SAMPLING.get(event, 1)
+        self.sample_every = max(1, sample_every)
+        self.rate_limit = rate_limit if rate_limit is not None else cfg.LOG_EVENT_RATE_LIMITS.get(event, 0)
+        self.occurrences = 0
+        self.skipped = 0
+        self.window_start = 0.0
+        self.window_count = 0
+
+    def allow(self) -> bool:
+        self.occurrences += 1
+        if self.occurrences % self.sample_every:
+            self.skipped += 1
+            return False
+        if self.rate_limit:
+            now = time.monotonic()
+            if now - self.window_start >= 1:
+                self.window_start = now
+                self.window_count = 0
+            if self.window_count >= self.rate_limit:
+                self.skipped += 1
+                return False
+            self.window_count += 1
+        return True
+
+    def log(self, level: int, msg: str, *args):
+        if not self.logger.isEnabledFor(level) or not self.allow():
+            return
+        skipped, self.skipped = self.skipped, 0
+        self.logger.log(level, msg, *args, extra={"event": self.event, "skipped": skipped}, stacklevel=3)
+
+    def debug(self, msg: str, *args):
+        self.log(logging.DEBUG, msg, *args)
+
+    def info(self, msg: str, *args):
+        self.log(logging.INFO, msg, *args)
@@ -0,0 +1,91 @@
+"""
+Vectorized simplification of a device's track.
+
+All functions take the columns of a track ordered by time, as NumPy arrays, and return the indices of the fixes
+to keep together with the latitudes and longitudes to report for them.
+
+``douglas_peucker`` refines every segment of the current approximation in one vectorized pass over all points
+per level, so a track costs O(n) per level of the Douglas-Peucker tree instead of one Python call per segment.
+The tree is about log2(n) levels deep for typical tracks but up to n for some, e.g. a spiral, so refinement stops
+after ``MAX_LEVELS`` levels, bounding the cost to O(n * MAX_LEVELS). ``bucket`` is a single linear pass.
+"""
+import numpy as np
+
+from src.spatial_index import METERS_PER_DEGREE_LATITUDE
+
+BUCKET_LAST = "last"
+BUCKET_AVERAGE = "average"
+MAX_LEVELS = 64
+
+
+def _project(latitudes: np.ndarray, longitudes: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+    """Projects to local equirectangular meters, unwrapping longitudes so tracks may cross the antimeridian."""
+    longitudes = np.unwrap(longitudes, period=360)
+    scale = np.cos(np.radians(latitudes.mean())) * METERS_PER_DEGREE_LATITUDE
+    return longitudes * scale, latitudes * METERS_PER_DEGREE_LATITUDE
+
+
+def douglas_peucker(latitudes: np.ndarray, longitudes: np.ndarray, tolerance_meters: float,
+                    max_levels: int = MAX_LEVELS) -> tuple:
+    """
+    Keeps the fixes needed to stay within tolerance_meters of the original track; the ends are always kept.
+
+    Segments that are still off by more than the tolerance after max_levels levels are thinned in one linear pass
+    instead: of every run of consecutive fixes in the same cell of a grid whose cells are tolerance_meters across
+    diagonally, only the first is kept, so every dropped fix is within the tolerance of a kept one. The result
+    stays within the tolerance at O(n * max_levels) cost.
+    """
+    count = len(latitudes)
+    if count <= 2:
+        return np.arange(count), latitudes, longitudes
+    x, y = _project(latitudes, longitudes)
+    keep = np.zeros(count, dtype=bool)
+    keep[[0, -1]] = True
+    positions = np.arange(count)
+    for level in range(max_levels + 1):
+        kept = np.flatnonzero(keep)
+        # Every point belongs to the segment between the last kept point before it and the next one.
+        segment = np.searchsorted(kept, positions, side="right") - 1
+        segment[-1] = len(kept) - 2
+        start, end = kept[segment], kept[segment + 1]
+        dx, dy = x[end] - x[start], y[end] - y[start]
+        length = np.hypot(dx, dy)
+        cross = np.abs(dx * (y[start] - y) - dy * (x[start] - x))
+        distance = np.where(length > 0, cross / np.where(length > 0, length, 1),
+                            np.hypot(x - x[start], y - y[start]))
+        distance[keep] = 0
+        farthest = np.maximum.reduceat(distance, kept[:-1])
+        candidates = np.flatnonzero((distance > tolerance_meters) & (distance == farthest[segment]))
+        if not len(candidates):
+            break
+        if level == max_levels:
+            cell_size = tolerance_meters / np.sqrt(2)
+            cell_x, cell_y = np.floor(x / cell_size), np.floor(y / cell_size)
+            run_starts = np.r_[True, (cell_x[1:] != cell_x[:-1]) | (cell_y[1:] != cell_y[:-1])] | keep
+            keep |= run_starts & (farthest[segment] > tolerance_meters)
+            break
+        # One new point per segment, the first of equally distant ones.
+        _, first = np.unique(segment[candidates], return_index=True)
+        keep[candidates[first]] = True
+    kept = np.flatnonzero(keep)
+    return kept, latitudes[kept], longitudes[kept]
+
+
+def bucket(timestamps: np.ndarray, latitudes: np.ndarray, longitudes: np.ndarray, bucket_seconds: int,
+           mode: str = BUCKET_LAST) -> tuple:
+    """
+    Keeps one fix per bucket_seconds, aligned to the epoch, represented by the bucket's last fix.
+
+    With ``average`` the position reported for a bucket is the mean position of its fixes instead.
+    """
+    if not len(timestamps):
+        return np.arange(0), latitudes, longitudes
+    buckets = timestamps // bucket_seconds
+    starts = np.flatnonzero(np.r_[True, buckets[1:] != buckets[:-1]])
+    last = np.r_[starts[1:], len(timestamps)] - 1
+    if mode == BUCKET_LAST:
+        return last, latitudes[last], longitudes[last]
+    counts = np.diff(np.r_[starts, len(timestamps)])
+    unwrapped = np.unwrap(longitudes, period=360)
+    average_longitudes = (np.add.reduceat(unwrapped, starts) / counts + 180) % 360 - 180
+    return last, np.add.reduceat(latitudes, starts) / counts, average_longitudes
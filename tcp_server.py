@@ -1,4 +1,4 @@
-import json
+import asyncio
 import logging
 import os
 import queue
@@ -8,61 +8,229 @@ import time
 
 from dotenv import load_dotenv
 
-import config as cfg
+from src.device_registry import DeviceRegistry
+from src.ingest_buffer import IngestBuffer, OVERFLOW_BLOCK, report_buffer_stats
+from src.metrics import Counter, Gauge, Histogram, start_metrics_server
+from src.partitioning import partition_queue_name, split_by_partition
+from src.protocol import DeviceSession
+from src.service.database_service import connect_to_db
+from src.service.device_registry_service import DeviceRegistrySync
 from src.service.publisher_service import RabbitMQPublisherService
+from src.service.transport_service import TRANSPORT_RABBITMQ, TRANSPORT_UNIX, create_transport
+from src.structured_logging import EventLogger, configure_logging
 
 load_dotenv()
 tcp_server_host = os.getenv("TCP_SERVER_HOST", "0.0.0.0")
 tcp_server_port = int(os.getenv("TCP_SERVER_PORT", "65432"))
+tcp_server_mode = os.getenv("TCP_SERVER_MODE", "threaded")
+tcp_server_backlog = int(os.getenv("TCP_SERVER_BACKLOG", "1024"))
+tcp_server_read_timeout = float(os.getenv("TCP_SERVER_READ_TIMEOUT", "10"))
 rabbitmq_host = os.getenv("RABBITMQ_HOST")
 rabbitmq_port = os.getenv("RABBITMQ_PORT")
 rabbitmq_queue = os.getenv("RABBITMQ_GPS_QUEUE")
+rabbitmq_gps_partitions = int(os.getenv("RABBITMQ_GPS_PARTITIONS", "1"))
+rabbitmq_device_events_exchange = os.getenv("RABBITMQ_DEVICE_EVENTS_EXCHANGE", "device_events")
+device_registry_at_ingress = os.getenv("DEVICE_REGISTRY_AT_INGRESS", "false").lower() == "true"
+device_registry_resync_interval = float(os.getenv("DEVICE_REGISTRY_RESYNC_INTERVAL", "300"))
+db_url = os.getenv("DATABASE_URL")
+publish_batch_size = int(os.getenv("RABBITMQ_PUBLISH_BATCH_SIZE", "500"))
+publish_linger_ms = float(os.getenv("RABBITMQ_PUBLISH_LINGER_MS", "20"))
+ingest_buffer_high_watermark = int(os.getenv("INGEST_BUFFER_HIGH_WATERMARK", "100000"))
+ingest_buffer_low_watermark = int(os.getenv("INGEST_BUFFER_LOW_WATERMARK", "50000"))
+ingest_buffer_overflow = os.getenv("INGEST_BUFFER_OVERFLOW", OVERFLOW_BLOCK)
+ingest_spill_dir = os.getenv("INGEST_SPILL_DIR", "ingest_spill")
+ingest_spill_segment_bytes = int(os.getenv("INGEST_SPILL_SEGMENT_BYTES", str(64 * 1024 * 1024)))
+ingest_buffer_stats_interval = float(os.getenv("INGEST_BUFFER_STATS_INTERVAL", "30"))
+tcp_server_metrics_port = int(os.getenv("TCP_SERVER_METRICS_PORT", "9100"))
+gps_transport = os.getenv("GPS_TRANSPORT", TRANSPORT_RABBITMQ)
+gps_transport_socket_dir = os.getenv("GPS_TRANSPORT_SOCKET_DIR", "gps_transport")
+gps_transport_max_in_flight = int(os.getenv("GPS_TRANSPORT_MAX_IN_FLIGHT", "1000"))
 logger = logging.getLogger(__name__)
+connected_log = EventLogger(logger, "device_connected")
+received_log = EventLogger(logger, "fix_received")
+
+READ_CHUNK_SIZE = 64 * 1024
+BACKPRESSURE_POLL_INTERVAL = 0.05
+
+CONNECTIONS_ACCEPTED = Counter("tcp_connections_accepted_total", "Device connections accepted.")
+CONNECTIONS_ACTIVE = Gauge("tcp_connections_active", "Device connections currently open.")
+FIXES_RECEIVED = Counter("tcp_fixes_received_total", "Fixes accepted from devices.")
+FEED_SECONDS = Histogram("tcp_feed_seconds",
+                         "Time to parse one socket read and hand its fixes to the ingest buffer.")
+INGEST_BUFFER_DEPTH = Gauge("ingest_buffer_depth", "Items in the ingest buffer, in memory and spilled.")
+INGEST_BUFFER_SPILLED = Gauge("ingest_buffer_spilled_items", "Items of the ingest buffer spilled to disk.")
 
 
 class TCPServer:
-    def __init__(self, host: str, port: int, output_queue: queue.Queue):
+    def __init__(self, host: str, port: int, output_queue: queue.Queue, backlog: int = tcp_server_backlog,
+                 read_timeout: float = tcp_server_read_timeout, device_registry: DeviceRegistry = None):
         self.host = host
         self.port = port
         self.output_queue = output_queue
+        self.backlog = backlog
+        self.read_timeout = read_timeout
+        self.device_registry = device_registry
+
+    def filter_message(self, gps_data):
+        """Returns the fix, or the records of a binary batch, that belong to registered devices, else None."""
+        received_log.info("Received data: %r", gps_data)
+        if self.device_registry is not None:
+            if isinstance(gps_data, bytes):
+                gps_data = self.device_registry.filter_records(gps_data)
+            elif gps_data["device_id"] not in self.device_registry:
+                self.device_registry.rejected += 1
+                gps_data = None
+            if not gps_data:
+                return None
+        return gps_data
+
+    def process_message(self, gps_data):
+        gps_data = self.filter_message(gps_data)
+        if gps_data is not None:
+            self.output_queue.put(gps_data)
 
     def handle_client_connection(self, client_socket):
+        session = DeviceSession(self.process_message)
+        CONNECTIONS_ACTIVE.inc()
         try:
-            data = client_socket.recv(1024).decode('utf-8')
-            if data:
-                logger.info(f"Received data: {data}")
-                gps_data = json.loads(data)
-                self.output_queue.put(gps_data)
-                client_socket.sendall(b'ACK')
+            client_socket.settimeout(self.read_timeout)
+            while not session.closed:
+                data = client_socket.recv(READ_CHUNK_SIZE)
+                reply = self.feed_session(session, data)
+                if reply:
+                    client_socket.sendall(reply)
+        except socket.timeout:
+            logger.warning(f"Client connection timed out after {session.seq} messages")
         except Exception as e:
             logger.error(f"Error handling client connection: {e}")
         finally:
+            CONNECTIONS_ACTIVE.dec()
             client_socket.close()
 
+    @staticmethod
+    def feed_session(session: DeviceSession, data: bytes) -> bytes:
+        started = time.perf_counter()
+        seq = session.seq
+        reply = session.feed(data) if data else session.feed_eof()
+        FEED_SECONDS.observe(time.perf_counter() - started)
+        FIXES_RECEIVED.inc(session.seq - seq)
+        return reply
+
     def start(self):
         with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as server_socket:
             server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
             server_socket.bind((self.host, self.port))
-            server_socket.listen(5)
+            server_socket.listen(self.backlog)
             logger.info(f"Server listening on {self.host}:{self.port}")
 
             while True:
                 client_socket, client_address = server_socket.accept()
-                logger.info(f"Connected by {client_address}")
-                self.handle_client_connection(client_socket)
+                CONNECTIONS_ACCEPTED.inc()
+                connected_log.info("Connected by %s", client_address)
+                threading.Thread(target=self.handle_client_connection, args=(client_socket,), daemon=True).start()
+
+
+class AsyncTCPServer(TCPServer):
+    """Single-threaded asyncio variant of TCPServer.
+
+    Every connection is served by its own coroutine, so a slow or stalled device only holds its own
+    read timeout instead of tying up a thread. The fixes of a read are handed to the output queue with
+    ``put_nowait``; while the queue is full, the connection waits before queuing the rest and acknowledging
+    them, and stops reading from its socket, rather than blocking the event loop in ``put``.
+    """
+
+    async def enqueue(self, pending: list):
+        """Puts the fixes of one read into the output queue, yielding to other connections while it is full."""
+        for gps_data in pending:
+            while True:
+                try:
+                    self.output_queue.put_nowait(gps_data)
+                    break
+                except queue.Full:
+                    await asyncio.sleep(BACKPRESSURE_POLL_INTERVAL)
+        pending.clear()
+
+    async def handle_client_connection_async(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        pending = []
+
+        def collect(gps_data):
+            gps_data = self.filter_message(gps_data)
+            if gps_data is not None:
+                pending.append(gps_data)
+
+        session = DeviceSession(collect)
+        CONNECTIONS_ACCEPTED.inc()
+        CONNECTIONS_ACTIVE.inc()
+        try:
+            connected_log.info("Connected by %s", writer.get_extra_info("peername"))
+            while not session.closed:
+                while self.output_queue.full():
+                    await asyncio.sleep(BACKPRESSURE_POLL_INTERVAL)
+                data = await asyncio.wait_for(reader.read(READ_CHUNK_SIZE), timeout=self.read_timeout)
+                reply = self.feed_session(session, data)
+                await self.enqueue(pending)
+                if reply:
+                    writer.write(reply)
+                    await writer.drain()
+        except asyncio.TimeoutError:
+            logger.warning(f"Client connection timed out after {session.seq} messages")
+        except Exception as e:
+            logger.error(f"Error handling client connection: {e}")
+        finally:
+            CONNECTIONS_ACTIVE.dec()
+            writer.close()
+
+    async def serve(self):
+        server = await asyncio.start_server(self.handle_client_connection_async, self.host, self.port,
+                                            backlog=self.backlog, reuse_address=True)
+        logger.info(f"Async server listening on {self.host}:{self.port}")
+        async with server:
+            await server.serve_forever()
+
+    def start(self):
+        asyncio.run(self.serve())
+
+
+TCP_SERVER_MODES = {"threaded": TCPServer, "asyncio": AsyncTCPServer}
 
 
 class RabbitMQPublisher(RabbitMQPublisherService):
-    def __init__(self, input_queue, rabbitmq_queue_name, *args, **kwargs):
+    def __init__(self, input_queue, rabbitmq_queue_name, *args, batch_size: int = publish_batch_size,
+                 linger_ms: float = publish_linger_ms, partitions: int = rabbitmq_gps_partitions, **kwargs):
         super().__init__(*args, **kwargs)
         self.input_queue = input_queue
         self.rabbitmq_queue_name = rabbitmq_queue_name
+        self.batch_size = batch_size
+        self.linger = linger_ms / 1000
+        self.partitions = partitions
+
+    def get_batch(self) -> list:
+        """Blocks for the first message, then collects more until the batch is full or the linger time passes."""
+        batch = [self.input_queue.get()]
+        deadline = time.monotonic() + self.linger
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                batch.append(self.input_queue.get(timeout=remaining) if remaining > 0
+                             else self.input_queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def publish_partitioned(self, pending: dict):
+        """Publishes every partition's messages to its own queue, removing each partition once confirmed."""
+        for partition in list(pending):
+            self.publish_batch(partition_queue_name(self.rabbitmq_queue_name, partition, self.partitions),
+                               pending[partition])
+            del pending[partition]
 
     def listen_internal_queue(self):
+        pending = {}
         while True:
             try:
-                data = self.input_queue.get()
-                self.publish(self.rabbitmq_queue_name, data)
+                if not pending:
+                    pending = split_by_partition(self.get_batch(), self.partitions)
+                self.publish_partitioned(pending)
             except (KeyboardInterrupt, InterruptedError):
                 logger.info('Terminating internal queue listener...')
                 break
@@ -72,17 +240,44 @@ class RabbitMQPublisher(RabbitMQPublisherService):
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
-    logging.getLogger("pika").setLevel(logging.WARNING)
+    configure_logging()
 
-    if not (rabbitmq_host and rabbitmq_port and rabbitmq_queue):
+    if not rabbitmq_queue or (gps_transport == TRANSPORT_RABBITMQ and not (rabbitmq_host and rabbitmq_port)):
         logger.error("Error: One or more RabbitMQ environment variables are missing.")
         exit(1)
 
-    internal_queue = queue.Queue()
-    server = TCPServer(host=tcp_server_host, port=tcp_server_port, output_queue=internal_queue)
+    if gps_transport not in (TRANSPORT_RABBITMQ, TRANSPORT_UNIX):
+        logger.error(f"Error: Unknown GPS_TRANSPORT '{gps_transport}', expected rabbitmq or unix.")
+        exit(1)
+
+    if tcp_server_mode not in TCP_SERVER_MODES:
+        logger.error(f"Error: Unknown TCP_SERVER_MODE '{tcp_server_mode}', expected one of {list(TCP_SERVER_MODES)}.")
+        exit(1)
+
+    internal_queue = IngestBuffer(high_watermark=ingest_buffer_high_watermark,
+                                  low_watermark=ingest_buffer_low_watermark, overflow=ingest_buffer_overflow,
+                                  spill_dir=ingest_spill_dir, segment_size=ingest_spill_segment_bytes)
+    threading.Thread(target=report_buffer_stats, args=(internal_queue, ingest_buffer_stats_interval),
+                     daemon=True).start()
+    INGEST_BUFFER_DEPTH.set_function(internal_queue.qsize)
+    INGEST_BUFFER_SPILLED.set_function(lambda: internal_queue.stats()["spilled_items"])
+    if tcp_server_metrics_port:
+        start_metrics_server(tcp_server_metrics_port)
+    ingress_device_registry = None
+    if device_registry_at_ingress:
+        if not db_url:
+            logger.error("Error: DATABASE_URL is required to filter unknown devices at ingress.")
+            exit(1)
+        ingress_device_registry = DeviceRegistry()
+        DeviceRegistrySync(ingress_device_registry, connect_to_db(db_url), rabbitmq_host, rabbitmq_port,
+                           exchange=rabbitmq_device_events_exchange,
+                           resync_interval=device_registry_resync_interval).start()
+    server = TCP_SERVER_MODES[tcp_server_mode](host=tcp_server_host, port=tcp_server_port,
+                                               output_queue=internal_queue, device_registry=ingress_device_registry)
     threading.Thread(target=server.start, daemon=True).start()
+    transport = create_transport(gps_transport, rabbitmq_host=rabbitmq_host, rabbitmq_port=rabbitmq_port,
+                                 socket_dir=gps_transport_socket_dir, max_in_flight=gps_transport_max_in_flight)
     rabbitmq_publisher = RabbitMQPublisher(input_queue=internal_queue, rabbitmq_queue_name=rabbitmq_queue,
                                            rabbitmq_host=rabbitmq_host,
-                                           rabbitmq_port=rabbitmq_port)
+                                           rabbitmq_port=rabbitmq_port, transport=transport)
     rabbitmq_publisher.listen_internal_queue()
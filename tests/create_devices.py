@@ -4,7 +4,7 @@ import os
 import requests
 from dotenv import load_dotenv
 
-import config as cfg
+from src.structured_logging import configure_logging
 
 logger = logging.getLogger(__name__)
 
@@ -13,13 +13,14 @@ webserver_url = os.getenv("WEBSERVER_URL", "http://localhost:8081")
 num_devices = int(os.getenv("NUM_DEVICES_TO_GENERATE", 100))
 
 
-def create_devices(server_url: str, num_devices: int):
+def create_devices(server_url: str, num_devices: int, batch_size: int = 1000):
     """
-    Creates a specified number of devices.
+    Creates a specified number of devices with createDevices, batch_size devices per request.
 
     Args:
         server_url: The base URL of webserver.
         num_devices: The number of devices to create.
+        batch_size: The number of devices created per request.
 
     Returns:
         None
@@ -27,25 +28,25 @@ def create_devices(server_url: str, num_devices: int):
 
     session = requests.Session()
     query = """
-    mutation {
-        createDevice(input: { name: "Device %s" }) {
-            id
-            name
+    mutation($inputs: [DeviceCreateInput!]!) {
+        createDevices(inputs: $inputs) {
+            devices { id }
+            conflicts { name reason }
         }
     }
     """
-    successful_creations = 0
-    for i in range(num_devices):
-        device_name = query % (i + 1)
-        response = session.post(server_url + "/graphql", json={"query": device_name})
-
-        if response.status_code == 200:
-            successful_creations += 1
-    logger.info(f"{successful_creations}/{num_devices} device create requests sent successfully")
-
+    created = conflicts = 0
+    for start in range(0, num_devices, batch_size):
+        inputs = [{"name": f"Device {i + 1}"} for i in range(start, min(start + batch_size, num_devices))]
+        response = session.post(server_url + "/graphql", json={"query": query, "variables": {"inputs": inputs}})
+        response.raise_for_status()
+        result = response.json()["data"]["createDevices"]
+        created += len(result["devices"])
+        conflicts += len(result["conflicts"])
+    logger.info(f"{created}/{num_devices} devices created, {conflicts} already existed or were rejected")
 
 
 if __name__ == "__main__":
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
+    configure_logging()
 
     create_devices(webserver_url, num_devices)
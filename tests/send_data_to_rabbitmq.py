@@ -1,9 +1,9 @@
 import logging
 import os
 
-import config as cfg
 from src.iot_device import IoTDevice
 from src.service.publisher_service import RabbitMQPublisherService
+from src.structured_logging import configure_logging
 
 IOT_DEVICE_ID = 1
 
@@ -13,7 +13,7 @@ rabbitmq_queue = os.getenv("RABBITMQ_GPS_QUEUE")
 logger = logging.getLogger(__name__)
 
 if __name__ == '__main__':
-    logging.basicConfig(level=getattr(logging, cfg.LOG_LEVEL), format=cfg.LOGGING_FORMAT, datefmt=cfg.TIME_FORMAT)
+    configure_logging()
     if not (rabbitmq_host and rabbitmq_port and rabbitmq_queue):
         logger.error("Error: One or more RabbitMQ environment variables are missing.")
         exit(1)
@@ -21,3 +21,4 @@ if __name__ == '__main__':
     device_gps_data = iot_device.generate_gps_data()
     rabbitmq_publisher_service = RabbitMQPublisherService(rabbitmq_host=rabbitmq_host, rabbitmq_port=rabbitmq_port)
     rabbitmq_publisher_service.publish(rabbitmq_queue, device_gps_data)
+    rabbitmq_publisher_service.close()
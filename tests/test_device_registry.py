@@ -0,0 +1,59 @@
+import threading
+import time
+
+from src.device_registry import DeviceRegistry
+from src.gps_record import encode_record, decode_records
+
+
+def record(device_id):
+    return encode_record({"device_id": device_id, "timestamp": 1723000000, "latitude": 41.0, "longitude": 29.0})
+
+
+def test_membership_and_updates():
+    registry = DeviceRegistry([1, 5, 9])
+    assert 5 in registry and 2 not in registry and 10_000 not in registry
+    registry.add(10_000)
+    registry.discard(5)
+    assert 10_000 in registry and 5 not in registry
+    assert len(registry) == 3
+
+
+def test_events_during_resync_are_kept():
+    registry = DeviceRegistry([1, 2])
+    registry.begin_resync()
+    registry.add(3)
+    registry.discard(1)
+    registry.finish_resync([1, 2])
+    assert 3 in registry and 1 not in registry and 2 in registry
+
+
+def test_overlapping_resyncs_keep_events():
+    registry = DeviceRegistry([1, 2])
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load_stale_snapshot():
+        loading.set()
+        release.wait()
+        return [1, 2]
+
+    first = threading.Thread(target=registry.resync, args=(load_stale_snapshot,))
+    first.start()
+    loading.wait()
+    registry.add(3)
+    second = threading.Thread(target=registry.resync, args=(lambda: [1, 2, 3],))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join()
+    second.join()
+
+    assert 3 in registry
+
+
+def test_unknown_devices_are_filtered_and_counted():
+    registry = DeviceRegistry([1, 3])
+    records = b"".join(record(device_id) for device_id in (1, 2, 3, 4))
+    assert [r[0] for r in decode_records(registry.filter_records(records))] == [1, 3]
+    assert registry.filter_fixes([(2, 0, 0.0, 0.0), (3, 0, 0.0, 0.0)]) == [(3, 0, 0.0, 0.0)]
+    assert registry.rejected == 3
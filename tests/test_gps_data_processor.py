@@ -0,0 +1,108 @@
+import datetime
+
+import pytest
+
+from gps_data_processor import GPSDataProcessor, RabbitMQListener
+from src.gps_record import CONTENT_TYPE_RECORDS, CONTENT_TYPE_JSON, encode_record
+from src.location_store import ColumnarLocationStore
+from src.model import Device, Location, LatestLocation
+
+
+@pytest.fixture
+def processor(tmp_path):
+    gps_processor = GPSDataProcessor(f"sqlite:///{tmp_path / 'processor.db'}")
+    with gps_processor.database_service.session_local() as db:
+        db.add_all([Device(name="Device 1"), Device(name="Device 2")])
+        db.commit()
+    return gps_processor
+
+
+def fix(device_id, timestamp, latitude=41.0, longitude=29.0):
+    return {"device_id": device_id, "timestamp": timestamp, "latitude": latitude, "longitude": longitude}
+
+
+def test_batch_is_stored_in_one_transaction(processor):
+    records = b"".join(encode_record(fix(device_id, 1723000000 + i)) for i in range(3) for device_id in (1, 2))
+    processor.process_gps_batch([
+        (records, CONTENT_TYPE_RECORDS),
+        (b'[{"device_id": 1, "timestamp": 1723000010, "latitude": 1.5, "longitude": 2.5}]', CONTENT_TYPE_JSON),
+        (b"not json", CONTENT_TYPE_JSON),
+    ])
+
+    with processor.database_service.session_local() as db:
+        assert db.query(Location).count() == 7
+        latest = {row.device_id: row for row in db.query(LatestLocation)}
+    assert (latest[1].latitude, latest[1].longitude) == (1.5, 2.5)
+    assert latest[2].timestamp == datetime.datetime.utcfromtimestamp(1723000002)
+
+
+def test_out_of_order_fix_does_not_regress_latest_location(processor):
+    processor.process_gps_data(encode_record(fix(1, 1723000100, latitude=10.0)), CONTENT_TYPE_RECORDS)
+    processor.process_gps_data(encode_record(fix(1, 1723000050, latitude=5.0)), CONTENT_TYPE_RECORDS)
+    processor.process_gps_batch([(encode_record(fix(1, 1723000200, latitude=20.0)) +
+                                  encode_record(fix(1, 1723000150, latitude=15.0)), CONTENT_TYPE_RECORDS)])
+
+    with processor.database_service.session_local() as db:
+        latest = db.get(LatestLocation, 1)
+        assert db.query(Location).count() == 4
+    assert latest.latitude == 20.0
+    assert latest.timestamp == datetime.datetime.utcfromtimestamp(1723000200)
+
+
+class FakeTransport:
+    def __init__(self):
+        self.acked = []
+        self.nacked = []
+
+    def ack(self, delivery_tag):
+        self.acked.append(delivery_tag)
+
+    def nack(self, delivery_tag):
+        self.nacked.append(delivery_tag)
+
+
+def test_listener_acks_batch_only_after_processing(monkeypatch):
+    monkeypatch.setattr("gps_data_processor.time.sleep", lambda _: None)
+    batches = []
+
+    def process(batch):
+        batches.append(batch)
+        if len(batches) == 2:
+            raise RuntimeError("database is down")
+
+    listener = RabbitMQListener(process, "localhost", 5672, "gps", batch_size=2)
+    transport = FakeTransport()
+    listener.process_batch(transport, [(b"{}", CONTENT_TYPE_JSON)] * 2, 2)
+    listener.process_batch(transport, [(b"{}", CONTENT_TYPE_JSON)] * 2, 4)
+    assert transport.acked == [2]
+    assert transport.nacked == [4]
+
+
+class LocationUpdateRecorder:
+    def __init__(self):
+        self.rows = []
+
+    def locations_saved(self, rows):
+        self.rows.extend(rows)
+
+
+def test_processor_announces_newest_location_per_device(processor):
+    processor.location_updates = recorder = LocationUpdateRecorder()
+    processor.process_gps_batch([(encode_record(fix(1, 1723000200, latitude=20.0)) +
+                                  encode_record(fix(1, 1723000100, latitude=10.0)) +
+                                  encode_record(fix(2, 1723000100)), CONTENT_TYPE_RECORDS)])
+
+    assert sorted((row["device_id"], row["latitude"]) for row in recorder.rows) == [(1, 20.0), (2, 41.0)]
+
+
+def test_columnar_store_replaces_the_locations_table(processor, tmp_path):
+    processor.location_store = store = ColumnarLocationStore(str(tmp_path / "store"))
+    processor.process_gps_batch([(encode_record(fix(1, 1723000200, latitude=20.0)) +
+                                  encode_record(fix(1, 1723000100, latitude=10.0)) +
+                                  encode_record(fix(2, 1723000100)), CONTENT_TYPE_RECORDS)])
+
+    with processor.database_service.session_local() as db:
+        assert db.query(Location).count() == 0
+        assert db.get(LatestLocation, 1).latitude == 20.0
+    assert store.read(1).latitudes.tolist() == [10.0, 20.0]
+    assert store.read(2).timestamps.tolist() == [datetime.datetime.utcfromtimestamp(1723000100)]
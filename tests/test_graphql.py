@@ -1,15 +1,30 @@
+import calendar
+import gzip
+import json
+import time
+from datetime import datetime, timedelta
+
 import pytest
 from fastapi.testclient import TestClient
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.ext.asyncio import AsyncSession, create_async_engine
 from sqlalchemy.orm import sessionmaker
 
 from main_web import app, get_context, database_service
-from src.model import Base
+from src.last_location_cache import CachedLocation, LastLocationCache
+from src.location_store import ColumnarLocationStore
+from src.location_subscriptions import LocationSubscriptionHub
+from src.model import Base, Device, LatestLocation, Location, LocationRollup
+from src.service.database_service import async_database_url
+from src.sql_query import upsert_latest_locations
 
 TEST_DATABASE_URL = "sqlite:///./test.db"
 
 engine = create_engine(TEST_DATABASE_URL, connect_args={"check_same_thread": False})
 TestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+async_engine = create_async_engine(async_database_url(TEST_DATABASE_URL))
+AsyncTestingSessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=async_engine, class_=AsyncSession,
+                                        expire_on_commit=False)
 
 
 @pytest.fixture(scope="function")
@@ -23,22 +38,18 @@ def db_session():
         Base.metadata.drop_all(bind=engine)
 
 
-@pytest.fixture(scope="function")
-def client(db_session):
-    # Override the get_db dependency to use the test database session
-    def _get_db_override():
-        try:
-            yield db_session
-        finally:
-            db_session.close()
-
-    # Override the context to include the test database session
-    def _get_context_override():
-        return {"db": db_session}
-
-    app.dependency_overrides[database_service.get_db] = _get_db_override
+def override_context(**context):
+    # Override the context to include an async session on the test database
+    async def _get_context_override():
+        async with AsyncTestingSessionLocal() as db:
+            yield {"db": db, **context}
+
     app.dependency_overrides[get_context] = _get_context_override
 
+
+@pytest.fixture(scope="function")
+def client(db_session):
+    override_context()
     return TestClient(app)
 
 
@@ -116,3 +127,363 @@ def test_all_devices(client):
 
     assert response.status_code == 200
     assert len(data["data"]["allDevices"]) > 0
+
+
+class DeviceEventRecorder:
+    def __init__(self):
+        self.events = []
+
+    def device_created(self, device_ids):
+        self.events.append(("created", device_ids))
+
+    def device_deleted(self, device_ids):
+        self.events.append(("deleted", device_ids))
+
+
+def test_device_mutations_publish_events(client, db_session):
+    recorder = DeviceEventRecorder()
+    override_context(device_events=recorder)
+    response = client.post("/graphql", json={"query": 'mutation { createDevice(input: { name: "Tracker" }) { id } }'})
+    device_id = response.json()["data"]["createDevice"]["id"]
+    client.post("/graphql", json={"query": "mutation { deleteDevice(input: { id: %d }) { id } }" % device_id})
+
+    assert recorder.events == [("created", [device_id]), ("deleted", [device_id])]
+
+
+def test_bulk_device_mutations_report_conflicts(client, db_session):
+    db_session.add(Device(name="Existing"))
+    db_session.commit()
+    recorder = DeviceEventRecorder()
+    override_context(device_events=recorder)
+    create = """
+    mutation($inputs: [DeviceCreateInput!]!) {
+        createDevices(inputs: $inputs) { devices { id name } conflicts { index name reason } }
+    }
+    """
+    delete = """
+    mutation($inputs: [DeviceDeleteInput!]!) {
+        deleteDevices(inputs: $inputs) { devices { id name } conflicts { index id reason } }
+    }
+    """
+    names = ["Tracker 1", "Existing", "Tracker 2", "Tracker 1", "x" * 300]
+
+    created = client.post("/graphql", json={"query": create, "variables": {
+        "inputs": [{"name": name} for name in names]}}).json()["data"]["createDevices"]
+    ids = [device["id"] for device in created["devices"]]
+    db_session.add(Location(device_id=ids[0], latitude=41.0, longitude=29.0, timestamp=datetime(2024, 8, 7, 12)))
+    db_session.commit()
+    deleted = client.post("/graphql", json={"query": delete, "variables": {
+        "inputs": [{"id": ids[0]}, {"id": 12345}, {"id": ids[1]}]}}).json()["data"]["deleteDevices"]
+
+    assert [device["name"] for device in created["devices"]] == ["Tracker 1", "Tracker 2"]
+    assert [(conflict["index"], conflict["reason"]) for conflict in created["conflicts"]] == [
+        (1, "a device with this name already exists"), (3, "name is repeated in the inputs"),
+        (4, "name is longer than 255 characters")]
+    assert deleted["devices"] == created["devices"]
+    assert deleted["conflicts"] == [{"index": 1, "id": 12345, "reason": "device not found"}]
+    assert recorder.events == [("created", ids), ("deleted", ids)]
+    assert [device.name for device in db_session.query(Device)] == ["Existing"]
+    assert db_session.query(Location).count() == 0
+
+
+def test_create_devices_reports_only_the_devices_it_created(client, db_session):
+    created_elsewhere = []
+
+    def create_concurrently(conn, cursor, statement, parameters, context, executemany):
+        if statement.startswith("INSERT INTO devices") and not created_elsewhere:
+            created_elsewhere.append(True)
+            with engine.begin() as other:
+                other.execute(Device.__table__.insert().values(name="Tracker 2"))
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", create_concurrently)
+    try:
+        created = client.post("/graphql", json={"query": """
+        mutation {
+            createDevices(inputs: [{name: "Tracker 1"}, {name: "Tracker 2"}]) {
+                devices { name } conflicts { index reason }
+            }
+        }
+        """}).json()["data"]["createDevices"]
+    finally:
+        event.remove(async_engine.sync_engine, "before_cursor_execute", create_concurrently)
+
+    assert created["devices"] == [{"name": "Tracker 1"}]
+    assert created["conflicts"] == [{"index": 1, "reason": "a device with this name already exists"}]
+    assert db_session.query(Device).count() == 2
+
+
+def test_last_locations(client, db_session):
+    device = Device(name="Tracker")
+    db_session.add(device)
+    db_session.commit()
+    db_session.add(LatestLocation(device_id=device.id, latitude=41.0, longitude=29.0,
+                                  timestamp=datetime(2024, 8, 7, 12, 0, 0)))
+    db_session.commit()
+
+    query = "query { lastLocations { deviceId latitude longitude timestamp } }"
+    response = client.post("/graphql", json={"query": query})
+    data = response.json()
+
+    assert response.status_code == 200
+    assert data["data"]["lastLocations"] == [
+        {"deviceId": device.id, "latitude": 41.0, "longitude": 29.0, "timestamp": "2024-08-07T12:00:00"}
+    ]
+
+
+def test_last_locations_are_served_from_a_fresh_cache(client, db_session):
+    cache = LastLocationCache(max_staleness=5)
+    cache.update([CachedLocation(7, 41.0, 29.0, datetime(2024, 8, 7, 12, 0, 0))])
+    override_context(last_locations=cache)
+    query = "query { lastLocations { deviceId } lastLocationByDevice(deviceId: 7) { latitude timestamp } }"
+
+    stale = client.post("/graphql", json={"query": query}).json()["data"]
+    cache.mark_synced()
+    fresh = client.post("/graphql", json={"query": query}).json()["data"]
+
+    assert stale == {"lastLocations": [], "lastLocationByDevice": None}
+    assert fresh == {"lastLocations": [{"deviceId": 7}],
+                     "lastLocationByDevice": {"latitude": 41.0, "timestamp": "2024-08-07T12:00:00"}}
+
+
+def test_location_history_pagination(client, db_session):
+    device = Device(name="Tracker")
+    db_session.add(device)
+    db_session.commit()
+    db_session.add_all([Location(device_id=device.id, latitude=float(i), longitude=29.0,
+                                 timestamp=datetime(2024, 8, 7, 12, i % 3, i)) for i in range(7)])
+    db_session.commit()
+
+    query = """
+    query ($after: String) {
+        locationHistoryByDevice(deviceId: DEVICE_ID, from: "2024-08-07T12:00:01", first: 2, after: $after) {
+            edges { cursor node { latitude timestamp } }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+    """.replace("DEVICE_ID", str(device.id))
+    latitudes, after, has_next_page = [], None, True
+    while has_next_page:
+        response = client.post("/graphql", json={"query": query, "variables": {"after": after}})
+        connection = response.json()["data"]["locationHistoryByDevice"]
+        latitudes += [edge["node"]["latitude"] for edge in connection["edges"]]
+        has_next_page = connection["pageInfo"]["hasNextPage"]
+        after = connection["pageInfo"]["endCursor"]
+
+    assert latitudes == [3.0, 6.0, 1.0, 4.0, 2.0, 5.0]
+
+
+def test_location_history_from_columnar_store(client, db_session, tmp_path):
+    device = Device(name="Tracker")
+    db_session.add(device)
+    db_session.commit()
+    store = ColumnarLocationStore(str(tmp_path))
+    store.append_records([(device.id, calendar.timegm((2024, 8, 7, 12, i % 3, i)),
+                           float(i), 29.0) for i in range(7)])
+    override_context(location_store=ColumnarLocationStore(str(tmp_path), read_only=True))
+
+    query = """
+    query ($after: String) {
+        locationHistoryByDevice(deviceId: DEVICE_ID, from: "2024-08-07T12:00:01", first: 2, after: $after) {
+            edges { node { latitude } }
+            pageInfo { hasNextPage endCursor }
+        }
+        deviceById(deviceId: DEVICE_ID) { recentLocations(limit: 2) { latitude timestamp } }
+        perMinute: locationHistoryByDevice(deviceId: DEVICE_ID, simplify: {bucketSeconds: 60}) {
+            edges { node { latitude } }
+        }
+    }
+    """.replace("DEVICE_ID", str(device.id))
+    latitudes, after, has_next_page = [], None, True
+    while has_next_page:
+        data = client.post("/graphql", json={"query": query, "variables": {"after": after}}).json()["data"]
+        latitudes += [edge["node"]["latitude"] for edge in data["locationHistoryByDevice"]["edges"]]
+        has_next_page = data["locationHistoryByDevice"]["pageInfo"]["hasNextPage"]
+        after = data["locationHistoryByDevice"]["pageInfo"]["endCursor"]
+    client.post("/graphql", json={"query": "mutation { deleteDevice(input: { id: %d }) { id } }" % device.id})
+
+    assert latitudes == [3.0, 6.0, 1.0, 4.0, 2.0, 5.0]
+    assert [edge["node"]["latitude"] for edge in data["perMinute"]["edges"]] == [6.0, 4.0, 5.0]
+    assert data["deviceById"]["recentLocations"] == [{"latitude": 5.0, "timestamp": "2024-08-07T12:02:05"},
+                                                      {"latitude": 2.0, "timestamp": "2024-08-07T12:02:02"}]
+    assert store.is_deleted(device.id) and len(store.read(device.id)) == 0
+
+
+def test_nearby_devices_and_bounding_box(client, db_session):
+    positions = {"Near": (41.0005, 29.0), "Nearer": (41.0001, 29.0), "Far": (41.05, 29.0), "Elsewhere": (-33.9, 18.4)}
+    devices = {name: Device(name=name) for name in positions}
+    db_session.add_all(devices.values())
+    db_session.commit()
+    upsert_latest_locations([{"device_id": devices[name].id, "latitude": latitude, "longitude": longitude,
+                              "timestamp": datetime(2024, 8, 7)} for name, (latitude, longitude) in positions.items()],
+                            db_session)
+    db_session.commit()
+
+    query = """
+    query {
+        nearbyDevices(latitude: 41.0, longitude: 29.0, radiusMeters: 2000, limit: 5) { deviceId distanceMeters }
+        devicesInBoundingBox(minLatitude: 40.9, minLongitude: 28.9, maxLatitude: 41.1, maxLongitude: 29.1) { deviceId }
+    }
+    """
+    data = client.post("/graphql", json={"query": query}).json()["data"]
+
+    assert [d["deviceId"] for d in data["nearbyDevices"]] == [devices["Nearer"].id, devices["Near"].id]
+    assert data["nearbyDevices"][0]["distanceMeters"] == pytest.approx(11.1, abs=0.5)
+    assert {d["deviceId"] for d in data["devicesInBoundingBox"]} == {devices[name].id for name in ("Near", "Nearer", "Far")}
+
+
+def test_nested_fields_are_batched_per_level(client, db_session):
+    devices = [Device(name=f"Device {i}") for i in range(3)]
+    db_session.add_all(devices)
+    db_session.commit()
+    for device in devices[:2]:
+        db_session.add_all([Location(device_id=device.id, latitude=41.0 + hour, longitude=29.0,
+                                     timestamp=datetime(2024, 8, 7, hour)) for hour in range(3)])
+        db_session.add(LatestLocation(device_id=device.id, latitude=43.0, longitude=29.0,
+                                      timestamp=datetime(2024, 8, 7, 2)))
+    db_session.commit()
+    statements = []
+
+    def record_statement(conn, cursor, statement, *args):
+        statements.append(statement)
+
+    event.listen(async_engine.sync_engine, "before_cursor_execute", record_statement)
+
+    query = """
+    query {
+        allDevices {
+            name
+            lastLocation { latitude }
+            recentLocations(limit: 2) { latitude device { name } }
+        }
+    }
+    """
+    response = client.post("/graphql", json={"query": query})
+    event.remove(async_engine.sync_engine, "before_cursor_execute", record_statement)
+
+    assert response.json()["data"]["allDevices"] == [
+        {"name": "Device 0", "lastLocation": {"latitude": 43.0},
+         "recentLocations": [{"latitude": 43.0, "device": {"name": "Device 0"}},
+                             {"latitude": 42.0, "device": {"name": "Device 0"}}]},
+        {"name": "Device 1", "lastLocation": {"latitude": 43.0},
+         "recentLocations": [{"latitude": 43.0, "device": {"name": "Device 1"}},
+                             {"latitude": 42.0, "device": {"name": "Device 1"}}]},
+        {"name": "Device 2", "lastLocation": None, "recentLocations": []},
+    ]
+    # devices, last locations, recent locations and the devices of the recent locations
+    assert len(statements) == 4
+
+
+def test_location_updates_subscription(client, db_session):
+    hub = LocationSubscriptionHub(coalesce_window=0.01)
+    override_context(location_updates=hub)
+    query = "subscription { locationUpdates(deviceIds: [7]) { deviceId latitude } }"
+
+    with client.websocket_connect("/graphql", subprotocols=["graphql-transport-ws"]) as websocket:
+        websocket.send_json({"type": "connection_init"})
+        assert websocket.receive_json()["type"] == "connection_ack"
+        websocket.send_json({"id": "1", "type": "subscribe", "payload": {"query": query}})
+        while not len(hub):
+            time.sleep(0.01)
+        hub.publish([CachedLocation(8, 40.0, 29.0, datetime(2024, 8, 7, 12)),
+                     CachedLocation(7, 41.0, 29.0, datetime(2024, 8, 7, 12))])
+        message = websocket.receive_json()
+        websocket.send_json({"id": "1", "type": "complete"})
+
+    assert message == {"id": "1", "type": "next", "payload": {"data": {"locationUpdates": [
+        {"deviceId": 7, "latitude": 41.0}]}}}
+
+
+def test_export_locations_streams_csv_and_ndjson(client, db_session, monkeypatch):
+    monkeypatch.setattr(database_service, "async_session_local", AsyncTestingSessionLocal)
+    devices = [Device(name="Exported"), Device(name="Other"), Device(name="Excluded")]
+    db_session.add_all(devices)
+    db_session.commit()
+    for device in devices:
+        db_session.add_all([Location(device_id=device.id, latitude=41.0 + hour, longitude=29.0,
+                                     timestamp=datetime(2024, 8, 7, hour)) for hour in range(3)])
+    db_session.commit()
+    params = {"device_id": [devices[1].id, devices[0].id], "from": "2024-08-07T01:00:00"}
+
+    csv_response = client.get("/export/locations", params={**params, "format": "csv", "gzip": "true"})
+    ndjson_response = client.get("/export/locations", params={**params, "to": "2024-08-07T02:00:00"})
+
+    assert csv_response.headers["content-type"] == "application/gzip"
+    assert gzip.decompress(csv_response.content).decode().splitlines() == [
+        "device_id,timestamp,latitude,longitude",
+        f"{devices[0].id},2024-08-07T01:00:00,42.0,29.0",
+        f"{devices[0].id},2024-08-07T02:00:00,43.0,29.0",
+        f"{devices[1].id},2024-08-07T01:00:00,42.0,29.0",
+        f"{devices[1].id},2024-08-07T02:00:00,43.0,29.0",
+    ]
+    assert [json.loads(line) for line in ndjson_response.text.splitlines()] == [
+        {"device_id": device.id, "timestamp": "2024-08-07T01:00:00", "latitude": 42.0, "longitude": 29.0}
+        for device in devices[:2]
+    ]
+    assert client.get("/export/locations", params={**params, "format": "xml"}).status_code == 400
+
+
+def test_location_history_simplification(client, db_session):
+    device = Device(name="Tracker")
+    db_session.add(device)
+    db_session.commit()
+    # Ten minutes driving east, then ten minutes driving north, one fix every 10 seconds.
+    db_session.add_all([Location(device_id=device.id, latitude=41.0 + max(0, i - 60) * 1e-4,
+                                 longitude=29.0 + min(i, 60) * 1e-4,
+                                 timestamp=datetime(2024, 8, 7, 12, i // 6, i % 6 * 10)) for i in range(120)])
+    db_session.commit()
+    query = """
+    query($simplify: SimplifyInput, $after: String) {
+        locationHistoryByDevice(deviceId: %d, first: 2, after: $after, simplify: $simplify) {
+            edges { node { latitude longitude timestamp } }
+            pageInfo { hasNextPage endCursor }
+        }
+    }
+    """ % device.id
+
+    def history(simplify, after=None):
+        response = client.post("/graphql", json={"query": query, "variables": {"simplify": simplify, "after": after}})
+        return response.json()["data"]["locationHistoryByDevice"]
+
+    first_page = history({"toleranceMeters": 5})
+    second_page = history({"toleranceMeters": 5}, after=first_page["pageInfo"]["endCursor"])
+    buckets = history({"bucketSeconds": 300, "bucketMode": "AVERAGE"})
+
+    assert [edge["node"]["timestamp"] for edge in first_page["edges"]] == ["2024-08-07T12:00:00", "2024-08-07T12:10:00"]
+    assert first_page["pageInfo"]["hasNextPage"]
+    assert [edge["node"]["timestamp"] for edge in second_page["edges"]] == ["2024-08-07T12:19:50"]
+    assert not second_page["pageInfo"]["hasNextPage"]
+    assert [edge["node"]["timestamp"] for edge in buckets["edges"]] == ["2024-08-07T12:04:50", "2024-08-07T12:09:50"]
+    assert buckets["edges"][0]["node"]["longitude"] == pytest.approx(29.0 + 14.5e-4)
+
+
+def test_location_history_beyond_raw_retention_uses_rollups(client, db_session):
+    device = Device(name="Tracker")
+    db_session.add(device)
+    db_session.commit()
+    today = datetime.combine(datetime.utcnow().date(), datetime.min.time())
+    old_hour = today - timedelta(days=10)
+    db_session.add_all([
+        LocationRollup(device_id=device.id, hour=old_hour, fix_count=360, latitude=40.0, longitude=29.0,
+                       timestamp=old_hour + timedelta(minutes=59)),
+        # Raw fixes that are already rolled up but not dropped yet are not returned twice.
+        Location(device_id=device.id, latitude=39.0, longitude=29.0, timestamp=old_hour + timedelta(minutes=59)),
+        Location(device_id=device.id, latitude=41.0, longitude=29.0, timestamp=today),
+    ])
+    db_session.commit()
+    override_context(raw_retention_days=7)
+    query = "{ locationHistoryByDevice(deviceId: %d) { edges { node { latitude } } } }" % device.id
+
+    response = client.post("/graphql", json={"query": query})
+
+    edges = response.json()["data"]["locationHistoryByDevice"]["edges"]
+    assert [edge["node"]["latitude"] for edge in edges] == [40.0, 41.0]
+
+
+def test_metrics_time_resolvers(client):
+    client.post("/graphql", json={"query": "{ allDevices { id } }"})
+
+    response = client.get("/metrics")
+
+    assert response.status_code == 200
+    assert 'graphql_resolver_seconds_count{field="Query.allDevices"}' in response.text
+    assert 'field="Device.id"' not in response.text
@@ -0,0 +1,66 @@
+import queue
+import threading
+import time
+
+import pytest
+
+from src.ingest_buffer import IngestBuffer, OVERFLOW_SPILL
+
+
+def drain(buffer):
+    items = []
+    while True:
+        try:
+            items.append(buffer.get_nowait())
+        except queue.Empty:
+            return items
+
+
+def test_block_policy_holds_producers_until_low_watermark():
+    buffer = IngestBuffer(high_watermark=4, low_watermark=1)
+    for i in range(4):
+        buffer.put(i)
+    producer = threading.Thread(target=buffer.put, args=(4,))
+    producer.start()
+    time.sleep(0.05)
+    assert producer.is_alive() and buffer.full()
+
+    assert [buffer.get(), buffer.get()] == [0, 1]
+    assert producer.is_alive()
+    buffer.get()
+    producer.join(timeout=1)
+    assert not producer.is_alive() and not buffer.full()
+    assert drain(buffer) == [3, 4]
+
+
+def test_spill_policy_preserves_order(tmp_path):
+    buffer = IngestBuffer(high_watermark=3, low_watermark=1, overflow=OVERFLOW_SPILL, spill_dir=str(tmp_path),
+                          segment_size=64)
+    items = [{"device_id": i} if i % 2 else bytes([i]) * 24 for i in range(20)]
+    for item in items[:10]:
+        buffer.put(item)
+    assert buffer.stats()["spilled_items"] == 7
+    assert buffer.stats()["spilled_bytes"] > 0
+
+    received = [buffer.get() for _ in range(5)]
+    for item in items[10:]:
+        buffer.put(item)
+    received += drain(buffer)
+    assert received == items
+    assert buffer.stats()["spilled_bytes"] == 0
+    assert not list(tmp_path.iterdir())
+
+
+def test_spilled_items_are_replayed_after_restart(tmp_path):
+    buffer = IngestBuffer(high_watermark=2, low_watermark=0, overflow=OVERFLOW_SPILL, spill_dir=str(tmp_path))
+    for i in range(5):
+        buffer.put({"device_id": i})
+
+    restarted = IngestBuffer(high_watermark=2, low_watermark=0, overflow=OVERFLOW_SPILL, spill_dir=str(tmp_path))
+    assert restarted.qsize() == 3
+    assert drain(restarted) == [{"device_id": i} for i in range(2, 5)]
+
+
+def test_invalid_watermarks_are_rejected():
+    with pytest.raises(ValueError):
+        IngestBuffer(high_watermark=1, low_watermark=1)
@@ -0,0 +1,83 @@
+import calendar
+import threading
+import time
+from datetime import datetime
+
+from src.gps_record import CONTENT_TYPE_JSON, CONTENT_TYPE_RECORDS, encode_record
+from src.last_location_cache import CachedLocation, LastLocationCache
+from src.service.last_location_cache_service import LastLocationCacheSync
+
+
+def location(device_id, hour, latitude=41.0):
+    return CachedLocation(device_id, latitude, 29.0, datetime(2024, 8, 7, hour))
+
+
+def test_update_keeps_newest_location():
+    cache = LastLocationCache(max_staleness=5)
+    cache.update([location(1, 12, latitude=1.0), location(2, 12)])
+    cache.update([location(1, 11, latitude=2.0)])
+    assert cache.get(1).latitude == 1.0
+    cache.update([location(1, 13, latitude=3.0)])
+    assert cache.get(1).latitude == 3.0
+    assert sorted(cache.all()) == [location(1, 13, latitude=3.0), location(2, 12)]
+
+
+def test_reload_replays_updates_that_arrived_meanwhile():
+    cache = LastLocationCache(max_staleness=5)
+    cache.update([location(1, 10), location(2, 10)])
+    cache.begin_reload()
+    cache.update([location(1, 14, latitude=5.0)])
+    cache.remove([3])
+    cache.finish_reload([location(1, 12), location(3, 12)])
+    assert cache.get(1).latitude == 5.0
+    assert cache.get(2) is None and cache.get(3) is None
+    assert len(cache) == 1
+
+
+def test_overlapping_reloads_keep_updates():
+    cache = LastLocationCache(max_staleness=5)
+    cache.update([location(1, 10), location(2, 10)])
+    loading = threading.Event()
+    release = threading.Event()
+
+    def load_stale_locations():
+        loading.set()
+        release.wait()
+        return [location(1, 10), location(2, 10)]
+
+    first = threading.Thread(target=cache.reload, args=(load_stale_locations,))
+    first.start()
+    loading.wait()
+    cache.update([location(1, 14, latitude=5.0)])
+    cache.remove([2])
+    second = threading.Thread(target=cache.reload, args=(lambda: [location(1, 14, latitude=5.0)],))
+    second.start()
+    time.sleep(0.05)
+    release.set()
+    first.join()
+    second.join()
+
+    assert cache.get(1).latitude == 5.0
+    assert cache.get(2) is None
+
+
+def test_cache_is_stale_until_synced(monkeypatch):
+    cache = LastLocationCache(max_staleness=5)
+    assert not cache.is_fresh()
+    monkeypatch.setattr("src.last_location_cache.time.monotonic", lambda: 100.0)
+    cache.mark_synced()
+    assert cache.is_fresh()
+    monkeypatch.setattr("src.last_location_cache.time.monotonic", lambda: 106.0)
+    assert not cache.is_fresh()
+
+
+def test_sync_applies_location_updates_and_device_deletions():
+    cache = LastLocationCache(max_staleness=5)
+    sync = LastLocationCacheSync(cache, None, "localhost", 5672, exchange="location_updates",
+                                 device_events_exchange="device_events")
+    timestamp = calendar.timegm(datetime(2024, 8, 7, 12).timetuple())
+    records = b"".join(encode_record({"device_id": device_id, "timestamp": timestamp, "latitude": 41.0,
+                                      "longitude": 29.0}) for device_id in (1, 2))
+    sync.on_message(records, CONTENT_TYPE_RECORDS)
+    sync.on_message(b'{"event": "deleted", "device_ids": [2]}', CONTENT_TYPE_JSON)
+    assert cache.all() == [location(1, 12)]
@@ -0,0 +1,59 @@
+import asyncio
+import queue
+import socket
+import threading
+import time
+
+import numpy as np
+
+from src.gps_record import decode_records
+from src.load_generator import DeviceFleet, LoadGenerator
+from tcp_server import TCP_SERVER_MODES
+
+HOST = "127.0.0.1"
+
+
+def test_fleet_keeps_positions_of_known_devices():
+    fleet = DeviceFleet([3, 1, 2], seed=1)
+    positions = dict(zip(fleet.device_ids.tolist(), zip(fleet.latitudes.tolist(), fleet.longitudes.tolist())))
+
+    fleet.set_devices([2, 3, 4])
+
+    assert fleet.device_ids.tolist() == [2, 3, 4]
+    assert [(latitude, longitude) for latitude, longitude in zip(fleet.latitudes[:2], fleet.longitudes[:2])] == \
+        [positions[2], positions[3]]
+
+
+def test_fleet_moves_and_encodes_records():
+    fleet = DeviceFleet([1, 2], seed=1)
+    fleet.latitudes[:] = [89.99995, 0.0]
+    fleet.longitudes[:] = [179.99995, 0.0]
+
+    fleet.move(slice(0, 1), step=0.001)
+
+    records = decode_records(fleet.encode_records(slice(None), 1723000000))
+    assert [(device_id, timestamp) for device_id, timestamp, _, _ in records] == [(1, 1723000000), (2, 1723000000)]
+    assert -90 <= records[0][2] <= 90 and -180 <= records[0][3] < 180
+    assert records[1][2:] == (0.0, 0.0)
+    assert np.allclose([record[2:] for record in records], np.c_[fleet.latitudes, fleet.longitudes])
+
+
+def test_load_generator_streams_every_device_and_measures_acks():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        port = sock.getsockname()[1]
+    output_queue = queue.Queue()
+    server = TCP_SERVER_MODES["asyncio"](host=HOST, port=port, output_queue=output_queue, read_timeout=5)
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.1)
+    generator = LoadGenerator(HOST, port, range(1, 101), rate=2000, connections=2, batch_size=10)
+
+    summary = asyncio.run(generator.run(duration=0.5))
+
+    device_ids = set()
+    while not output_queue.empty():
+        device_ids.update(record[0] for record in decode_records(output_queue.get()))
+    assert device_ids == set(range(1, 101))
+    assert summary["errors"] == 0
+    assert summary["acked/s"] > 0
+    assert summary["ack_p99_ms"] >= summary["ack_p50_ms"]
@@ -0,0 +1,155 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+
+from src.location_store import ColumnarLocationStore
+
+START = 1723000000
+
+
+def at(seconds):
+    return datetime.utcfromtimestamp(START + seconds)
+
+
+def append(store, device_id, seconds, latitudes=None):
+    seconds = np.asarray(seconds)
+    latitudes = seconds.astype(float) if latitudes is None else np.asarray(latitudes, dtype=float)
+    store.append(np.full(len(seconds), device_id), START + seconds, latitudes, -latitudes)
+
+
+def test_range_reads_are_views_of_the_mapped_segment(tmp_path):
+    writer = ColumnarLocationStore(str(tmp_path), segment_capacity=1024, index_interval=64)
+    append(writer, 1, np.arange(1000))
+    append(writer, 2, np.arange(10))
+    reader = ColumnarLocationStore(str(tmp_path), read_only=True)
+
+    columns = reader.read(1, start=at(100), end=at(300))
+    append(writer, 1, [1000])
+
+    assert len(columns) == 200
+    assert not columns.latitudes.flags.owndata and not columns.latitudes.flags.writeable
+    assert columns.ids[0] == 100 and columns.latitudes[-1] == 299.0
+    assert columns.timestamps[0] == np.datetime64(at(100))
+    assert len(reader.read(1, start=at(999))) == 2
+    assert len(reader.read(3)) == 0
+
+
+def test_late_fixes_start_a_segment_and_are_read_in_time_order(tmp_path):
+    store = ColumnarLocationStore(str(tmp_path), segment_capacity=1024, index_interval=64)
+    append(store, 1, [0, 10, 20, 30])
+    append(store, 1, [15, 10, 40], latitudes=[1.5, 1.0, 4.0])
+
+    rows, after = [], None
+    while True:
+        page = store.read(1, start=at(10), after=after, limit=2)
+        if not len(page):
+            break
+        rows += [(int(location_id), latitude) for location_id, _, latitude, _ in page.rows()]
+        after = (page.timestamps[-1].item(), int(page.ids[-1]))
+
+    assert len(os.listdir(tmp_path / "1")) == 3
+    assert rows == [(1, 10.0), (4, 1.0), (5, 1.5), (2, 20.0), (3, 30.0), (6, 4.0)]
+    assert [int(location_id) for location_id in store.recent(1, 3).ids] == [2, 3, 6]
+
+
+def test_segments_roll_over_and_expire(tmp_path):
+    store = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(store, 1, np.arange(0, 1500, 10))
+    append(store, 1, np.arange(1500, 3000, 10))
+
+    assert [int(entry["count"]) for entry in store.catalog(1)] == [100, 100]
+    assert store.delete_before(at(1000)) == 1
+    assert store.read(1).ids[0] == 100
+    assert len(store.read(1)) == 200
+
+    # A seal interrupted before the catalog was written is finished by the next writer.
+    ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000) \
+        .open_segment(store.segment_path(1, 200)).seal()
+    restarted = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(restarted, 1, [3000])
+
+    assert restarted.read(1, start=at(3000)).ids.tolist() == [300]
+    restarted.delete_device(1)
+    assert len(restarted.read(1)) == 0
+
+
+def test_a_torn_catalog_entry_is_dropped_before_the_next_seal(tmp_path):
+    store = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(store, 1, np.arange(0, 1500, 10))
+    with open(tmp_path / "1" / "catalog", "ab") as catalog:
+        catalog.write(b"torn")
+
+    restarted = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(restarted, 1, np.arange(2000, 2100, 10))
+
+    reloaded = ColumnarLocationStore(str(tmp_path), read_only=True)
+    assert [int(entry["first_id"]) for entry in reloaded.catalog(1)] == [0, 100]
+    assert reloaded.read(1).ids.tolist() == list(range(160))
+
+
+def test_open_segments_of_silent_devices_expire_in_their_writer(tmp_path):
+    store = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000,
+                                  partition=1, partitions=2)
+    append(store, 1, np.arange(0, 100, 10))
+    append(store, 3, np.arange(0, 100, 10))
+    append(store, 3, [5000])
+    other_partition = ColumnarLocationStore(str(tmp_path), partition=0, partitions=2)
+    other_partition.append(np.array([2]), np.array([START]), np.zeros(1), np.zeros(1))
+
+    restarted = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000,
+                                      partition=1, partitions=2)
+    assert restarted.delete_before(at(1000)) == 2
+    assert len(restarted.read(1)) == 0
+    assert restarted.read(3).ids.tolist() == [10]
+    assert len(restarted.read(2)) == 1
+
+    append(restarted, 1, [2000])
+    assert restarted.read(1).ids.tolist() == [10]
+
+
+def test_deleted_devices_are_hidden_until_their_writer_removes_them(tmp_path):
+    writer = ColumnarLocationStore(str(tmp_path))
+    append(writer, 1, np.arange(10))
+    append(writer, 2, np.arange(10))
+    reader = ColumnarLocationStore(str(tmp_path), read_only=True)
+
+    with pytest.raises(ValueError):
+        reader.delete_device(1)
+    reader.mark_deleted(1)
+
+    assert len(reader.read(1)) == 0 and len(reader.recent(1, 5)) == 0
+    assert (tmp_path / "1").exists()
+    assert writer.apply_deletions() == 1
+    assert not (tmp_path / "1").exists() and not reader.is_deleted(1)
+    assert len(reader.read(2)) == 10
+
+
+def test_readers_drop_segments_their_writer_removed(tmp_path):
+    writer = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(writer, 1, np.arange(10))
+    append(writer, 2, np.arange(0, 100, 10))
+    append(writer, 2, [5000])
+    reader = ColumnarLocationStore(str(tmp_path), read_only=True)
+    assert len(reader.read(1)) == 10 and len(reader.read(2)) == 11
+
+    reader.mark_deleted(1)
+    writer.apply_deletions()
+    assert writer.delete_before(at(1000)) == 1
+    assert len(reader.read(1)) == 0 and len(reader.recent(1, 5)) == 0
+    assert reader.read(2).ids.tolist() == [10]
+
+    append(writer, 1, [7000])
+    assert reader.read(1).ids.tolist() == [0]
+
+
+def test_readers_skip_segments_past_retention(tmp_path, monkeypatch):
+    writer = ColumnarLocationStore(str(tmp_path), segment_capacity=128, index_interval=64, segment_seconds=1000)
+    append(writer, 1, np.arange(0, 100, 10))
+    append(writer, 1, [86400 + 5000])
+    reader = ColumnarLocationStore(str(tmp_path), read_only=True, retention_days=1)
+
+    monkeypatch.setattr("src.location_store.time.time", lambda: START + 86400 + 1000)
+    assert reader.read(1).ids.tolist() == [10]
+    assert reader.recent(1, 5).ids.tolist() == [10]
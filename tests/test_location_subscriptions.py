@@ -0,0 +1,52 @@
+import asyncio
+from datetime import datetime
+
+import pytest
+
+from src.last_location_cache import CachedLocation
+from src.location_subscriptions import BoundingBox, LocationSubscriptionHub
+
+
+def location(device_id, second, latitude=41.0, longitude=29.0):
+    return CachedLocation(device_id, latitude, longitude, datetime(2024, 8, 7, 12, 0, second))
+
+
+async def next_batch(updates):
+    return sorted(await asyncio.wait_for(updates.__anext__(), timeout=1))
+
+
+def test_updates_are_coalesced_per_device():
+    async def scenario():
+        hub = LocationSubscriptionHub(coalesce_window=0.05)
+        updates = hub.subscribe(device_ids=[1, 2])
+        batch = asyncio.ensure_future(next_batch(updates))
+        await asyncio.sleep(0.01)
+        hub.dispatch([location(1, 1), location(3, 1), location(1, 3, latitude=3.0), location(2, 1)])
+        hub.dispatch([location(1, 2, latitude=2.0)])
+        assert await batch == [location(1, 3, latitude=3.0), location(2, 1)]
+        await updates.aclose()
+        assert len(hub) == 0
+
+    asyncio.run(scenario())
+
+
+def test_bounding_box_subscription_across_antimeridian():
+    async def scenario():
+        hub = LocationSubscriptionHub(coalesce_window=0)
+        updates = hub.subscribe(bounding_box=BoundingBox(-10, 179, 10, -179))
+        batch = asyncio.ensure_future(next_batch(updates))
+        await asyncio.sleep(0.01)
+        hub.dispatch([location(1, 1, latitude=0, longitude=179.5), location(2, 1, latitude=0, longitude=0),
+                      location(3, 1, latitude=0, longitude=-179.5), location(4, 1, latitude=20, longitude=180)])
+        assert [loc.device_id for loc in await batch] == [1, 3]
+        await updates.aclose()
+
+    asyncio.run(scenario())
+
+
+def test_subscribe_requires_one_filter():
+    async def scenario():
+        with pytest.raises(ValueError):
+            await LocationSubscriptionHub(coalesce_window=0).subscribe().__anext__()
+
+    asyncio.run(scenario())
@@ -0,0 +1,46 @@
+import requests
+
+from src.metrics import Counter, Gauge, Histogram, MetricsRegistry, start_metrics_server
+
+
+def test_render_prometheus_text_format():
+    registry = MetricsRegistry()
+    requests_total = Counter("requests_total", "Requests handled.", ("path",), registry=registry)
+    depth = Gauge("queue_depth", "Items queued.", registry=registry)
+    latency = Histogram("latency_seconds", "Latency.", registry=registry, buckets=(0.1, 1.0))
+    requests_total.labels("/a\"b").inc()
+    requests_total.labels("/a\"b").inc(2)
+    depth.set_function(lambda: 7)
+    for value in (0.05, 0.1, 0.5, 3.0):
+        latency.observe(value)
+
+    assert registry.render() == (
+        '# HELP requests_total Requests handled.\n'
+        '# TYPE requests_total counter\n'
+        'requests_total{path="/a\\"b"} 3\n'
+        '# HELP queue_depth Items queued.\n'
+        '# TYPE queue_depth gauge\n'
+        'queue_depth 7\n'
+        '# HELP latency_seconds Latency.\n'
+        '# TYPE latency_seconds histogram\n'
+        'latency_seconds_bucket{le="0.1"} 2\n'
+        'latency_seconds_bucket{le="1.0"} 3\n'
+        'latency_seconds_bucket{le="+Inf"} 4\n'
+        'latency_seconds_sum 3.65\n'
+        'latency_seconds_count 4\n'
+    )
+
+
+def test_metrics_server():
+    registry = MetricsRegistry()
+    Counter("events_total", "Events.", registry=registry).inc()
+    server = start_metrics_server(0, host="127.0.0.1", registry=registry)
+    try:
+        url = f"http://127.0.0.1:{server.server_address[1]}"
+        response = requests.get(f"{url}/metrics")
+        assert response.status_code == 200
+        assert response.headers["Content-Type"].startswith("text/plain; version=0.0.4")
+        assert "events_total 1\n" in response.text
+        assert requests.get(f"{url}/other").status_code == 404
+    finally:
+        server.shutdown()
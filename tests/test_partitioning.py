@@ -0,0 +1,79 @@
+import os
+import time
+
+from gps_data_processor import ProcessorSupervisor
+from src.gps_record import encode_record, decode_message
+from src.partitioning import partition_queue_name, split_by_partition
+from src.service.publisher_service import encode_batch
+
+
+def fix(device_id, timestamp):
+    return {"device_id": device_id, "timestamp": timestamp, "latitude": 41.0, "longitude": 29.0}
+
+
+def exit_immediately(partition, partitions):
+    os._exit(3)
+
+
+class DeadWorker:
+    pid = None
+    exitcode = 3
+
+    def is_alive(self):
+        return False
+
+
+def test_single_partition_keeps_plain_queue_name():
+    assert partition_queue_name("gps", 0, 1) == "gps"
+    assert partition_queue_name("gps", 2, 4) == "gps.2"
+    messages = [fix(1, 1), b"x" * 24]
+    assert split_by_partition(messages, 1) == {0: messages}
+
+
+def test_split_by_partition_keeps_each_device_in_order():
+    fixes = [fix(device_id, timestamp) for timestamp in range(5) for device_id in range(1, 7)]
+    messages = [fixes[0], b"".join(encode_record(f) for f in fixes[1:20]), *fixes[20:]]
+
+    split = split_by_partition(messages, 3)
+    assert set(split) == {0, 1, 2}
+    for partition, partition_messages in split.items():
+        received = []
+        for body, content_type in encode_batch(partition_messages):
+            received.extend(decode_message(body, content_type))
+        received_device_ids = {device_id for device_id, *_ in received}
+        assert received_device_ids
+        assert all(device_id % 3 == partition for device_id in received_device_ids)
+        for device_id in received_device_ids:
+            timestamps = [timestamp for d, timestamp, *_ in received if d == device_id]
+            assert timestamps == sorted(timestamps)
+
+
+def test_supervisor_restarts_crashed_workers():
+    supervisor = ProcessorSupervisor(partitions=2, worker_target=exit_immediately, min_uptime=0, max_backoff=0)
+    for partition in range(2):
+        supervisor.start_worker(partition)
+    first_pids = {partition: worker.pid for partition, worker in supervisor.workers.items()}
+    for worker in supervisor.workers.values():
+        worker.join(timeout=10)
+
+    supervisor.check_workers()
+    time.sleep(0.1)
+    supervisor.check_workers()
+    try:
+        assert all(supervisor.workers[p].pid != first_pids[p] for p in range(2))
+    finally:
+        supervisor.stop()
+
+
+def test_supervisor_backoff_grows_again_after_a_long_run():
+    supervisor = ProcessorSupervisor(partitions=1, min_uptime=10, max_backoff=30)
+    supervisor.start_worker = lambda partition: None
+    supervisor.workers[0] = DeadWorker()
+
+    def crash_after(uptime):
+        now = time.monotonic()
+        supervisor.started_at[0] = now - uptime
+        supervisor.check_workers()
+        return round(supervisor.restart_at.pop(0, now) - now)
+
+    assert [crash_after(uptime) for uptime in (0, 100, 0, 0)] == [1, 0, 1, 2]
@@ -0,0 +1,87 @@
+import json
+import queue
+
+import pytest
+from pika.exceptions import StreamLostError
+
+from src.gps_record import CONTENT_TYPE_JSON, CONTENT_TYPE_RECORDS
+from src.service import transport_service
+from src.service.publisher_service import RabbitMQPublisherService, encode_batch
+from tcp_server import RabbitMQPublisher
+
+
+class FakeChannel:
+    def __init__(self, connection):
+        self.connection = connection
+        self.is_open = True
+
+    def confirm_delivery(self):
+        pass
+
+    def queue_declare(self, queue):
+        pass
+
+    def basic_publish(self, exchange, routing_key, body, properties=None):
+        if self.connection.failures:
+            self.connection.failures -= 1
+            self.is_open = False
+            raise StreamLostError("connection reset")
+        self.connection.published.append((routing_key, body, properties.content_type))
+
+
+class FakeConnection:
+    instances = []
+
+    def __init__(self, parameters):
+        self.is_open = True
+        self.failures = 0
+        self.published = []
+        FakeConnection.instances.append(self)
+
+    def channel(self):
+        return FakeChannel(self)
+
+    def close(self):
+        self.is_open = False
+
+
+@pytest.fixture(autouse=True)
+def fake_pika(monkeypatch):
+    FakeConnection.instances = []
+    monkeypatch.setattr(transport_service.pika, "BlockingConnection", FakeConnection)
+
+
+def test_encode_batch_keeps_order_of_mixed_messages():
+    fix = {"device_id": 1, "timestamp": 1, "latitude": 1.0, "longitude": 2.0}
+    bodies = encode_batch([fix, fix, b"r" * 24, b"r" * 48, fix])
+    assert [content_type for _, content_type in bodies] == [CONTENT_TYPE_JSON, CONTENT_TYPE_RECORDS,
+                                                            CONTENT_TYPE_JSON]
+    assert json.loads(bodies[0][0]) == [fix, fix]
+    assert len(bodies[1][0]) == 72
+    assert json.loads(bodies[2][0]) == fix
+
+
+def test_publisher_reuses_connection():
+    service = RabbitMQPublisherService("localhost", 5672, retry_interval=0)
+    for _ in range(3):
+        service.publish("gps", {"device_id": 1})
+    assert len(FakeConnection.instances) == 1
+    assert len(FakeConnection.instances[0].published) == 3
+
+
+def test_publisher_reconnects_after_connection_loss():
+    service = RabbitMQPublisherService("localhost", 5672, retry_interval=0)
+    service.publish("gps", b"r" * 24)
+    FakeConnection.instances[0].failures = 1
+    service.publish("gps", b"s" * 24)
+    assert len(FakeConnection.instances) == 2
+    assert FakeConnection.instances[1].published == [("gps", b"s" * 24, CONTENT_TYPE_RECORDS)]
+
+
+def test_get_batch_drains_up_to_batch_size():
+    input_queue = queue.Queue()
+    for i in range(5):
+        input_queue.put(i)
+    publisher = RabbitMQPublisher(input_queue, "gps", "localhost", 5672, batch_size=3, linger_ms=1)
+    assert publisher.get_batch() == [0, 1, 2]
+    assert publisher.get_batch() == [3, 4]
@@ -0,0 +1,46 @@
+import random
+
+import pytest
+
+from src.spatial_index import bounding_box, cell_for, cell_ranges, haversine_meters, COLUMNS
+
+
+def in_ranges(cell, ranges):
+    return any(first <= cell <= last for first, last in ranges)
+
+
+@pytest.mark.parametrize("box", [
+    (40.9, 28.9, 41.1, 29.1),
+    (-10.0, 179.5, 10.0, -179.5),
+    (-90.0, -180.0, 90.0, 180.0),
+    (89.95, 170.0, 90.0, 180.0),
+])
+def test_cell_ranges_cover_every_point_in_box(box):
+    min_latitude, min_longitude, max_latitude, max_longitude = box
+    ranges = cell_ranges(*box)
+    rng = random.Random(1)
+    for _ in range(1000):
+        latitude = rng.uniform(min_latitude, max_latitude)
+        if min_longitude <= max_longitude:
+            longitude = rng.uniform(min_longitude, max_longitude)
+        else:
+            longitude = rng.choice([rng.uniform(min_longitude, 180), rng.uniform(-180, max_longitude)])
+        assert in_ranges(cell_for(latitude, longitude), ranges)
+
+
+def test_cell_ranges_exclude_far_away_points():
+    ranges = cell_ranges(40.9, 28.9, 41.1, 29.1)
+    assert not in_ranges(cell_for(41.0, 30.0), ranges)
+    assert not in_ranges(cell_for(45.0, 29.0), ranges)
+    assert len(ranges) == 21 and all(last - first < COLUMNS for first, last in ranges)
+
+
+def test_bounding_box_contains_circle():
+    latitude, longitude, radius = 60.0, 179.99, 2000
+    min_latitude, min_longitude, max_latitude, max_longitude = bounding_box(latitude, longitude, radius)
+    assert min_longitude > max_longitude
+    east = (latitude, -179.98)
+    assert haversine_meters(latitude, longitude, *east) < radius
+    assert east[1] <= max_longitude
+    assert haversine_meters(41.0, 29.0, 41.0, 29.0) == 0
+    assert haversine_meters(0, 0, 0, 1) == pytest.approx(111_195, rel=1e-3)
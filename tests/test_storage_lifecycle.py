@@ -0,0 +1,111 @@
+from datetime import datetime, timedelta
+
+import pytest
+
+from src.model import Device, Location, LocationRollup
+from src.service.database_service import connect_to_db
+from src.service.storage_lifecycle_service import LocationStorageLifecycle, partition_day, partition_name
+from src.sql_query import delete_locations_before, get_location_history_by_device
+
+NOW = datetime(2024, 8, 10, 12, 30)
+
+
+@pytest.fixture
+def database_service(tmp_path):
+    service = connect_to_db(f"sqlite:///{tmp_path / 'lifecycle.db'}")
+    with service.session_local() as db:
+        db.add_all([Device(name="Device 1"), Device(name="Device 2")])
+        db.commit()
+    return service
+
+
+def add_fixes(database_service, fixes):
+    with database_service.session_local() as db:
+        db.add_all([Location(device_id=device_id, latitude=latitude, longitude=29.0, timestamp=timestamp)
+                    for device_id, latitude, timestamp in fixes])
+        db.commit()
+
+
+def test_old_fixes_are_rolled_up_before_they_expire(database_service):
+    old_hour = datetime(2024, 8, 7, 9)
+    add_fixes(database_service, [
+        (1, 1.0, old_hour + timedelta(minutes=10)),
+        (1, 3.0, old_hour + timedelta(minutes=50)),
+        (1, 2.0, old_hour + timedelta(minutes=20)),
+        (2, 5.0, old_hour + timedelta(hours=5)),
+        (1, 7.0, NOW - timedelta(minutes=5)),
+    ])
+    lifecycle = LocationStorageLifecycle(database_service, raw_retention_days=1, rollup_delay=3600)
+
+    lifecycle.run_once(NOW)
+    lifecycle.run_once(NOW)
+
+    with database_service.session_local() as db:
+        rollups = db.query(LocationRollup).order_by(LocationRollup.hour).all()
+        raw = db.query(Location).all()
+    assert [(rollup.device_id, rollup.hour, rollup.fix_count) for rollup in rollups] == [
+        (1, old_hour, 3), (2, old_hour + timedelta(hours=5), 1)]
+    assert (rollups[0].latitude, rollups[0].timestamp) == (3.0, old_hour + timedelta(minutes=50))
+    assert rollups[0].average_latitude == pytest.approx(2.0)
+    assert [location.latitude for location in raw] == [7.0]
+
+
+def test_nothing_expires_before_it_is_rolled_up(database_service):
+    add_fixes(database_service, [(1, 1.0, datetime(2024, 8, 7, 9, 10)), (1, 2.0, datetime(2024, 8, 8, 9, 10))])
+    lifecycle = LocationStorageLifecycle(database_service, raw_retention_days=1, max_rollup_hours=1)
+
+    lifecycle.run_once(NOW)
+
+    with database_service.session_local() as db:
+        assert db.query(LocationRollup).count() == 1
+        assert [location.latitude for location in db.query(Location)] == [2.0]
+
+
+def test_history_continues_from_rollups_into_raw_fixes(database_service):
+    raw_since = datetime(2024, 8, 9)
+    with database_service.session_local() as db:
+        db.add_all([LocationRollup(device_id=1, hour=datetime(2024, 8, 8, hour), fix_count=1, latitude=float(hour),
+                                   longitude=29.0, timestamp=datetime(2024, 8, 8, hour, 30)) for hour in range(3)])
+        db.add_all([Location(device_id=1, latitude=10.0 + i, longitude=29.0, timestamp=raw_since + timedelta(hours=i))
+                    for i in range(2)])
+        db.commit()
+
+        latitudes, after = [], None
+        while True:
+            page = get_location_history_by_device(1, db, after=after, limit=2, raw_since=raw_since)
+            if not page:
+                break
+            latitudes += [location.latitude for location in page]
+            after = (page[-1].timestamp, page[-1].id)
+        assert latitudes == [0.0, 1.0, 2.0, 10.0, 11.0]
+        assert [location.latitude for location in
+                get_location_history_by_device(1, db, start=datetime(2024, 8, 8, 1), end=raw_since + timedelta(hours=1),
+                                               raw_since=raw_since)] == [1.0, 2.0, 10.0]
+
+
+def test_expired_fixes_are_deleted_by_id_range(database_service):
+    # Late fixes interleave old and recent timestamps in id order.
+    add_fixes(database_service, [(1, float(i), NOW - timedelta(days=3 if i % 3 else 0)) for i in range(10)])
+
+    with database_service.session_local() as db:
+        assert delete_locations_before(NOW - timedelta(days=1), db, chunk_size=4) == 6
+        assert [location.latitude for location in db.query(Location).order_by(Location.id)] == [0.0, 3.0, 6.0, 9.0]
+
+
+def test_mysql_table_is_only_partitioned_with_a_retention(database_service, monkeypatch):
+    converted = []
+    monkeypatch.setattr(LocationStorageLifecycle, "get_partitions", staticmethod(lambda db: []))
+    monkeypatch.setattr(LocationStorageLifecycle, "partition_table",
+                        staticmethod(lambda db, today: converted.append(today)))
+    with database_service.session_local() as db:
+        monkeypatch.setattr(db.get_bind().dialect, "name", "mysql")
+
+    LocationStorageLifecycle(database_service, raw_retention_days=0).run_once(NOW)
+    assert converted == []
+
+
+def test_partition_names():
+    day = datetime(2024, 8, 7).date()
+    assert partition_name(day) == "before_20240807"
+    assert partition_day(partition_name(day)) == day
+    assert partition_day("pmax") is None
@@ -0,0 +1,61 @@
+import io
+import json
+import logging
+import queue
+
+from src.structured_logging import BackgroundQueueHandler, EventLogger, configure_logging, stop_logging
+
+
+class Payload:
+    def __init__(self):
+        self.formatted = 0
+
+    def __repr__(self):
+        self.formatted += 1
+        return "payload"
+
+
+def test_records_are_written_as_json_by_a_background_thread():
+    stream = io.StringIO()
+    configure_logging(level="INFO", log_format="json", stream=stream, worker=3)
+    try:
+        payload = Payload()
+        logging.getLogger("test.json").info("Received %r", payload, extra={"device_id": 7})
+        logging.getLogger("test.json").debug("Not written %r", payload)
+    finally:
+        stop_logging()
+
+    entry = json.loads(stream.getvalue())
+    assert entry["message"] == "Received payload"
+    assert (entry["level"], entry["logger"], entry["worker"], entry["device_id"]) == ("INFO", "test.json", 3, 7)
+    assert payload.formatted == 1
+
+
+def test_records_are_queued_unformatted_and_dropped_when_full():
+    records = queue.Queue(1)
+    logger = logging.getLogger("test.queue")
+    logger.propagate = False
+    logger.addHandler(BackgroundQueueHandler(records))
+    payload = Payload()
+
+    logger.warning("First %r", payload)
+    logger.warning("Dropped %r", payload)
+
+    assert records.get_nowait().args == (payload,)
+    assert records.empty() and payload.formatted == 0
+
+
+def test_event_logger_samples_and_rate_limits():
+    records = queue.Queue()
+    logger = logging.getLogger("test.events")
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    logger.addHandler(BackgroundQueueHandler(records))
+    received_log = EventLogger(logger, "fix_received", sample_every=10, rate_limit=2)
+
+    for i in range(100):
+        received_log.info("Received fix %d", i)
+
+    logged = [records.get_nowait() for _ in range(records.qsize())]
+    assert [record.getMessage() for record in logged] == ["Received fix 9", "Received fix 19"]
+    assert [(record.event, record.skipped) for record in logged] == [("fix_received", 9), ("fix_received", 9)]
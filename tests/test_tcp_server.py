@@ -0,0 +1,115 @@
+import asyncio
+import json
+import queue
+import socket
+import threading
+import time
+
+import pytest
+
+from src.gps_record import RECORD_SIZE, decode_records, json_to_tuple
+from src.ingest_buffer import IngestBuffer
+from src.iot_device import DeviceConnection
+from src.protocol import FORMAT_BINARY
+from tcp_server import AsyncTCPServer, TCP_SERVER_MODES
+
+HOST = "127.0.0.1"
+
+
+def _free_port():
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:
+        sock.bind((HOST, 0))
+        return sock.getsockname()[1]
+
+
+@pytest.fixture(params=list(TCP_SERVER_MODES))
+def server(request):
+    output_queue = queue.Queue()
+    tcp_server = TCP_SERVER_MODES[request.param](host=HOST, port=_free_port(), output_queue=output_queue,
+                                                 read_timeout=0.5)
+    threading.Thread(target=tcp_server.start, daemon=True).start()
+    time.sleep(0.1)
+    return tcp_server
+
+
+def _send(port, payload: bytes):
+    with socket.create_connection((HOST, port), timeout=2) as sock:
+        sock.sendall(payload)
+        return sock.recv(1024)
+
+
+def test_gps_data_is_acked_and_queued(server):
+    gps_data = {"device_id": 1, "timestamp": 1723000000, "latitude": 41.0, "longitude": 29.0}
+    assert _send(server.port, json.dumps(gps_data).encode()) == b"ACK"
+    assert server.output_queue.get(timeout=1) == gps_data
+
+
+def test_stalled_client_times_out(server):
+    stalled = socket.create_connection((HOST, server.port))
+    try:
+        time.sleep(0.7)
+        assert stalled.recv(1024) == b""
+    finally:
+        stalled.close()
+
+
+def test_fragmented_legacy_message_is_reassembled(server):
+    gps_data = {"device_id": 1, "timestamp": 1723000000, "latitude": 41.0, "longitude": 29.0}
+    payload = json.dumps(gps_data).encode()
+    with socket.create_connection((HOST, server.port), timeout=2) as sock:
+        sock.sendall(payload[:10])
+        time.sleep(0.05)
+        sock.sendall(payload[10:])
+        assert sock.recv(1024) == b"ACK"
+    assert server.output_queue.get(timeout=1) == gps_data
+
+
+def test_persistent_connection_streams_many_messages(server):
+    fixes = [{"device_id": i, "timestamp": 1723000000 + i, "latitude": 41.0, "longitude": 29.0} for i in range(1, 501)]
+    with DeviceConnection(HOST, server.port, timeout=2) as connection:
+        for gps_data in fixes[:10]:
+            connection.send(gps_data)
+        assert connection.wait_for_ack() == 10
+        connection.send_many(fixes[10:])
+        assert connection.wait_for_ack() == len(fixes)
+    assert [server.output_queue.get(timeout=1) for _ in fixes] == fixes
+
+
+def test_malformed_frame_is_rejected(server):
+    with socket.create_connection((HOST, server.port), timeout=2) as sock:
+        reader = sock.makefile("rb")
+        sock.sendall(b"GPS1 JSON\n{\"device_id\": 1}\nnot json\n")
+        assert reader.readline() == b"OK JSON\n"
+        assert reader.readline() == b"ACK 1\n"
+        assert reader.readline().startswith(b"ERR 2 ")
+
+
+def test_binary_records_are_queued_as_bytes(server):
+    fixes = [{"device_id": i, "timestamp": 1723000000 + i, "latitude": 41.0, "longitude": 29.0} for i in range(1, 101)]
+    with DeviceConnection(HOST, server.port, timeout=2, data_format=FORMAT_BINARY) as connection:
+        connection.send_many(fixes)
+        assert connection.wait_for_ack() == len(fixes)
+
+    body = b""
+    while len(body) < len(fixes) * RECORD_SIZE:
+        body += server.output_queue.get(timeout=1)
+    assert decode_records(body) == [json_to_tuple(gps_data) for gps_data in fixes]
+
+
+def test_async_server_keeps_its_event_loop_running_when_a_read_fills_the_buffer():
+    output_queue = IngestBuffer(high_watermark=10, low_watermark=5)
+    tcp_server = AsyncTCPServer(host=HOST, port=_free_port(), output_queue=output_queue, read_timeout=2)
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(tcp_server.serve(), loop)
+    time.sleep(0.1)
+    fixes = [{"device_id": i, "timestamp": 1723000000 + i, "latitude": 41.0, "longitude": 29.0} for i in range(1, 51)]
+
+    with DeviceConnection(HOST, tcp_server.port, timeout=2) as connection:
+        connection.send_many(fixes)
+        time.sleep(0.2)
+        assert output_queue.full()
+        asyncio.run_coroutine_threadsafe(asyncio.sleep(0), loop).result(timeout=1)
+        received = [output_queue.get(timeout=1) for _ in fixes]
+        assert connection.wait_for_ack() == len(fixes)
+    assert received == fixes
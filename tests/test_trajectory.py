@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+from src.spatial_index import METERS_PER_DEGREE_LATITUDE
+from src.trajectory import BUCKET_AVERAGE, BUCKET_LAST, bucket, douglas_peucker
+
+
+def test_douglas_peucker_keeps_corners_only():
+    # An L-shaped track: east along the equator, then north.
+    latitudes = np.r_[np.zeros(50), np.linspace(0.001, 0.05, 50)]
+    longitudes = np.r_[np.linspace(0, 0.05, 50), np.full(50, 0.05)]
+    kept, kept_latitudes, kept_longitudes = douglas_peucker(latitudes, longitudes, tolerance_meters=10)
+    assert kept.tolist() == [0, 49, 99]
+    assert kept_latitudes.tolist() == latitudes[[0, 49, 99]].tolist()
+
+
+def test_douglas_peucker_respects_tolerance():
+    rng = np.random.default_rng(0)
+    latitudes = 41 + np.cumsum(rng.normal(0, 1e-4, 5000))
+    longitudes = 29 + np.cumsum(rng.normal(0, 1e-4, 5000))
+    coarse, _, _ = douglas_peucker(latitudes, longitudes, tolerance_meters=100)
+    fine, _, _ = douglas_peucker(latitudes, longitudes, tolerance_meters=10)
+    assert 2 < len(coarse) < len(fine) < 5000
+    assert set(coarse.tolist()) <= set(fine.tolist())
+
+
+def off_track_meters(latitudes, longitudes, kept):
+    """Distance of every fix to the line through the kept fixes before and after it."""
+    x = longitudes * np.cos(np.radians(latitudes.mean())) * METERS_PER_DEGREE_LATITUDE
+    y = latitudes * METERS_PER_DEGREE_LATITUDE
+    segment = np.minimum(np.searchsorted(kept, np.arange(len(x)), side="right") - 1, len(kept) - 2)
+    start, end = kept[segment], kept[segment + 1]
+    dx, dy = x[end] - x[start], y[end] - y[start]
+    return np.abs(dx * (y[start] - y) - dy * (x[start] - x)) / np.hypot(dx, dy)
+
+
+def test_douglas_peucker_stays_within_tolerance_past_max_levels():
+    # Every level of a spiral's Douglas-Peucker tree only splits off a small part of it.
+    angles = np.linspace(0, 200, 5000)
+    latitudes, longitudes = 41 + 1e-5 * angles * np.sin(angles), 29 + 1e-5 * angles * np.cos(angles)
+    exact, _, _ = douglas_peucker(latitudes, longitudes, tolerance_meters=25, max_levels=10_000)
+    capped, _, _ = douglas_peucker(latitudes, longitudes, tolerance_meters=25, max_levels=4)
+    assert len(exact) < len(capped) < 2500
+    assert off_track_meters(latitudes, longitudes, capped).max() <= 25
+
+
+def test_bucket_keeps_last_or_average_position():
+    timestamps = np.array([0, 5, 10, 15, 29, 30])
+    latitudes = np.array([0.0, 1.0, 2.0, 3.0, 4.0, 5.0])
+    longitudes = np.array([179.0, -179.0, 0.0, 0.0, 2.0, 0.0])
+
+    kept, kept_latitudes, _ = bucket(timestamps, latitudes, longitudes, 10, BUCKET_LAST)
+    assert kept.tolist() == [1, 3, 4, 5]
+    assert kept_latitudes.tolist() == [1.0, 3.0, 4.0, 5.0]
+
+    kept, kept_latitudes, kept_longitudes = bucket(timestamps, latitudes, longitudes, 10, BUCKET_AVERAGE)
+    assert kept.tolist() == [1, 3, 4, 5]
+    assert kept_latitudes.tolist() == [0.5, 2.5, 4.0, 5.0]
+    assert abs(kept_longitudes[0]) == pytest.approx(180)
@@ -0,0 +1,96 @@
+import pytest
+
+from src.gps_record import CONTENT_TYPE_RECORDS
+from src.service.transport_service import UnixSocketTransport
+
+
+@pytest.fixture
+def consumer(tmp_path):
+    transport = UnixSocketTransport(str(tmp_path))
+    yield transport
+    transport.close()
+
+
+def start_consuming(consumer: UnixSocketTransport):
+    deliveries = consumer.consume("gps", prefetch_count=10, inactivity_timeout=0.05)
+    # The first call binds the socket and times out.
+    assert next(deliveries) is None
+    return deliveries
+
+
+def receive(deliveries, count: int) -> list:
+    received = []
+    while len(received) < count:
+        delivery = next(deliveries)
+        if delivery is not None:
+            received.append(delivery)
+    return received
+
+
+def bodies(*payloads) -> list:
+    return [(payload, CONTENT_TYPE_RECORDS) for payload in payloads]
+
+
+def test_bodies_are_delivered_in_order_and_acked_cumulatively(tmp_path, consumer):
+    deliveries = start_consuming(consumer)
+    publisher = UnixSocketTransport(str(tmp_path), retry_interval=0)
+    publisher.publish("gps", bodies(b"a", b"b"))
+    publisher.publish("gps", bodies(b"c"))
+
+    received = receive(deliveries, 3)
+    assert [(delivery.body, delivery.content_type) for delivery in received] == bodies(b"a", b"b", b"c")
+    consumer.ack(received[1].delivery_tag)
+
+    link = publisher.links["gps"]
+    link.read_acks(block=True)
+    assert [body for _, body, _ in link.unacked] == [b"c"]
+    publisher.close()
+
+
+def test_nacked_bodies_are_redelivered(tmp_path, consumer):
+    deliveries = start_consuming(consumer)
+    publisher = UnixSocketTransport(str(tmp_path), retry_interval=0)
+    publisher.publish("gps", bodies(b"a", b"b"))
+
+    consumer.nack(receive(deliveries, 2)[-1].delivery_tag)
+
+    assert [delivery.body for delivery in receive(deliveries, 2)] == [b"a", b"b"]
+    publisher.close()
+
+
+def test_unacked_bodies_are_resent_after_the_listener_restarts(tmp_path, consumer):
+    deliveries = start_consuming(consumer)
+    publisher = UnixSocketTransport(str(tmp_path), retry_interval=0)
+    publisher.publish("gps", bodies(b"a", b"b"))
+    consumer.ack(receive(deliveries, 2)[0].delivery_tag)
+    publisher.links["gps"].read_acks(block=True)
+    consumer.close()
+
+    restarted = UnixSocketTransport(str(tmp_path))
+    deliveries = start_consuming(restarted)
+    publisher.publish("gps", bodies(b"c"))
+
+    assert [delivery.body for delivery in receive(deliveries, 2)] == [b"b", b"c"]
+    publisher.close()
+    restarted.close()
+
+
+def test_a_failed_publish_is_delivered_once_after_the_caller_retries(tmp_path, consumer):
+    deliveries = start_consuming(consumer)
+    publisher = UnixSocketTransport(str(tmp_path), max_retries=2, retry_interval=0)
+    publisher.publish("gps", bodies(b"a", b"b"))
+    assert [delivery.body for delivery in receive(deliveries, 2)] == [b"a", b"b"]
+    # The listener dies before acknowledging anything.
+    consumer.close()
+
+    with pytest.raises(OSError):
+        publisher.publish("gps", bodies(b"c"))
+
+    restarted = UnixSocketTransport(str(tmp_path))
+    deliveries = start_consuming(restarted)
+    publisher.publish("gps", bodies(b"c"))
+
+    assert [delivery.body for delivery in receive(deliveries, 3)] == [b"a", b"b", b"c"]
+    assert next(deliveries) is None
+    publisher.close()
+    restarted.close()